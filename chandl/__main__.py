@@ -4,20 +4,48 @@ from __future__ import unicode_literals, print_function, division
 import sys
 import os
 import argparse
+import contextlib
+import io
+import itertools
 import logging
+import multiprocessing
+import signal
+import sqlite3
+import time
 
 import requests.packages.urllib3
 
 import chandl
-from chandl import util
-from chandl.downloader import Downloader
+from chandl import util, archive, content, control, daemon, jobs, \
+    mirrors, profiling, timeline, transport, verify
+from chandl.downloader import Cancellation, Downloader, FSYNC_MODES, \
+    FSYNC_NONE, Throttle
 from chandl.model.thread import Thread
+from chandl.model import post
 from chandl.model import file
+from chandl.store import Store
 
 
 # the default maximum number of download threads to use per core
 _DEFAULT_PARALLELISM = 2
 
+# --thumbnails modes, and how many times the usual number of threads download
+# them, as they are small
+_THUMBNAILS_ONLY = 'only'
+_THUMBNAILS_FIRST = 'first'
+_THUMBNAIL_MODES = [_THUMBNAILS_ONLY, _THUMBNAILS_FIRST]
+_THUMBNAIL_PARALLELISM = 4
+_THUMBNAIL_DIR = 'thumbnails'
+
+# the number of allocation sites --trace-malloc reports by default
+_DEFAULT_TRACE_MALLOC = 10
+
+# the default format of downloaded file names
+_DEFAULT_NAME = '{file.id} - {file.name}.{file.extension}'
+
+# the port `chandl serve` listens on by default
+_DEFAULT_PORT = 8642
+
 logger = logging.getLogger(__name__)
 
 
@@ -30,6 +58,30 @@ def _print_error(msg):
     print(msg, file=sys.stderr)
 
 
+@contextlib.contextmanager
+def _cancel_on_sigint(cancellation):
+    """
+    For the duration of the context, a SIGINT cancels downloads rather than
+    raising `KeyboardInterrupt`. Signals can only be handled on the main
+    thread; elsewhere, this does nothing.
+
+    :param cancellation: The `Cancellation` of the downloads.
+    """
+    # noinspection PyUnusedLocal
+    def handler(number, frame):
+        cancellation.cancel()
+
+    try:
+        original_handler = signal.signal(signal.SIGINT, handler)
+    except ValueError:
+        yield
+        return
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, original_handler)
+
+
 def _parse_args(args):
     """
     Interpret command line arguments.
@@ -62,6 +114,13 @@ def _parse_args(args):
                         action='append',
                         type=util.decode_cli_arg,
                         default=[])
+    parser.add_argument('--select',
+                        help='the ids of the only files to download, e.g. '
+                             'after previewing their thumbnails; value either '
+                             'comma-separated or option passed multiple times',
+                        action='append',
+                        type=util.decode_cli_arg,
+                        default=[])
     parser.add_argument('-o', '--output-dir',
                         help='the directory to create the `thread-dir` within; '
                              'defaults to the present working directory',
@@ -74,50 +133,315 @@ def _parse_args(args):
     parser.add_argument('-n', '--name',
                         help='the format to use for downloaded file names',
                         type=util.decode_cli_arg,
-                        default='{file.id} - {file.name}.{file.extension}')
+                        default=_DEFAULT_NAME)
     parser.add_argument('-p', '--parallelism',
                         help='the maximum number of download threads to use '
                              'per core; defaults to {0}'.format(
                                  _DEFAULT_PARALLELISM),
                         type=int,
                         default=_DEFAULT_PARALLELISM)
+    parser.add_argument('-s', '--stream',
+                        help='start downloading while the thread is still '
+                             'being received; useful for very large threads',
+                        action='store_true')
+    parser.add_argument('--state',
+                        help='an SQLite database to remember threads, posts '
+                             'and downloaded files in between runs; files it '
+                             'records as downloaded are not checked again',
+                        type=util.decode_cli_arg)
+    parser.add_argument('-a', '--archive',
+                        help='write files into a single archive named after '
+                             'the `thread-dir` instead of into the directory; '
+                             'existing archives are added to',
+                        choices=archive.FORMATS)
+    parser.add_argument('-c', '--content-dir',
+                        help='store files by checksum in a tree shared by '
+                             'all threads under this directory; the '
+                             '`thread-dir` only contains symlinks to them',
+                        type=util.decode_cli_arg)
+    parser.add_argument('-m', '--manifest',
+                        help='with --content-dir, list files in a manifest in '
+                             'the `thread-dir` instead of linking to them',
+                        action='store_true')
+    parser.add_argument('-i', '--index',
+                        help='add post text, file names and thread titles to '
+                             'the state database\'s search index, for use '
+                             'with `chandl search`',
+                        action='store_true')
+    parser.add_argument('--thumbnails',
+                        help='download the thumbnail of every file into a '
+                             '`thumbnails` directory within the `thread-dir`, '
+                             'with {0} times the threads, to preview the '
+                             'thread: only them, or first, before the files '
+                             'themselves'.format(_THUMBNAIL_PARALLELISM),
+                        choices=_THUMBNAIL_MODES)
+    parser.add_argument('--drop-cache',
+                        help='advise the OS not to keep downloaded files in '
+                             'memory, so archiving many files does not evict '
+                             'more useful data from the page cache',
+                        action='store_true')
+    parser.add_argument('--fsync',
+                        help='when to flush files saved in the `thread-dir` '
+                             'to disk, so they survive a power loss: after '
+                             'each file, by each download thread once it is '
+                             'done, or once at the end; defaults to none, '
+                             'leaving it to the OS',
+                        choices=FSYNC_MODES,
+                        default=FSYNC_NONE)
+    parser.add_argument('--summary-only',
+                        help='only count the files that failed, rather than '
+                             'list them at the end, so memory use stays flat '
+                             'however many files are processed',
+                        action='store_true')
+    parser.add_argument('-q', '--queue',
+                        help='share downloads with other chandl processes, '
+                             'possibly on other hosts, through a queue in '
+                             'this SQLite database; files another process '
+                             'has downloaded or is downloading are skipped',
+                        type=util.decode_cli_arg)
+    parser.add_argument('-M', '--media-host',
+                        help='a URL files are served from, e.g. '
+                             'https://i.4cdn.org; value either '
+                             'comma-separated or option passed multiple '
+                             'times. Each file is downloaded from the '
+                             'fastest host that has not failed recently, '
+                             'failing over to the others',
+                        action='append',
+                        type=util.decode_cli_arg,
+                        default=[])
+    parser.add_argument('--prewarm',
+                        help='the number of connections to open to each '
+                             'media host while the thread is retrieved, so '
+                             'the first files need not wait for them, up to '
+                             'the number of download threads; by default, '
+                             'they are opened as needed',
+                        type=int,
+                        default=0)
+    parser.add_argument('--limit-rate',
+                        help='the most bytes per second to receive files at, '
+                             'across all download threads; suffix with K, M '
+                             'or G for KiB, MiB or GiB',
+                        metavar='RATE',
+                        type=util.decode_cli_arg)
+    parser.add_argument('--transport',
+                        help='how to send HTTP requests: with requests, '
+                             'through a single event loop (requires '
+                             'aiohttp), or with requests, recording each '
+                             'response in the `cassette` directory, or '
+                             'replaying responses recorded there without '
+                             'touching the network',
+                        choices=transport.BACKENDS,
+                        default=transport.BACKEND_REQUESTS)
+    parser.add_argument('--cassette',
+                        help='the directory the record and replay transports '
+                             'keep responses in',
+                        type=util.decode_cli_arg)
+    parser.add_argument('--profile',
+                        help='profile the run, including every download '
+                             'thread, writing the result to this file',
+                        type=util.decode_cli_arg)
+    parser.add_argument('--profiler',
+                        help='with --profile, how to profile: with cProfile, '
+                             'writing statistics for pstats or snakeviz, or by '
+                             'sampling stacks every {0:.0f} ms, writing '
+                             'collapsed stacks for flame graph tools; defaults '
+                             'to deterministic'.format(
+                                 profiling.SAMPLE_INTERVAL * 1000),
+                        choices=profiling.PROFILERS,
+                        default=profiling.PROFILER_DETERMINISTIC)
+    parser.add_argument('--trace-malloc',
+                        help='trace memory allocations during the run, then '
+                             'report the peak and the N sites holding the '
+                             'most memory (default: {0})'.format(
+                                 _DEFAULT_TRACE_MALLOC),
+                        metavar='N',
+                        nargs='?',
+                        type=int,
+                        const=_DEFAULT_TRACE_MALLOC)
+    parser.add_argument('--timeline',
+                        help='record what each download thread spends its '
+                             'time on, writing a timeline to this file in '
+                             'Chrome\'s trace format, for about:tracing or '
+                             'Perfetto',
+                        type=util.decode_cli_arg)
+    parser.add_argument('--control',
+                        help='a file of `parallelism = N` and `limit-rate = '
+                             'RATE` lines to retune the download with '
+                             'whenever it changes, or on SIGUSR2; SIGUSR1 '
+                             'prints the state of the download whether or not '
+                             'it is passed',
+                        metavar='FILE',
+                        type=util.decode_cli_arg)
     parser.add_argument('url',
                         type=util.decode_cli_arg,
                         help='the URL of the thread to download')
-    return parser.parse_args(args[1:])
+    parsed = parser.parse_args(args[1:])
+    parsed.media_host = [host for arg in parsed.media_host
+                         for host in (h.strip() for h in arg.split(','))
+                         if host]
+    for host in parsed.media_host:
+        if not host.startswith(('http://', 'https://')):
+            parser.error('Invalid media host: {0}'.format(host))
+    if parsed.transport in (transport.BACKEND_RECORD,
+                            transport.BACKEND_REPLAY) and not parsed.cassette:
+        parser.error('--transport {0} requires --cassette'.format(
+            parsed.transport))
+    if parsed.index and not parsed.state:
+        parser.error('--index requires --state')
+    if parsed.manifest and not parsed.content_dir:
+        parser.error('--manifest requires --content-dir')
+    if parsed.archive and parsed.content_dir:
+        parser.error('--archive and --content-dir cannot be used together')
+    if parsed.thumbnails and parsed.archive:
+        parser.error('--thumbnails and --archive cannot be used together')
+    if parsed.trace_malloc is not None and profiling.tracemalloc is None:
+        parser.error('--trace-malloc requires Python 3.4 or later')
+    parsed.select = _parse_file_ids(parser, parsed.select)
+    if parsed.limit_rate is not None:
+        try:
+            parsed.limit_rate = control.parse_rate(
+                parsed.limit_rate) or None
+        except ValueError as e:
+            parser.error(str(e))
+    return parsed
 
 
-def _remove_unwanted(posts, args):
+def _parse_file_ids(parser, values):
+    """
+    Interpret the values of a --select option.
 
-    # filter out posts without a file
-    posts = [post for post in posts if post.has_file]
-    logger.debug('%d contain a file', len(posts))
+    :param parser: The `ArgumentParser`, to report invalid values.
+    :param values: The option's values, each comma-separated.
+    :return: The set of file ids, or None if the option was not passed.
+    """
+    if not values:
+        return None
+    try:
+        return set(int(id_) for id_ in util.expand_cli_args(values) if id_)
+    except ValueError:
+        parser.error('--select takes file ids, e.g. 1486866826992')
 
-    # filter out files of the wrong type
-    if args.filter:
-        extensions = file.expand_filters(args.filter)
-        posts = [post for post in posts if post.file.extension in extensions]
-    logger.debug('%d are also of the desired format', len(posts))
 
-    # filter out excluded file names
-    filenames = util.expand_cli_args(args.exclude)
-    posts = [post for post in posts if post.file.name not in filenames]
-    logger.debug('%d have also not been excluded', len(posts))
+def _parse_search_args(args):
+    """
+    Interpret the command line arguments of `chandl search`.
 
-    return posts
+    :param args: `sys.argv`
+    :return: The populated argparse namespace.
+    """
 
+    parser = argparse.ArgumentParser(prog='chandl search',
+                                     description='Search the posts indexed '
+                                                 'by previous downloads.')
+    parser.add_argument('-l', '--limit',
+                        help='the maximum number of posts to show; defaults '
+                             'to 20',
+                        type=int,
+                        default=20)
+    parser.add_argument('state',
+                        type=util.decode_cli_arg,
+                        help='the state database passed to --state when '
+                             'downloading')
+    parser.add_argument('query',
+                        type=util.decode_cli_arg,
+                        help='the words to search for, in SQLite FTS5 query '
+                             'syntax')
+    return parser.parse_args(args[2:])
 
-def main(args):
+
+def _search(args):
     """
-    chandl's entry point.
+    Run `chandl search`, printing matching posts and the paths of their
+    downloaded files.
 
     :param args: Command-line arguments, with the program in position 0.
+    :return: The exit status.
     """
+    args = _parse_search_args(args)
 
-    args = _parse_args(args)
+    if not os.path.isfile(args.state):
+        _print_error('No state database at {0}'.format(args.state))
+        return 4
+
+    try:
+        store_ = Store(args.state)
+        try:
+            results = store_.search(args.query, args.limit)
+        finally:
+            store_.close()
+    except sqlite3.Error as e:
+        _print_error('Search failed: {0}'.format(e))
+        return 4
+
+    for result in results:
+        print(result)
+        print('    ' + result.snippet.replace('\n', ' '))
+        if result.path:
+            print('    ' + result.path)
+    return 0
+
+
+def _parse_serve_args(args):
+    """
+    Interpret the command line arguments of `chandl serve`.
 
-    # sort out logging output and level
-    level = util.log_level_from_vebosity(args.verbosity)
+    :param args: `sys.argv`
+    :return: The populated argparse namespace.
+    """
+
+    parser = argparse.ArgumentParser(prog='chandl serve',
+                                     description='Download threads submitted '
+                                                 'over a local HTTP API.')
+    parser.add_argument('-v', '--verbosity',
+                        help='increase output verbosity',
+                        action='count',
+                        default=0)
+    parser.add_argument('-o', '--output-dir',
+                        help='the directory to create thread directories '
+                             'within; defaults to the present working '
+                             'directory',
+                        type=util.decode_cli_arg,
+                        default=os.getcwd())
+    parser.add_argument('-n', '--name',
+                        help='the default format to use for downloaded file '
+                             'names',
+                        type=util.decode_cli_arg,
+                        default=_DEFAULT_NAME)
+    parser.add_argument('-p', '--parallelism',
+                        help='the maximum number of download threads to use '
+                             'per core; defaults to {0}'.format(
+                                 _DEFAULT_PARALLELISM),
+                        type=int,
+                        default=_DEFAULT_PARALLELISM)
+    parser.add_argument('--state',
+                        help='the SQLite database to queue jobs in; defaults '
+                             'to chandl.db in the `output-dir`',
+                        type=util.decode_cli_arg)
+    parser.add_argument('--host',
+                        help='the address to listen on; defaults to '
+                             '127.0.0.1',
+                        default='127.0.0.1')
+    listen = parser.add_mutually_exclusive_group()
+    listen.add_argument('--port',
+                        help='the port to listen on; defaults to {0}'.format(
+                            _DEFAULT_PORT),
+                        type=int,
+                        default=_DEFAULT_PORT)
+    listen.add_argument('--socket',
+                        help='listen on a Unix socket at this path instead of '
+                             'a port',
+                        type=util.decode_cli_arg)
+    return parser.parse_args(args[2:])
+
+
+def _configure_logging(verbosity):
+    """
+    Send log messages to stdout.
+
+    :param verbosity: The number of times -v was passed.
+    :return: The log level.
+    """
+    level = util.log_level_from_vebosity(verbosity)
     root = logging.getLogger()
     root.setLevel(level)
     handler = logging.StreamHandler(sys.stdout)
@@ -128,39 +452,510 @@ def main(args):
     if level != logging.DEBUG:
         requests.packages.urllib3.disable_warnings()
 
+    return level
+
+
+def _serve(args):
+    """
+    Run `chandl serve` until interrupted.
+
+    :param args: Command-line arguments, with the program in position 0.
+    :return: The exit status.
+    """
+    args = _parse_serve_args(args)
+    _configure_logging(args.verbosity)
+    logger.debug(args)
+
+    state = args.state or os.path.join(args.output_dir, 'chandl.db')
+    try:
+        store_ = Store(state)
+    except sqlite3.Error as e:
+        _print_error('Failed to open the state database at {0}: {1}'.format(
+            state, e))
+        return 4
+
+    try:
+        daemon_ = daemon.Daemon(store_, os.path.abspath(args.output_dir),
+                                args.name, args.parallelism)
+        try:
+            daemon_.start(args.socket or (args.host, args.port))
+        except (IOError, OSError) as e:
+            _print_error('Failed to listen: {0}'.format(e))
+            return 5
+
+        address = daemon_.address
+        print('Listening on {0}'.format(
+            address if args.socket else 'http://{0}:{1}'.format(*address)))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(os.linesep + 'Stopping; abandoning downloads in progress.')
+            daemon_.stop()
+    finally:
+        store_.close()
+
+    return 0
+
+
+def _parse_verify_args(args):
+    """
+    Interpret the command line arguments of `chandl verify`.
+
+    :param args: `sys.argv`
+    :return: The populated argparse namespace.
+    """
+
+    parser = argparse.ArgumentParser(prog='chandl verify',
+                                     description='Check downloaded files '
+                                                 'against their checksums.')
+    parser.add_argument('-v', '--verbosity',
+                        help='increase output verbosity',
+                        action='count',
+                        default=0)
+    parser.add_argument('-f', '--filter',
+                        help='with a `url`, the file types or extensions '
+                             'that were downloaded',
+                        action='append',
+                        type=util.decode_cli_arg,
+                        default=[])
+    parser.add_argument('-e', '--exclude',
+                        help='with a `url`, the file names that were excluded',
+                        action='append',
+                        type=util.decode_cli_arg,
+                        default=[])
+    parser.add_argument('--select',
+                        help='with a `url`, the ids of the only files that '
+                             'were downloaded',
+                        action='append',
+                        type=util.decode_cli_arg,
+                        default=[])
+    parser.add_argument('-n', '--name',
+                        help='with a `url`, the format files were named with',
+                        type=util.decode_cli_arg,
+                        default=_DEFAULT_NAME)
+    parser.add_argument('-j', '--processes',
+                        help='the number of processes to hash files with; '
+                             'defaults to the number of cores',
+                        type=int)
+    parser.add_argument('--state',
+                        help='the state database passed to --state when '
+                             'downloading; without a `url`, a directory is '
+                             'checked against the files it records',
+                        type=util.decode_cli_arg)
+    parser.add_argument('-r', '--requeue',
+                        help='download corrupt and missing files again if a '
+                             '`url` is given; otherwise, mark them in the '
+                             'state database for the next run to download',
+                        action='store_true')
+    parser.add_argument('path',
+                        type=util.decode_cli_arg,
+                        help='a thread directory, or an archive written with '
+                             '--archive, which is checked against its '
+                             'manifest')
+    parser.add_argument('url',
+                        type=util.decode_cli_arg,
+                        nargs='?',
+                        help='the URL of the thread, to check a directory '
+                             'against the thread\'s current files')
+    parsed = parser.parse_args(args[2:])
+    parsed.select = _parse_file_ids(parser, parsed.select)
+    if parsed.requeue and not (parsed.url or parsed.state):
+        parser.error('--requeue requires a url or --state')
+    return parsed
+
+
+def _verify(args):
+    """
+    Run `chandl verify`, printing corrupt and missing files.
+
+    :param args: Command-line arguments, with the program in position 0.
+    :return: The exit status; 6 if any file is corrupt or missing.
+    """
+    args = _parse_verify_args(args)
+    level = _configure_logging(args.verbosity)
     logger.debug(args)
 
+    path = os.path.abspath(args.path)
+    if os.path.isfile(path):
+        if args.url or args.requeue:
+            _print_error('Archives are checked against their manifest; a url '
+                         'and --requeue cannot be used')
+            return 2
+        try:
+            result = verify.verify_archive(path, args.processes)
+        except (ValueError, IOError) as e:
+            _print_error('Failed to read the archive at {0}: {1}'.format(
+                path, e))
+            return 3
+        return _report(result)
+
+    if not os.path.isdir(path):
+        _print_error('No thread directory or archive at {0}'.format(path))
+        return 3
+    if not (args.url or args.state):
+        _print_error('A url or --state is needed to check a directory')
+        return 2
+
+    store_ = None
+    if args.state:
+        try:
+            store_ = Store(args.state)
+        except sqlite3.Error as e:
+            _print_error('Failed to open the state database at {0}: {1}'.format(
+                args.state, e))
+            return 4
+
     try:
-        thread = Thread.from_url(args.url)
+        if args.url:
+            try:
+                thread = Thread.from_url(args.url, lazy=True)
+                entries = [verify.Entry(post_.format(args.name),
+                                        post_.file.md5, post_)
+                           for post_ in _remove_unwanted(thread.posts, args)]
+            except (ValueError, IOError) as e:
+                _print_error('Error retrieving thread: {0}'.format(e))
+                return 1
+            except KeyError as e:
+                _print_error('Invalid file name specifier: {0}'.format(e))
+                return 2
+        else:
+            entries = [verify.Entry(os.path.relpath(path_, path), md5,
+                                    (board, id_))
+                       for board, id_, path_, md5 in store_.saved_files(path)]
+
+        result = verify.verify_directory(path, entries, args.processes)
+        status = _report(result)
+        if args.requeue and result.problems:
+            _requeue(args, level, path, result, store_)
+        return status
+    finally:
+        if store_:
+            store_.close()
+
+
+def _report(result):
+    """
+    Print the problems found by `chandl verify`.
+
+    :param result: The `VerifyResult`.
+    :return: The exit status.
+    """
+    for problem in result.problems:
+        print(problem)
+    print(result)
+    return 6 if result.problems else 0
+
+
+def _requeue(args, level, directory, result, store_=None):
+    """
+    Have the corrupt and missing files found by `chandl verify` downloaded
+    again: now if the thread was retrieved, otherwise by the next run using
+    the state database.
+
+    :param args: The parsed command line arguments.
+    :param level: The log level.
+    :param directory: The thread directory.
+    :param result: The `VerifyResult`.
+    :param store_: The `Store` to use, if any.
+    """
+    sources = [problem.entry.source for problem in result.problems]
+    if not args.url:
+        store_.reset_files(sources)
+        print('{0} files will be downloaded by the next run'.format(
+            len(sources)))
+        return
+
+    downloader = Downloader(directory, args.name, _DEFAULT_PARALLELISM,
+                            store_)
+    with _cancel_on_sigint(downloader.cancellation):
+        print(downloader.download(sources, level >= logging.WARNING))
+
+
+def _log_count(message, posts):
+    """
+    Log the number of posts, if it can be found without consuming them.
+
+    :param message: The message, with a %d placeholder for the count.
+    :param posts: The posts to count.
+    """
+    if hasattr(posts, '__len__'):
+        logger.debug(message, len(posts))
+
+
+def _remove_unwanted(posts, args):
+    """
+    Apply the --filter, --exclude and --select options. Posts are selected
+    based on their raw JSON, so those removed are never decoded.
+
+    :param posts: The thread's `LazyPosts` or `PostStream`.
+    :param args: The parsed command line arguments.
+    :return: The posts to download.
+    """
+
+    posts = post.select(posts, file.expand_filters(args.filter),
+                        util.expand_cli_args(args.exclude), args.select)
+    _log_count('%d contain a file of the desired format not excluded', posts)
+
+    return posts
+
+
+def main(args):
+    """
+    chandl's entry point.
+
+    :param args: Command-line arguments, with the program in position 0.
+    """
+
+    if len(args) > 1 and args[1] == 'search':
+        return _search(args)
+    if len(args) > 1 and args[1] == 'serve':
+        return _serve(args)
+    if len(args) > 1 and args[1] == 'verify':
+        return _verify(args)
+
+    args = _parse_args(args)
+    level = _configure_logging(args.verbosity)
+    logger.debug(args)
+
+    try:
+        factory = transport.factory(args.transport, args.cassette)
+    except ValueError as e:
+        _print_error(str(e))
+        return 2
+
+    store_ = None
+    if args.state:
+        try:
+            store_ = Store(args.state, args.index)
+        except sqlite3.Error as e:
+            _print_error('Failed to open the state database at {0}: {1}'.format(
+                args.state, e))
+            return 4
+
+    queue = None
+    if args.queue:
+        try:
+            queue = jobs.SQLiteQueue(args.queue)
+        except sqlite3.Error as e:
+            _print_error('Failed to open the queue at {0}: {1}'.format(
+                args.queue, e))
+            if store_:
+                store_.close()
+            return 4
+
+    # shared by the download threads, and everything else the run requests
+    session = transport.pooled(_download_threads(args), factory)
+    try:
+        with _instrumented(args) as timeline_:
+            return _download_thread(args, level, session, store_, queue,
+                                    timeline_)
+    except _OutputError as e:
+        _print_error(str(e))
+        return 3
+    finally:
+        session.close()
+        if queue:
+            queue.close()
+        if store_:
+            store_.close()
+
+
+def _download_threads(args):
+    """
+    Find the most download threads a run uses at once.
+
+    :param args: The parsed command line arguments.
+    :return: The number of threads.
+    """
+    threads = multiprocessing.cpu_count() * args.parallelism
+    if args.thumbnails:
+        threads *= _THUMBNAIL_PARALLELISM
+    return threads
+
+
+class _OutputError(Exception):
+    """
+    Raised when a file requested on the command line, e.g. a profile, could
+    not be written.
+    """
+
+
+def _check_writable(path, what):
+    """
+    Check that a file requested on the command line can be written, so a run
+    fails before it starts rather than after it finishes.
+
+    :param path: The file's path.
+    :param what: What the file will hold, for the error message.
+    :raises _OutputError: If it cannot be written.
+    """
+    try:
+        io.open(path, 'wb').close()
+    except IOError as e:
+        raise _OutputError('Failed to write the {0} to {1}: {2}'.format(
+            what, path, e))
+
+
+@contextlib.contextmanager
+def _optional(manager):
+    """
+    Enter a context manager, if there is one.
+
+    :param manager: The context manager, or None.
+    :return: A context manager yielding what it yields, or None.
+    """
+    if manager is None:
+        yield None
+    else:
+        with manager as value:
+            yield value
+
+
+@contextlib.contextmanager
+def _instrumented(args):
+    """
+    For the duration of the context, profile the run, trace its memory
+    allocations and record a timeline of its download threads, as requested
+    on the command line. Each is written or printed once the context exits,
+    unless it raises.
+
+    :param args: The parsed command line arguments.
+    :return: A context manager yielding the `Timeline` to record the download
+             threads in, or None.
+    :raises _OutputError: If the profile or timeline cannot be written; this
+                          is checked before the context is entered, too.
+    """
+    if args.profile:
+        _check_writable(args.profile, 'profile')
+    if args.timeline:
+        _check_writable(args.timeline, 'timeline')
+
+    timeline_ = timeline.Timeline() if args.timeline else None
+    with _optional(profiling.profiled(args.profile, args.profiler)
+                   if args.profile else None):
+        with _optional(profiling.traced_allocations(args.trace_malloc)
+                       if args.trace_malloc is not None else None) as report:
+            yield timeline_
+
+    if report:
+        print(report)
+    if args.profile:
+        print('Wrote the profile to \'{0}\''.format(
+            _display_path(os.path.abspath(args.profile))))
+    if timeline_ is not None:
+        try:
+            timeline_.write(args.timeline)
+        except IOError as e:
+            raise _OutputError('Failed to write the timeline to {0}: '
+                               '{1}'.format(args.timeline, e))
+        print('Wrote the timeline to \'{0}\''.format(
+            _display_path(os.path.abspath(args.timeline))))
+
+
+def _track(thread, store_):
+    """
+    Record a thread and all of its posts in the state database.
+
+    :param thread: The thread just retrieved.
+    :param store_: The `Store`.
+    """
+    store_.add_thread(thread)
+    # record the raw JSON, so posts that are not downloaded are never decoded
+    if hasattr(thread.posts, '__len__'):
+        store_.add_raw_posts(thread, thread.posts.raw())
+    else:
+        # record posts as they are received
+        thread.posts = thread.posts.tap(
+            lambda json: store_.add_raw_post(thread, json))
+
+
+def _download_thread(args, level, session, store_=None, queue=None,
+                     timeline_=None):
+    """
+    Retrieve the thread and download its files.
+
+    :param args: The parsed command line arguments.
+    :param level: The log level.
+    :param session: The transport to send every request with.
+    :param store_: The `Store` to use, if any.
+    :param queue: The job queue shared with other processes, if any.
+    :param timeline_: The `Timeline` to record the download threads in, if
+                      any.
+    :return: The exit status.
+    """
+    # the first connections open while the thread is retrieved
+    for root in args.media_host or [file.MEDIA_ROOT]:
+        transport.prewarm(session, root + '/',
+                          min(args.prewarm, _download_threads(args)))
+
+    try:
+        thread = Thread.from_url(args.url, session, lazy=True,
+                                 stream=args.stream)
     except (ValueError, IOError) as e:
         _print_error('Error retrieving thread: {0}'.format(e))
         return 1
 
+    if store_:
+        _track(thread, store_)
+
     posts = thread.posts
-    logger.debug('Thread contains %d posts', len(posts))
+    _log_count('Thread contains %d posts', posts)
 
     posts = _remove_unwanted(posts, args)
-    logger.debug('Will download %d posts', len(posts))
+
+    # set an appropriate thread_dir if one was not specified
+    if not args.thread_dir:
+        args.thread_dir = util.make_filename(thread.title)
+
+    write_dir = os.path.abspath(os.path.join(args.output_dir, args.thread_dir))
+
+    if store_:
+        # skip files a previous run downloaded to the same place, without
+        # hashing them
+        done = store_.downloaded(
+            thread.board, thread.id,
+            '{0}.{1}'.format(write_dir, args.archive) if args.archive
+            else write_dir)
+        logger.info('%d files were downloaded by a previous run', len(done))
+        if done:
+            posts = posts.filter(lambda json: json['tim'] not in done)
+
+    _log_count('Will download %d posts', posts)
+
+    # find the first post to download; when streaming, this only waits until
+    # that post has been received
+    remaining = iter(posts)
+    try:
+        first = next(remaining, None)
+    except (ValueError, IOError) as e:
+        _print_error('Error retrieving thread: {0}'.format(e))
+        return 1
 
     # check whether we still have anything to do
-    if not posts:
-        print('All files are either filtered out or excluded')
+    if first is None:
+        print('All files are either filtered out, excluded or already '
+              'downloaded' if store_ else
+              'All files are either filtered out or excluded')
         return 0
 
-    # use the first post to validate the --name
+    if args.stream:
+        posts = itertools.chain([first], remaining)
+
+    # use the first post to validate the --name, unless it could not be
+    # decoded, in which case the downloader counts it as failed
     try:
-        post = posts[0]
-        args.name.format(**post.__dict__)
+        if not isinstance(first, post.MalformedPost):
+            first.format(args.name)
     except KeyError as e:
         _print_error('Invalid file name specifier: {0}'.format(e))
         return 2
 
-    # set an appropriate thread_dir if one was not specified
-    if not args.thread_dir:
-        args.thread_dir = util.make_filename(thread.title)
+    if args.archive:
+        return _archive_thread(args, level, thread, posts, write_dir, session,
+                               store_, queue, timeline_)
 
     # create --thread-dir
-    write_dir = os.path.abspath(os.path.join(args.output_dir, args.thread_dir))
     if not os.path.isdir(write_dir):
         try:
             os.mkdir(write_dir, 0o700)
@@ -170,21 +965,186 @@ def main(args):
                     write_dir, e))
             return 3
 
-    # show a relative path is there is a common directory (below root) between
-    # the `pwd` and the write_dir, otherwise show the absolute path
-    display_path = write_dir \
-        if os.path.dirname(os.path.commonprefix([write_dir,
-                                                 os.getcwd()])) == '/' \
-        else os.path.relpath(write_dir, os.getcwd())
+    mirrors_ = _mirrors(args)
+    cancellation = Cancellation()
+    throttle = Throttle(args.limit_rate)
+    if args.thumbnails:
+        if args.thumbnails == _THUMBNAILS_FIRST and \
+                not hasattr(posts, '__len__'):
+            # both passes need the posts
+            posts = list(posts)
+        status = _download_thumbnails(args, level, posts, write_dir, session,
+                                      mirrors_, cancellation, timeline_,
+                                      throttle)
+        if status or args.thumbnails == _THUMBNAILS_ONLY or \
+                cancellation.cancelled:
+            return status
+
+    output = None
+    if args.content_dir:
+        root = os.path.abspath(args.content_dir)
+        try:
+            output = content.ContentDirectory(root, write_dir,
+                                              not args.manifest,
+                                              not args.drop_cache)
+        except (IOError, OSError) as e:
+            _print_error(
+                'Failed to create the content directory at {0}: {1}'.format(
+                    root, e))
+            return 3
+
+    print('Saving \'{0}\' to \'{1}\''.format(thread.title,
+                                             _display_path(write_dir)))
+    downloader = Downloader(write_dir, args.name, args.parallelism, store_,
+                            output, session=session, queue=queue,
+                            cache=not args.drop_cache, fsync=args.fsync,
+                            mirrors_=mirrors_, cancellation=cancellation,
+                            summary_only=args.summary_only,
+                            timeline_=timeline_, throttle=throttle)
+    try:
+        _run(downloader, posts, level, thread, store_, args.control)
+    finally:
+        if output:
+            output.close()
+    return 0
+
 
-    # download the files
-    print('Saving \'{0}\' to \'{1}\''.format(thread.title, display_path))
-    downloader = Downloader(write_dir, args.name, args.parallelism)
-    print(downloader.download(posts, level >= logging.WARNING))
+def _download_thumbnails(args, level, posts, write_dir, session,
+                         mirrors_=None, cancellation=None, timeline_=None,
+                         throttle=None):
+    """
+    Download the thumbnails of posts into a directory within the thread
+    directory. Thumbnails already there are skipped.
+
+    :param args: The parsed command line arguments.
+    :param level: The log level.
+    :param posts: The posts whose thumbnails to download.
+    :param write_dir: The path of the thread directory.
+    :param session: The transport for the download threads to share.
+    :param mirrors_: The media hosts to download from, if any.
+    :param cancellation: The `Cancellation` to share with later downloads, if
+                         any.
+    :param timeline_: The `Timeline` to record the download threads in, if
+                      any.
+    :param throttle: The `Throttle` to share with later downloads, if any.
+    :return: The exit status.
+    """
+    directory = os.path.join(write_dir, _THUMBNAIL_DIR)
+    if not os.path.isdir(directory):
+        try:
+            os.mkdir(directory, 0o700)
+        except OSError as e:
+            _print_error(
+                'Failed to create the thumbnail directory at {0}: {1}'.format(
+                    directory, e))
+            return 3
 
+    print('Saving thumbnails to \'{0}\''.format(_display_path(directory)))
+    downloader = Downloader(directory, args.name,
+                            args.parallelism * _THUMBNAIL_PARALLELISM,
+                            session=session, cache=not args.drop_cache,
+                            fsync=args.fsync, mirrors_=mirrors_,
+                            thumbnails=True, cancellation=cancellation,
+                            summary_only=args.summary_only,
+                            timeline_=timeline_, throttle=throttle)
+    with _cancel_on_sigint(downloader.cancellation), \
+            control.controlled(downloader, args.control,
+                               _THUMBNAIL_PARALLELISM):
+        print(downloader.download(posts, level >= logging.WARNING))
     return 0
 
 
+def _mirrors(args):
+    """
+    Get the media hosts to download files from.
+
+    :param args: The parsed command-line arguments.
+    :return: The `Mirrors`, or None if `--media-host` was not passed.
+    """
+    return mirrors.Mirrors(args.media_host) if args.media_host else None
+
+
+def _display_path(path):
+    """
+    Shorten a path for display. A relative path is shown if there is a common
+    directory (below root) between the `pwd` and the path, otherwise the
+    absolute path is shown.
+
+    :param path: The absolute path.
+    :return: The path to print.
+    """
+    return path \
+        if os.path.dirname(os.path.commonprefix([path,
+                                                 os.getcwd()])) == '/' \
+        else os.path.relpath(path, os.getcwd())
+
+
+def _run(downloader, posts, level, thread, store_=None, control_=None):
+    """
+    Download files, recording the run in the state database, and print the
+    result.
+
+    :param downloader: The configured `Downloader`.
+    :param posts: The posts to download.
+    :param level: The log level.
+    :param thread: The thread the posts belong to.
+    :param store_: The `Store` to use, if any.
+    :param control_: The path of the --control file, if any.
+    """
+    run_id = store_.start_run(thread) if store_ else None
+    with _cancel_on_sigint(downloader.cancellation), \
+            control.controlled(downloader, control_):
+        result = downloader.download(posts, level >= logging.WARNING)
+    if store_:
+        store_.finish_run(run_id, result)
+    print(result)
+
+
+def _archive_thread(args, level, thread, posts, write_dir, session=None,
+                    store_=None, queue=None, timeline_=None):
+    """
+    Download files into an archive alongside where the thread directory would
+    otherwise be created.
+
+    :param args: The parsed command line arguments.
+    :param level: The log level.
+    :param thread: The thread being downloaded.
+    :param posts: The posts to download.
+    :param write_dir: The path of the thread directory.
+    :param session: The transport for the download threads to share, if any.
+    :param store_: The `Store` to use, if any.
+    :param queue: The job queue shared with other processes, if any.
+    :param timeline_: The `Timeline` to record the download threads in, if
+                      any.
+    :return: The exit status.
+    """
+    path = '{0}.{1}'.format(write_dir, args.archive)
+    try:
+        archive_ = archive.Archive(path, args.archive)
+    except (ValueError, IOError) as e:
+        _print_error('Failed to open the archive at {0}: {1}'.format(path, e))
+        return 3
+
+    print('Saving \'{0}\' to \'{1}\''.format(thread.title,
+                                             _display_path(path)))
+    downloader = Downloader(write_dir, args.name, args.parallelism, store_,
+                            archive_, session=session, queue=queue,
+                            mirrors_=_mirrors(args),
+                            summary_only=args.summary_only,
+                            timeline_=timeline_,
+                            throttle=Throttle(args.limit_rate))
+    status = 0
+    try:
+        _run(downloader, posts, level, thread, store_, args.control)
+    finally:
+        try:
+            archive_.close()
+        except IOError as e:
+            _print_error(str(e))
+            status = 3
+    return status
+
+
 def main_cli():
     """
     chandl's command-line entry point.
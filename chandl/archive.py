@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""
+Writing a thread's files into a single archive rather than as loose files in a
+directory, which is kinder to filesystems that handle many small files
+poorly.
+"""
+from __future__ import unicode_literals
+
+import calendar
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+from six.moves import queue
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+
+FORMAT_TAR = 'tar'
+FORMAT_TAR_GZ = 'tar.gz'
+FORMAT_TAR_ZSTD = 'tar.zst'
+FORMAT_ZIP = 'zip'
+
+FORMATS = [FORMAT_TAR, FORMAT_TAR_GZ, FORMAT_TAR_ZSTD, FORMAT_ZIP]
+
+# the suffix appended to an archive's path to name its manifest
+MANIFEST_SUFFIX = '.manifest.jsonl'
+
+# files up to this size are buffered in memory before being archived; larger
+# ones are spilled to a temporary file
+_SPOOL_SIZE = 8 * 1024 * 1024
+
+# the number of downloaded files that may wait for the writer before workers
+# are made to wait for it to catch up
+_BACKLOG = 32
+
+# the most files added to the archive before it is flushed to disk and they
+# are recorded in the manifest; fewer whenever the writer runs out of files
+_COMMIT_BATCH = 32
+
+# how much of a file to copy into a zip archive at a time
+_COPY_SIZE = 64 * 1024
+
+# zip members can only be written as a stream from Python 3.6
+_ZIP_STREAMING = sys.version_info >= (3, 6)
+
+logger = logging.getLogger(__name__)
+
+
+def _part_path(path, format_, part):
+    """
+    Find the path of an additional part of a compressed tar archive.
+
+    :param path: The path of the first part, e.g. `thread.tar.gz`.
+    :param format_: The archive's format.
+    :param part: The part number, from 2.
+    :return: The part's path, e.g. `thread.2.tar.gz`.
+    """
+    return '{0}.{1}.{2}'.format(path[:-len(format_) - 1], part, format_)
+
+
+def _open_tar(path, format_, mode):
+    """
+    Open a tar archive for writing.
+
+    :param path: The archive's path.
+    :param format_: One of the tar `FORMAT_` constants.
+    :param mode: 'w' to create the archive, or 'a' to add to it; only plain
+                 tar archives can be added to.
+    :return: A (tarfile, underlying file or None) tuple; both must be closed.
+    """
+    if format_ == FORMAT_TAR:
+        return tarfile.open(path, mode), None
+    if format_ == FORMAT_TAR_GZ:
+        return tarfile.open(path, 'w:gz'), None
+
+    # tarfile cannot compress with zstd itself; not opened as a stream, as
+    # tarfile would then buffer the end of each member where `flush()` cannot
+    # reach it
+    raw = open(path, 'wb')
+    stream = zstandard.ZstdCompressor().stream_writer(raw)
+    return tarfile.open(fileobj=stream, mode='w'), stream
+
+
+def detect_format(path):
+    """
+    Infer an archive's format from the end of its path.
+
+    :param path: The path, e.g. `thread.tar.gz`.
+    :return: One of `FORMATS`, or None if the path matches none of them.
+    """
+    return next((f for f in sorted(FORMATS, key=len, reverse=True)
+                 if path.endswith('.' + f)), None)
+
+
+class Archive:
+    """
+    A tar or zip archive that files are added to by a single writer thread,
+    so download threads hand over files without waiting on each other. A
+    manifest alongside the archive lists the post, checksum and member name of
+    every file, and is read back to resume an archive on a later run.
+
+    Plain tar and zip archives are appended to in place. Compressed tar
+    archives cannot be, so later runs write a new numbered part alongside the
+    first, e.g. `thread.2.tar.gz`. So can zip archives left without a central
+    directory by an interrupted run, whose files are then downloaded again.
+    A plain tar is instead cut back to the end of the last file in the
+    manifest, as an interrupted run may have stopped partway through one.
+
+    Files are only recorded in the manifest once the archive has been flushed
+    to disk with them in it, so a killed run never leaves the manifest listing
+    a file the archive lost.
+    """
+
+    def __init__(self, path, format_=None):
+        """
+        Open an archive for writing, resuming it if it already exists.
+
+        :param path: The path of the archive.
+        :param format_: One of `FORMATS`. If omitted, this is inferred from the
+                        end of the path.
+        :raises ValueError: If the format is unknown, or unavailable.
+        :raises IOError: If the archive or its manifest could not be opened.
+        """
+        if format_ is None:
+            format_ = detect_format(path)
+        if format_ not in FORMATS:
+            raise ValueError('Unknown archive format for {0}'.format(path))
+        if format_ == FORMAT_TAR_ZSTD and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard '
+                             'package')
+
+        self.path = path
+        self.format = format_
+
+        # file id -> (md5, name of the archive or part) of files archived by
+        # previous runs
+        self._archived = {}
+        # where the last file recorded in the manifest ends in a plain tar, or
+        # None if that is not known
+        self._tar_end = None
+        manifest_path = path + MANIFEST_SUFFIX
+        if os.path.isfile(manifest_path):
+            ends = []
+            with io.open(manifest_path, encoding='utf-8') as handle:
+                for line in handle:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # cut short by an earlier run being killed
+                        continue
+                    self._archived[entry['file']] = (entry['md5'],
+                                                     entry.get('archive'))
+                    ends.append(entry.get('end'))
+            if None not in ends:
+                self._tar_end = max(ends) if ends else 0
+
+        # opened by the writer when the first file arrives, so runs that
+        # download nothing do not leave empty parts behind
+        self._write_path = self._find_write_path()
+        self._zip, self._tar, self._stream = None, None, None
+        # manifest entries of files added since the archive was last flushed
+        self._pending = []
+
+        self._manifest = io.open(manifest_path, 'a', encoding='utf-8')
+
+        self._queue = queue.Queue(_BACKLOG)
+        self._error = None
+        self._writer = threading.Thread(target=self._write_all)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _open(self):
+        """
+        Open the file this run writes to. Called on the writer thread.
+        """
+        mode = 'a' if os.path.exists(self._write_path) else 'w'
+        if mode == 'a' and self.format == FORMAT_TAR:
+            self._truncate_tar()
+        if self.format == FORMAT_ZIP:
+            self._zip = zipfile.ZipFile(self._write_path, mode,
+                                        zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            self._tar, self._stream = _open_tar(self._write_path, self.format,
+                                                mode)
+
+    def _truncate_tar(self):
+        """
+        Cut a plain tar archive back to the end of the last file recorded in
+        the manifest, discarding whatever a previous run wrote after it,
+        which may stop partway through a file, so appending does not bury
+        the remains in the archive. The discarded files are downloaded again.
+        An archive without a manifest is left alone. Called on the writer
+        thread.
+        """
+        if self._tar_end is None:
+            return
+        with open(self._write_path, 'r+b') as handle:
+            handle.truncate(self._tar_end)
+            # end-of-archive blocks, which adding to it overwrites
+            handle.seek(self._tar_end)
+            handle.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+
+    def _find_write_path(self):
+        """
+        Find the file this run should write to: the archive itself, unless it
+        is a compressed tar that already exists, in which case the next free
+        part.
+
+        :return: The path.
+        """
+        if self.format == FORMAT_ZIP:
+            return self._find_zip_path()
+        if self.format == FORMAT_TAR or not os.path.exists(self.path):
+            return self.path
+
+        part = 2
+        while os.path.exists(_part_path(self.path, self.format, part)):
+            part += 1
+        return _part_path(self.path, self.format, part)
+
+    def _find_zip_path(self):
+        """
+        Find the zip archive this run should write to: the archive itself,
+        unless an interrupted run left it without a central directory, in
+        which case the first part that is intact or does not exist. Files in
+        the broken ones are forgotten, so they are downloaded again.
+
+        :return: The path.
+        """
+        path, part = self.path, 1
+        while os.path.exists(path) and not zipfile.is_zipfile(path):
+            logger.warning('%s was left incomplete by an interrupted run; its '
+                           'files will be archived again in a new part', path)
+            broken = os.path.basename(path)
+            self._archived = dict(
+                (id_, entry) for id_, entry in self._archived.items()
+                if entry[1] != broken)
+            part += 1
+            path = _part_path(self.path, self.format, part)
+        return path
+
+    def __contains__(self, post_):
+        """
+        Find whether a post's file was archived by a previous run.
+
+        :param post_: The post.
+        :return: True if the file is in the manifest with the same checksum.
+        """
+        entry = self._archived.get(post_.file.id)
+        return entry is not None and entry[0] == post_.file.md5
+
+    def save(self, post_, name, session=None):
+        """
+        Download a post's file and queue it to be added to the archive. This
+        is the counterpart of `File.save_to()`.
+
+        :param post_: The post whose file to download.
+        :param name: The name of the file within the archive.
+        :param session: The transport to use for the download.
+        :return: True if the file was skipped because it was already archived;
+                 False if it was downloaded successfully.
+        :raise IOError: If the file could not be downloaded, its checksum did
+                        not match the one reported by 4chan, or the writer has
+                        failed.
+        """
+        if post_ in self:
+            logger.debug('%s already archived; skipping download', post_.file)
+            return True
+
+        handle = tempfile.SpooledTemporaryFile(_SPOOL_SIZE)
+        try:
+            md5 = post_.file.fetch(handle, session)
+            if md5 != post_.file.md5:
+                raise IOError('Verify failed: checksum mismatch')
+            self._put((post_, name, handle))
+        except BaseException:
+            handle.close()
+            raise
+
+        return False
+
+    def _put(self, item):
+        """
+        Hand an item to the writer thread.
+
+        :param item: A (post, name, handle) tuple.
+        :raise IOError: If the writer has failed.
+        """
+        while True:
+            if self._error:
+                raise IOError('Archive writer failed: {0}'.format(self._error))
+            try:
+                self._queue.put(item, timeout=.5)
+                return
+            except queue.Full:
+                continue
+
+    def _write_all(self):
+        """
+        Add queued files to the archive until `close()` is called. Runs on
+        the writer thread.
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if item is not None and not self._error:
+                    self._write(*item)
+                # the files written so far are recorded once the writer runs
+                # out of them, has written a batch, or is closing
+                if not self._error and (
+                        item is None or self._queue.empty() or
+                        len(self._pending) >= _COMMIT_BATCH):
+                    self._commit()
+            except (IOError, OSError, tarfile.TarError,
+                    zipfile.BadZipfile) as e:
+                logger.error('Failed to write to %s: %s', self.path, e)
+                self._error = e
+            finally:
+                if item is not None:
+                    item[2].close()
+            if item is None:
+                return
+
+    def _write(self, post_, name, handle):
+        """
+        Add a single file to the archive, holding its manifest entry until
+        the archive is next flushed.
+
+        :param post_: The post the file belongs to.
+        :param name: The file's name within the archive.
+        :param handle: A file object containing the file, at its end.
+        """
+        if not self._zip and not self._tar:
+            self._open()
+
+        size = handle.tell()
+        handle.seek(0)
+        mtime = calendar.timegm(post_.timestamp.utctimetuple())
+
+        if self._zip:
+            info = zipfile.ZipInfo(name, post_.timestamp.utctimetuple()[:6])
+            info.external_attr = 0o644 << 16
+            if _ZIP_STREAMING:
+                with self._zip.open(
+                        info, 'w',
+                        force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+                    shutil.copyfileobj(handle, member, _COPY_SIZE)
+            else:
+                self._zip.writestr(info, handle.read())
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = mtime
+            info.mode = 0o644
+            self._tar.addfile(info, handle)
+
+        self._pending.append({
+            'board': post_.board,
+            'post': post_.id,
+            'file': post_.file.id,
+            'name': name,
+            'md5': post_.file.md5,
+            'size': size,
+            'archive': os.path.basename(self._write_path)
+        })
+
+    def _flush(self):
+        """
+        Write everything added to the archive so far to disk.
+        """
+        if self._zip:
+            handle = self._zip.fp
+        elif self._stream:
+            self._stream.flush(zstandard.FLUSH_BLOCK)
+            handle = self._stream
+        else:
+            # for tar.gz, a `GzipFile`, which flushes its compressor too
+            handle = self._tar.fileobj
+        handle.flush()
+        os.fsync(handle.fileno())
+
+    def _commit(self):
+        """
+        Flush the archive to disk, then record the files added since it was
+        last flushed in the manifest.
+        """
+        if not self._pending:
+            return
+        self._flush()
+        for entry in self._pending:
+            if self.format == FORMAT_TAR:
+                # where to cut the archive back to if a later file is lost
+                entry['end'] = self._tar.offset
+            self._manifest.write(json.dumps(entry) + '\n')
+        self._manifest.flush()
+        self._pending = []
+
+    def close(self):
+        """
+        Wait for queued files to be written, then close the archive and its
+        manifest.
+
+        :raise IOError: If the writer failed to add a file.
+        """
+        self._queue.put(None)
+        self._writer.join()
+        try:
+            if self._zip:
+                self._zip.close()
+            if self._tar:
+                self._tar.close()
+            if self._stream:
+                self._stream.close()
+        finally:
+            self._manifest.close()
+
+        if self._error:
+            raise IOError('Archive writer failed: {0}'.format(self._error))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for chandl, run against a local stand-in for 4chan's API and CDN
+rather than the real site. Invoke with `python -m chandl.benchmarks -h`.
+"""
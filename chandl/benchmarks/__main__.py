@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function
+import sys
+import argparse
+import json
+
+from chandl.benchmarks import e2e, hashing, parse, results, synthetic
+
+
+def _parse_args(args):
+    """
+    Interpret command line arguments.
+
+    :param args: `sys.argv`
+    :return: The populated argparse namespace.
+    """
+    parser = argparse.ArgumentParser(prog='python -m chandl.benchmarks',
+                                     description='Benchmark chandl against a '
+                                                 'local stand-in for 4chan.')
+    parser.add_argument('-o', '--output',
+                        help='write results as JSON to this file')
+    parser.add_argument('-c', '--compare',
+                        help='a results file from a previous run to compare '
+                             'against')
+    parser.add_argument('-r', '--repeat',
+                        help='the number of times to run each benchmark; '
+                             'defaults to 3',
+                        type=int,
+                        default=3)
+    subparsers = parser.add_subparsers(dest='suite')
+    subparsers.required = True
+
+    e2e_parser = subparsers.add_parser('e2e',
+                                       help='fetch, parse and download a '
+                                            'thread end to end')
+    e2e_parser.add_argument('-s', '--scenario',
+                            help='the scenarios to run; defaults to all',
+                            action='append',
+                            choices=e2e.SCENARIOS)
+    e2e_parser.add_argument('--posts',
+                            help='the number of posts (and files) in the '
+                                 'thread',
+                            type=int,
+                            default=100)
+    e2e_parser.add_argument('--file-size',
+                            help='the size of each file in bytes',
+                            type=int,
+                            default=64 * 1024)
+    e2e_parser.add_argument('--latency',
+                            help='seconds the server waits before each '
+                                 'response',
+                            type=float,
+                            default=0.0)
+    e2e_parser.add_argument('--bandwidth',
+                            help='the maximum bytes per second of each '
+                                 'response; 0 is unlimited',
+                            type=int,
+                            default=0)
+    e2e_parser.add_argument('--failure-rate',
+                            help='the fraction of files that fail with a 503',
+                            type=float,
+                            default=0.0)
+    e2e_parser.add_argument('--corrupt-rate',
+                            help='the fraction of files served with a bad '
+                                 'checksum',
+                            type=float,
+                            default=0.0)
+    e2e_parser.add_argument('--seed',
+                            help='selects which files fail or are corrupt',
+                            type=int,
+                            default=0)
+    e2e_parser.add_argument('-p', '--parallelism',
+                            help='download threads per core',
+                            type=int,
+                            default=2)
+
+    parse_parser = subparsers.add_parser('parse',
+                                         help='micro-benchmark parsing of '
+                                              'thread JSON')
+    parse_parser.add_argument('-b', '--benchmark',
+                              help='the benchmarks to run; defaults to all',
+                              action='append',
+                              choices=list(parse.BENCHMARKS))
+    parse_parser.add_argument('--posts',
+                              help='the number of posts in the thread',
+                              type=int,
+                              default=1000)
+    parse_parser.add_argument('--seed',
+                              help='seeds the thread generator',
+                              type=int,
+                              default=0)
+
+    hash_parser = subparsers.add_parser('hash',
+                                        help='micro-benchmark hashing of '
+                                             'files on disk')
+    hash_parser.add_argument('-b', '--benchmark',
+                             help='the benchmarks to run; defaults to all',
+                             action='append',
+                             choices=list(hashing.BENCHMARKS))
+    hash_parser.add_argument('--files',
+                             help='the number of files to hash',
+                             type=int,
+                             default=4)
+    hash_parser.add_argument('--file-size',
+                             help='the size of each file in bytes',
+                             type=int,
+                             default=64 * 1024 * 1024)
+
+    generate_parser = subparsers.add_parser('generate',
+                                            help='write synthetic thread or '
+                                                 'catalog JSON to a file')
+    generate_parser.add_argument('kind',
+                                 choices=['thread', 'catalog'])
+    generate_parser.add_argument('path',
+                                 help='the file to write')
+    generate_parser.add_argument('-n', '--count',
+                                 help='the number of posts in a thread, or '
+                                      'threads in a catalog',
+                                 type=int,
+                                 default=1000)
+    generate_parser.add_argument('--seed',
+                                 help='seeds the generator',
+                                 type=int,
+                                 default=0)
+
+    return parser.parse_args(args[1:])
+
+
+def _run_e2e(args):
+    """
+    Run the end-to-end suite.
+
+    :param args: The parsed arguments.
+    :return: A list of result dictionaries.
+    """
+    params = {
+        'posts': args.posts,
+        'file_size': args.file_size,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'failure_rate': args.failure_rate,
+        'corrupt_rate': args.corrupt_rate,
+        'seed': args.seed
+    }
+    return [e2e.run(scenario, params, args.parallelism, args.repeat)
+            for scenario in args.scenario or e2e.SCENARIOS]
+
+
+def _run_parse(args):
+    """
+    Run the parsing micro-benchmarks.
+
+    :param args: The parsed arguments.
+    :return: A list of result dictionaries.
+    """
+    return parse.run_all(args.posts, args.seed, args.benchmark, args.repeat)
+
+
+def _run_hash(args):
+    """
+    Run the hashing micro-benchmarks.
+
+    :param args: The parsed arguments.
+    :return: A list of result dictionaries.
+    """
+    return hashing.run_all(args.files, args.file_size, args.benchmark,
+                           args.repeat)
+
+
+def _generate(args):
+    """
+    Write synthetic JSON to a file.
+
+    :param args: The parsed arguments.
+    """
+    if args.kind == 'thread':
+        synthetic.write_file(args.path, synthetic.write_thread, args.count,
+                             args.seed)
+    else:
+        synthetic.write_file(
+            args.path,
+            lambda handle: json.dump(
+                synthetic.catalog_json(args.count, args.seed), handle))
+
+
+# suite -> (runner, metrics to display and compare)
+_SUITES = {
+    'e2e': (_run_e2e, e2e.METRICS),
+    'parse': (_run_parse, parse.METRICS),
+    'hash': (_run_hash, hashing.METRICS)
+}
+
+
+def main(args):
+    """
+    The benchmark runner's entry point.
+
+    :param args: Command-line arguments, with the program in position 0.
+    :return: The exit status.
+    """
+    args = _parse_args(args)
+    if args.suite == 'generate':
+        _generate(args)
+        return 0
+
+    runner, metrics = _SUITES[args.suite]
+    document = results.document(runner(args))
+
+    print(results.format_table(
+        [('benchmark',) + metrics] +
+        [(result['name'],) + tuple(result[metric] for metric in metrics)
+         for result in document['results']]))
+
+    if args.output:
+        results.save(args.output, document)
+
+    if args.compare:
+        print()
+        print(results.format_comparison(
+            results.compare(results.load(args.compare), document, metrics)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmarks of the download path: fetching and parsing a thread,
+downloading its files, and the command-line entry point as a whole.
+"""
+from __future__ import unicode_literals, division
+
+import contextlib
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from six.moves import queue
+
+from chandl import __main__ as main_
+from chandl.benchmarks import results
+from chandl.benchmarks.server import FakeChan
+from chandl.downloader import Downloader
+from chandl.model import file, thread
+from chandl.model.thread import Thread
+
+
+SCENARIOS = ('from_url', 'downloader', 'main', 'main_stream', 'main_replay')
+
+# the metrics reported by this suite
+METRICS = ('wall', 'items_per_sec', 'bytes_per_sec', 'peak_rss')
+
+# the name format used when saving files; the same as the CLI's default
+_NAME_FMT = '{file.id} - {file.name}.{file.extension}'
+
+
+@contextlib.contextmanager
+def _silenced():
+    """
+    Discard anything written to stdout for the duration of the context, e.g.
+    the CLI's progress output.
+    """
+    original = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = original
+
+
+def _directory_size(directory):
+    """
+    Count the files and bytes beneath a directory.
+
+    :param directory: The directory to walk.
+    :return: A (files, bytes) tuple.
+    """
+    files, bytes_ = 0, 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            files += 1
+            bytes_ += os.path.getsize(os.path.join(root, name))
+    return files, bytes_
+
+
+def _scenario(scenario, root, thread_url, parallelism):
+    """
+    Run a single scenario once and report what happened.
+
+    :param scenario: The name of the scenario to run, from `SCENARIOS`.
+    :param root: The base URL of the fake 4chan server.
+    :param thread_url: The URL of the thread to fetch.
+    :param parallelism: Download threads per core.
+    :return: The measurement dictionary.
+    """
+    thread.API_ROOT = file.MEDIA_ROOT = root
+    directory = tempfile.mkdtemp(prefix='chandl-bench-')
+    try:
+        if scenario == 'from_url':
+            start = time.time()
+            items = len(Thread.from_url(thread_url).posts)
+            wall = time.time() - start
+            bytes_, failed = None, 0
+        elif scenario == 'downloader':
+            posts = Thread.from_url(thread_url).posts
+            downloader = Downloader(directory, _NAME_FMT, parallelism)
+            start = time.time()
+            outcome = downloader.download(posts)
+            wall = time.time() - start
+            items = outcome.downloaded_job_count
+            bytes_ = outcome.downloaded_bytes
+            failed = outcome.failed_job_count
+        elif scenario in ('main', 'main_stream', 'main_replay'):
+            output = os.path.join(directory, 'output')
+            os.mkdir(output)
+            options = ['-t', 'thread', '-p', str(parallelism)]
+            if scenario == 'main_stream':
+                options.append('--stream')
+            elif scenario == 'main_replay':
+                # record the run first, untimed, so the timed run measures
+                # chandl without the network
+                cassette = os.path.join(directory, 'cassette')
+                recorded = os.path.join(directory, 'recorded')
+                os.mkdir(recorded)
+                with _silenced():
+                    main_.main(['chandl', '-o', recorded,
+                                '--transport', 'record', '--cassette',
+                                cassette] + options + [thread_url])
+                options += ['--transport', 'replay', '--cassette', cassette]
+            start = time.time()
+            with _silenced():
+                status = main_.main(['chandl', '-o', output] + options +
+                                    [thread_url])
+            wall = time.time() - start
+            if status != 0:
+                raise RuntimeError('chandl exited with {0}'.format(status))
+            items, bytes_ = _directory_size(output)
+            failed = None
+        else:
+            raise ValueError('Unknown scenario: {0}'.format(scenario))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'wall': wall,
+        'items': items,
+        'bytes': bytes_,
+        'failed': failed,
+        'peak_rss': results.peak_rss()
+    }
+
+
+def _measure(scenario, root, thread_url, parallelism, output):
+    """
+    Run a scenario and pass back the outcome. Intended to be the only thing a
+    fresh process does, so the peak RSS belongs to the scenario.
+
+    :param scenario: The name of the scenario to run, from `SCENARIOS`.
+    :param root: The base URL of the fake 4chan server.
+    :param thread_url: The URL of the thread to fetch.
+    :param parallelism: Download threads per core.
+    :param output: A queue to put the measurement dictionary on, or the error
+                   message if the scenario failed.
+    """
+    # injected failures are expected; don't fill the terminal with them
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    try:
+        output.put(_scenario(scenario, root, thread_url, parallelism))
+    except Exception as e:  # pylint: disable=broad-except
+        output.put('{0}: {1}'.format(type(e).__name__, e))
+
+
+def _isolated(*args):
+    """
+    Run `_measure()` in a freshly spawned interpreter, falling back to the
+    current process where spawning is unavailable (Python 2).
+
+    :param args: The arguments to `_measure()`, excluding the output queue.
+    :return: The measurement dictionary.
+    :raises RuntimeError: If the scenario failed.
+    """
+    try:
+        context = multiprocessing.get_context('spawn')
+    except AttributeError:
+        output = queue.Queue()
+        _measure(*(args + (output,)))
+        measurement = output.get()
+    else:
+        output = context.Queue()
+        process = context.Process(target=_measure, args=args + (output,))
+        process.start()
+        measurement = output.get()
+        process.join()
+
+    if not isinstance(measurement, dict):
+        raise RuntimeError('Benchmark failed: {0}'.format(measurement))
+    return measurement
+
+
+def run(scenario, params, parallelism=2, repeat=3):
+    """
+    Benchmark a scenario against a fake 4chan.
+
+    :param scenario: The name of the scenario to run, from `SCENARIOS`.
+    :param params: Keyword arguments for `FakeChan`.
+    :param parallelism: Download threads per core.
+    :param repeat: The number of times to run the scenario; the median wall
+                   time is reported.
+    :return: The result dictionary.
+    """
+    measurements = []
+    with FakeChan(**params) as fake:
+        for _ in range(repeat):
+            measurements.append(_isolated(scenario, fake.root,
+                                          fake.thread_url, parallelism))
+        requests_, failures = fake.requests, fake.failures
+
+    wall = results.median([m['wall'] for m in measurements])
+    first = measurements[0]
+    rss = [m['peak_rss'] for m in measurements if m['peak_rss'] is not None]
+    result_params = dict(params)
+    result_params['parallelism'] = parallelism
+    return {
+        'name': 'e2e.' + scenario,
+        'params': result_params,
+        'repeat': repeat,
+        'wall': wall,
+        'wall_min': min(m['wall'] for m in measurements),
+        'items': first['items'],
+        'items_per_sec': first['items'] / wall if wall else None,
+        'bytes_per_sec': first['bytes'] / wall
+        if wall and first['bytes'] is not None else None,
+        'failed': first['failed'],
+        'peak_rss': max(rss) if rss else None,
+        'server_requests': requests_,
+        'server_failures': failures
+    }
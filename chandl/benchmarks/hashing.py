@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of hashing files the size of those on 4chan and larger, as
+done to skip files that already exist and to verify downloads.
+"""
+from __future__ import unicode_literals, division
+
+import collections
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from chandl import util
+
+
+# the metrics reported by this suite
+METRICS = ('wall', 'bytes_per_sec')
+
+# the size of the chunks files are written in
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _baseline(path):
+    # how `util.md5_file` used to hash files, for comparison
+    hash_ = hashlib.md5()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(4096), b''):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def _strategy(function):
+    """
+    Make a function hashing whole files with one of `util.md5_file`'s
+    strategies, whatever their size.
+
+    :param function: `util._md5_read` or `util._md5_mapped`.
+    :return: A function taking a path and returning its checksum.
+    """
+    def md5_file(path):
+        hash_ = hashlib.md5()
+        with io.open(path, 'rb') as handle:
+            function(hash_, handle, 0, os.fstat(handle.fileno()).st_size)
+        return hash_.hexdigest()
+    return md5_file
+
+
+def _threaded(function):
+    """
+    Make a function hashing many files at once, one per thread, as download
+    threads do. This only scales if hashing releases the GIL.
+
+    :param function: A function taking a path and returning its checksum.
+    :return: A function taking a list of paths.
+    """
+    def md5_files(paths):
+        threads = [threading.Thread(target=function, args=(path,))
+                   for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return md5_files
+
+
+# name -> (function to benchmark, whether it takes all files in a single call)
+BENCHMARKS = collections.OrderedDict([
+    ('baseline', (_baseline, False)),
+    ('md5_file', (util.md5_file, False)),
+    ('md5_file.read', (
+        _strategy(util._md5_read),  # pylint: disable=protected-access
+        False)),
+    ('md5_file.mmap', (
+        _strategy(util._md5_mapped),  # pylint: disable=protected-access
+        False)),
+    ('baseline.threads', (_threaded(_baseline), True)),
+    ('md5_file.threads', (_threaded(util.md5_file), True))
+])
+
+
+def write_files(directory, count, size):
+    """
+    Write files of random bytes to hash.
+
+    :param directory: The directory to write them in.
+    :param count: The number of files.
+    :param size: The size of each file in bytes.
+    :return: The paths of the files.
+    """
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, '{0}.bin'.format(i))
+        with open(path, 'wb') as handle:
+            remaining = size
+            while remaining:
+                chunk = os.urandom(min(remaining, _CHUNK_SIZE))
+                handle.write(chunk)
+                remaining -= len(chunk)
+        paths.append(path)
+    return paths
+
+
+def run(name, paths, params, repeat=3):
+    """
+    Run a hashing benchmark. The first pass also brings the files into the
+    page cache, so the fastest pass measures hashing rather than the disk.
+
+    :param name: The benchmark to run, a key of `BENCHMARKS`.
+    :param paths: The files to hash.
+    :param params: The parameters the files were written with, recorded in
+                   the result.
+    :param repeat: The number of timed passes; the fastest is reported.
+    :return: The result dictionary.
+    """
+    function, whole = BENCHMARKS[name]
+    inputs = [paths] if whole else paths
+    size = sum(os.path.getsize(path) for path in paths)
+
+    wall = None
+    for _ in range(repeat):
+        start = time.time()
+        for input_ in inputs:
+            function(input_)
+        elapsed = time.time() - start
+        wall = elapsed if wall is None else min(wall, elapsed)
+
+    return {
+        'name': 'hash.' + name,
+        'params': params,
+        'repeat': repeat,
+        'wall': wall,
+        'bytes': size,
+        'bytes_per_sec': size / wall if wall else None
+    }
+
+
+def run_all(count, size, names=None, repeat=3):
+    """
+    Write temporary files and run hashing benchmarks over them.
+
+    :param count: The number of files.
+    :param size: The size of each file in bytes.
+    :param names: The benchmarks to run; defaults to all of them.
+    :param repeat: The number of timed passes of each benchmark.
+    :return: A list of result dictionaries.
+    """
+    directory = tempfile.mkdtemp(prefix='chandl-hash-')
+    try:
+        paths = write_files(directory, count, size)
+        params = {'files': count, 'file_size': size}
+        return [run(name, paths, params, repeat)
+                for name in names or BENCHMARKS]
+    finally:
+        shutil.rmtree(directory)
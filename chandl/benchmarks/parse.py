@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of the functions that turn 4chan's JSON into model objects,
+run over a synthetic thread.
+"""
+from __future__ import unicode_literals, division
+
+import collections
+import gc
+import time
+
+from chandl import util
+from chandl.benchmarks import synthetic
+from chandl.model import file, post as post_
+from chandl.model.file import File
+from chandl.model.post import Post
+from chandl.model.thread import Thread
+
+try:
+    import tracemalloc
+except ImportError:  # 2.7
+    tracemalloc = None
+
+
+# the metrics reported by this suite
+METRICS = ('wall', 'items_per_sec', 'blocks_per_item', 'peak_bytes_per_item')
+
+_BOARD = 'wg'
+
+
+def _find_subject_inputs(posts):
+    # first posts without a subject, forcing the bleach fallback
+    return [{'no': post['no'], 'com': post['com']}
+            for post in posts if 'com' in post]
+
+
+def _lazy_filter(posts):
+    # what the CLI does with `--filter webm`
+    thread = Thread.parse_json(_BOARD, {'posts': posts}, lazy=True)
+    return list(thread.posts.filter(
+        lambda json: json.get('ext') == '.webm'))
+
+
+# name -> (function to benchmark, function selecting its inputs from posts)
+BENCHMARKS = collections.OrderedDict([
+    ('util.unescape_html', (
+        util.unescape_html,
+        lambda posts: [post['com'] for post in posts if 'com' in post])),
+    ('post.timestamp', (
+        post_._utc_datetime,  # pylint: disable=protected-access
+        lambda posts: [post['time'] for post in posts])),
+    ('file.unpack_hashes', (
+        file.unpack_hashes,
+        lambda posts: [[post['md5'] for post in posts if 'tim' in post]])),
+    ('file.parse_json', (
+        lambda post: File.parse_json(_BOARD, post),
+        lambda posts: [post for post in posts if 'tim' in post])),
+    ('post.parse_json', (
+        lambda post: Post.parse_json(_BOARD, post),
+        lambda posts: posts)),
+    ('post.parse_json_all', (
+        lambda posts: Post.parse_json_all(_BOARD, posts),
+        lambda posts: [posts])),
+    ('thread.find_subject', (
+        Thread._find_subject,  # pylint: disable=protected-access
+        _find_subject_inputs)),
+    ('thread.parse_json', (
+        lambda posts: Thread.parse_json(_BOARD, {'posts': posts}),
+        lambda posts: [posts])),
+    ('thread.lazy_filter', (
+        _lazy_filter,
+        lambda posts: [posts]))
+])
+
+# benchmarks taking the whole thread in a single call; rates are per post
+_WHOLE_THREAD = {'file.unpack_hashes', 'post.parse_json_all',
+                 'thread.parse_json', 'thread.lazy_filter'}
+
+
+def _time(function, inputs, repeat):
+    """
+    Find the fastest time to apply a function to every input.
+
+    :param function: The function to benchmark.
+    :param inputs: The list of arguments, one per call.
+    :param repeat: The number of passes to make.
+    :return: The duration of the fastest pass in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        for input_ in inputs:
+            function(input_)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _allocations(function, inputs):
+    """
+    Measure the memory allocated by applying a function to every input. The
+    outputs are kept alive until the end, so objects built by the function are
+    counted.
+
+    :param function: The function to benchmark.
+    :param inputs: The list of arguments, one per call.
+    :return: A (blocks, peak bytes) tuple, or (None, None) if tracemalloc is
+             unavailable.
+    """
+    if tracemalloc is None:
+        return None, None
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        outputs = [function(input_) for input_ in inputs]
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del outputs
+
+    blocks = sum(stat.count_diff
+                 for stat in after.compare_to(before, 'filename'))
+    return blocks, peak
+
+
+def run(name, posts, params, repeat=3):
+    """
+    Run a parse benchmark.
+
+    :param name: The benchmark to run, a key of `BENCHMARKS`.
+    :param posts: The post dictionaries of the synthetic thread.
+    :param params: The parameters the thread was generated with, recorded in
+                   the result.
+    :param repeat: The number of timed passes; the fastest is reported.
+    :return: The result dictionary.
+    """
+    function, select = BENCHMARKS[name]
+    inputs = select(posts)
+    items = len(posts) if name in _WHOLE_THREAD else len(inputs)
+
+    wall = _time(function, inputs, repeat)
+    blocks, peak = _allocations(function, inputs)
+    return {
+        'name': 'parse.' + name,
+        'params': params,
+        'repeat': repeat,
+        'wall': wall,
+        'items': items,
+        'items_per_sec': items / wall if wall else None,
+        'blocks_per_item': blocks / items
+        if blocks is not None and items else None,
+        'peak_bytes_per_item': peak / items
+        if peak is not None and items else None
+    }
+
+
+def run_all(count, seed=0, names=None, repeat=3):
+    """
+    Generate a synthetic thread and run parse benchmarks over it.
+
+    :param count: The number of posts in the thread.
+    :param seed: Seeds the thread generator.
+    :param names: The benchmarks to run; defaults to all of them.
+    :param repeat: The number of timed passes of each benchmark.
+    :return: A list of result dictionaries.
+    """
+    posts = synthetic.realistic_thread_json(count, seed)['posts']
+    params = {'posts': count, 'seed': seed}
+    return [run(name, posts, params, repeat) for name in names or BENCHMARKS]
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division
+
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+
+import chandl
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    Get the peak resident set size of the current process.
+
+    :return: The high-water mark in bytes, or None if the platform does not
+             report it.
+    """
+    if resource is None:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def _git(*args):
+    """
+    Run a git command in the directory containing chandl.
+
+    :param args: The arguments to pass to git.
+    :return: The stripped output, or None if git failed or is unavailable.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(
+                ('git',) + args,
+                cwd=os.path.dirname(os.path.abspath(chandl.__file__)),
+                stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8').strip()
+
+
+def environment():
+    """
+    Describe the code and machine a set of results was produced by, so that
+    results from different commits can be told apart and fairly compared.
+
+    :return: A dictionary of environment details.
+    """
+    status = _git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'chandl': chandl.__version__,
+        'commit': _git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
+    }
+
+
+def median(values):
+    """
+    Find the median of a non-empty list of numbers.
+
+    :param values: The numbers.
+    :return: The median value.
+    """
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def save(path, document):
+    """
+    Write a results document to disk as JSON.
+
+    :param path: The file to write.
+    :param document: The results, as returned by `document()`.
+    """
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(document, indent=2, sort_keys=True))
+
+
+def load(path):
+    """
+    Read a results document previously written by `save()`.
+
+    :param path: The file to read.
+    :return: The results document.
+    """
+    with io.open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def document(results):
+    """
+    Wrap a list of benchmark results with details of the environment.
+
+    :param results: A list of result dictionaries, each with at least `name`
+                    and `params` keys.
+    :return: The results document.
+    """
+    return {
+        'environment': environment(),
+        'results': results
+    }
+
+
+def _key(result):
+    """
+    Identify a result so it can be matched to the same benchmark in another
+    run.
+
+    :param result: The result dictionary.
+    :return: A hashable key.
+    """
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(baseline, current, metrics):
+    """
+    Compare two results documents.
+
+    :param baseline: The document to compare against, e.g. from the previous
+                     commit.
+    :param current: The document from this run.
+    :param metrics: The metric names to compare.
+    :return: A list of (name, metric, baseline, current, change) tuples, where
+             change is the relative difference, or None if the baseline value
+             was zero or missing.
+    """
+    previous = dict((_key(result), result) for result in baseline['results'])
+    rows = []
+    for result in current['results']:
+        old = previous.get(_key(result))
+        if old is None:
+            continue
+        for metric in metrics:
+            before, after = old.get(metric), result.get(metric)
+            if after is None:
+                continue
+            change = (after - before) / before if before else None
+            rows.append((result['name'], metric, before, after, change))
+    return rows
+
+
+def format_table(rows):
+    """
+    Lay out rows of values as a fixed-width table.
+
+    :param rows: A list of tuples; the first is treated as the header.
+    :return: The table as a string.
+    """
+    cells = [['{0:.4g}'.format(value) if isinstance(value, float)
+              else '-' if value is None else '{0}'.format(value)
+              for value in row]
+             for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(cells[0]))]
+    return os.linesep.join(
+        '  '.join(cell.ljust(width) for cell, width in zip(row, widths))
+        .rstrip()
+        for row in cells)
+
+
+def format_comparison(rows):
+    """
+    Render the output of `compare()` for humans.
+
+    :param rows: The comparison rows.
+    :return: The comparison as a table.
+    """
+    return format_table(
+        [('benchmark', 'metric', 'baseline', 'current', 'change')] +
+        [(name, metric, before, after,
+          '{0:+.1%}'.format(change) if change is not None else None)
+         for name, metric, before, after, change in rows])
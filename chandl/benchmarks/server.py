@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import contextlib
+import json
+import random
+import re
+import threading
+import time
+from six.moves import BaseHTTPServer, socketserver
+
+from chandl.benchmarks import synthetic
+from chandl.model import file, thread
+
+
+# the size of the pieces a throttled response is written in, as a fraction of
+# the bandwidth limit; 20 gives a smooth transfer without too many wakeups
+_THROTTLE_SLICES = 20
+
+# the size of served thumbnails; 4chan's are typically a few kilobytes
+_THUMBNAIL_SIZE = 8 * 1024
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server handling each connection on its own thread.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves requests on behalf of a `FakeChan`.
+    """
+
+    # keep-alive, so clients can reuse connections as they would with 4chan
+    protocol_version = 'HTTP/1.1'
+
+    _THREAD_PATH = re.compile(r'^/([a-z]+)/thread/([0-9]+)\.json$')
+    _MEDIA_PATH = re.compile(r'^/([a-z]+)/([0-9]+)(s?)\.[a-z0-9]+$')
+
+    # noinspection PyPep8Naming
+    def do_GET(self):
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        match = self._THREAD_PATH.match(self.path)
+        if match and match.group(1) == fake.board and \
+                int(match.group(2)) == fake.thread_no:
+            self._send(200, fake.thread_body, 'application/json')
+            return
+
+        match = self._MEDIA_PATH.match(self.path)
+        if match and match.group(1) == fake.board:
+            tim = int(match.group(2))
+            if tim in fake.failing:
+                fake.record(0, failed=True)
+                self._send(503, b'', 'text/plain')
+                return
+            content = fake.thumbnail(tim) if match.group(3) else \
+                fake.content(tim)
+            if content is not None:
+                fake.record(len(content))
+                self._send(200, content, 'image/jpeg')
+                return
+
+        self._send(404, b'', 'text/plain')
+
+    def _send(self, status, body, content_type):
+        """
+        Write a complete response, honouring any bandwidth limit.
+
+        :param status: The HTTP status code.
+        :param body: The response body as a bytestring.
+        :param content_type: The value of the Content-Type header.
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        bandwidth = self.server.fake.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+
+        step = max(1, bandwidth // _THROTTLE_SLICES)
+        for offset in range(0, len(body), step):
+            self.wfile.write(body[offset:offset + step])
+            time.sleep(float(step) / bandwidth)
+
+    def log_message(self, format_, *args):
+        # keep benchmark output clean
+        pass
+
+
+class FakeChan:
+    """
+    A local HTTP server impersonating 4chan's API and CDN for a single
+    synthetic thread. While `patched()` is active, `Thread.from_url()` and
+    `File.url` point at this server instead of the real site.
+    """
+
+    def __init__(self, board='wg', posts=100, file_size=64 * 1024, latency=0.0,
+                 bandwidth=0, failure_rate=0.0, corrupt_rate=0.0, seed=0,
+                 thread_json=None):
+        """
+        Initialise a new fake 4chan.
+
+        :param board: The board the thread lives on.
+        :param posts: The number of posts in the thread, each with a file.
+        :param file_size: The size of each file in bytes.
+        :param latency: Seconds to wait before answering each request.
+        :param bandwidth: The maximum bytes per second of each response, or 0
+                          for unlimited.
+        :param failure_rate: The fraction of files that always respond with a
+                             503.
+        :param corrupt_rate: The fraction of files whose content does not
+                             match their advertised checksum.
+        :param seed: Determines which files fail or are corrupt, so runs are
+                     repeatable.
+        :param thread_json: A pre-generated thread to serve, overriding
+                            `posts`. Its files must come from the same media
+                            source, i.e. share `file_size`.
+        """
+        self.board = board
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.media = synthetic.Media(file_size)
+
+        if thread_json is None:
+            thread_json = synthetic.thread_json(posts, self.media)
+        self.thread_no = thread_json['posts'][0]['no']
+        self.thread_body = json.dumps(thread_json).encode('utf-8')
+        self._tims = set(post['tim'] for post in thread_json['posts']
+                         if 'tim' in post)
+
+        rng = random.Random(seed)
+        ordered = sorted(self._tims)
+        self.failing = set(rng.sample(ordered,
+                                      int(len(ordered) * failure_rate)))
+        healthy = [tim for tim in ordered if tim not in self.failing]
+        self.corrupt = set(rng.sample(healthy,
+                                      int(len(ordered) * corrupt_rate)))
+
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.failures = 0
+
+        self._server = None
+        self._thread = None
+
+    @property
+    def root(self):
+        """
+        Get the base URL of this server.
+
+        :return: The URL, without a trailing slash.
+        """
+        host, port = self._server.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    @property
+    def thread_url(self):
+        """
+        Get the URL of the served thread, as a user would pass it to chandl.
+
+        :return: The thread URL.
+        """
+        return 'https://boards.4chan.org/{0}/thread/{1}'.format(
+            self.board, self.thread_no)
+
+    def content(self, tim):
+        """
+        Get the bytes served for a file.
+
+        :param tim: The file's id.
+        :return: The file's contents, or None if there is no such file.
+        """
+        if tim not in self._tims:
+            return None
+        content = self.media.content(tim)
+        if tim in self.corrupt:
+            # flip the final byte so the checksum no longer matches
+            last = bytearray(content[-1:])
+            last[0] ^= 1
+            content = content[:-1] + bytes(last)
+        return content
+
+    def thumbnail(self, tim):
+        """
+        Get the bytes served for a file's thumbnail.
+
+        :param tim: The file's id.
+        :return: The thumbnail's contents, or None if there is no such file.
+        """
+        if tim not in self._tims:
+            return None
+        return self.media.content(tim)[:_THUMBNAIL_SIZE]
+
+    def record(self, size, failed=False):
+        """
+        Update request statistics; called by the handler.
+
+        :param size: The number of bytes sent.
+        :param failed: Whether a failure was injected.
+        """
+        with self._stats_lock:
+            self.requests += 1
+            self.bytes_sent += size
+            if failed:
+                self.failures += 1
+
+    def start(self):
+        """
+        Start serving on an ephemeral port on the loopback interface.
+        """
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving and release the port.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    @contextlib.contextmanager
+    def patched(self):
+        """
+        Redirect chandl's API and media requests to this server for the
+        duration of the context.
+        """
+        api_root, media_root = thread.API_ROOT, file.MEDIA_ROOT
+        thread.API_ROOT = file.MEDIA_ROOT = self.root
+        try:
+            yield self
+        finally:
+            thread.API_ROOT, file.MEDIA_ROOT = api_root, media_root
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
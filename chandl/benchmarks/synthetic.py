@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+
+
+# the first file id handed out; a realistic 13-digit millisecond timestamp
+_FIRST_TIM = 1486016715106
+
+# the first post number handed out
+_FIRST_NO = 6840627
+
+# how often each extension appears among files on a typical image board
+_EXTENSIONS = [('.jpg', 0.55), ('.png', 0.3), ('.gif', 0.05), ('.webm', 0.1)]
+
+# the building blocks of comments, in 4chan's escaped HTML form
+_WORDS = ['the', 'thread', 'anon', 'wallpaper', 'source', 'please', 'this',
+          'is', 'a', 'great', 'one', 'resolution', 'more', 'of', 'these',
+          'thanks', 'dump', 'bump', 'nice', 'where', 'can', 'I', 'find']
+_ENTITIES = ['&#039;', '&quot;', '&amp;', '&gt;', '&lt;', '&pound;']
+
+# threads per catalog page, as served by 4chan
+_CATALOG_PAGE_SIZE = 15
+
+
+class Media:
+    """
+    Deterministic file contents for a synthetic thread. Every file shares the
+    same filler body followed by a unique 8-byte suffix, so files have distinct
+    checksums without having to hash each one from scratch.
+    """
+
+    def __init__(self, size):
+        """
+        Initialise a new media source.
+
+        :param size: The size of each file in bytes; at least 8.
+        :raises ValueError: If size is too small to hold the unique suffix.
+        """
+        if size < 8:
+            raise ValueError('Files must be at least 8 bytes')
+
+        self.size = size
+        self.body = (b'chandl' * (size // 6 + 1))[:size - 8]
+        self._body_hash = hashlib.md5(self.body)
+
+    @staticmethod
+    def suffix(tim):
+        """
+        Get the bytes that make a file unique.
+
+        :param tim: The file's id.
+        :return: The final 8 bytes of the file.
+        """
+        return struct.pack('>Q', tim)
+
+    def content(self, tim):
+        """
+        Get the complete contents of a file.
+
+        :param tim: The file's id.
+        :return: The file as a bytestring.
+        """
+        return self.body + self.suffix(tim)
+
+    def md5(self, tim):
+        """
+        Get the checksum of a file in the packed format used by 4chan's API.
+
+        :param tim: The file's id.
+        :return: The base64-encoded MD5 digest, as unicode.
+        """
+        hash_ = self._body_hash.copy()
+        hash_.update(self.suffix(tim))
+        return base64.b64encode(hash_.digest()).decode('ascii')
+
+
+def post_json(index, media, thread_no=_FIRST_NO):
+    """
+    Generate a single post in 4chan's API format, with a file attached.
+
+    :param index: The position of the post within its thread, from 0.
+    :param media: The media source providing the file's size and checksum.
+    :param thread_no: The post number of the thread's first post.
+    :return: The post as a dictionary.
+    """
+    tim = _FIRST_TIM + index
+    post = {
+        'no': thread_no + index,
+        'now': '02/02/17(Thu)01:25:15',
+        'name': 'Anonymous',
+        'com': 'Post number {0}'.format(index),
+        'filename': 'file_{0}'.format(index),
+        'ext': '.jpg',
+        'w': 1920,
+        'h': 1080,
+        'tn_w': 250,
+        'tn_h': 140,
+        'tim': tim,
+        'time': 1486016715 + index,
+        'md5': media.md5(tim),
+        'fsize': media.size,
+        'resto': 0 if index == 0 else thread_no
+    }
+    if index == 0:
+        post['sub'] = 'Synthetic thread'
+        post['semantic_url'] = 'synthetic-thread'
+    return post
+
+
+def thread_json(posts, media, thread_no=_FIRST_NO):
+    """
+    Generate a thread in 4chan's API format.
+
+    :param posts: The number of posts in the thread; at least 1.
+    :param media: The media source for the posts' files.
+    :param thread_no: The post number of the thread's first post.
+    :return: The thread as a dictionary.
+    """
+    return {
+        'posts': [post_json(i, media, thread_no) for i in range(posts)]
+    }
+
+
+def _weighted_choice(rng, choices):
+    """
+    Pick from a list of (value, weight) pairs.
+
+    :param rng: The random number generator to use.
+    :param choices: The pairs to choose between; weights should sum to 1.
+    :return: The chosen value.
+    """
+    point = rng.random()
+    for value, weight in choices:
+        point -= weight
+        if point < 0:
+            return value
+    return choices[-1][0]
+
+
+def _sentence(rng, entity_rate):
+    """
+    Generate a sentence of escaped text.
+
+    :param rng: The random number generator to use.
+    :param entity_rate: The probability of each word being followed by an
+                        HTML entity.
+    :return: The sentence.
+    """
+    words = []
+    for _ in range(rng.randint(3, 15)):
+        words.append(rng.choice(_WORDS))
+        if rng.random() < entity_rate:
+            words.append(rng.choice(_ENTITIES))
+    return ' '.join(words).capitalize() + rng.choice(['.', '?', '!', ''])
+
+
+def _comment(rng, thread_no, index, entity_rate):
+    """
+    Generate a comment resembling real 4chan markup: quote links, greentext
+    and line breaks mixed with plain text.
+
+    :param rng: The random number generator to use.
+    :param thread_no: The number of the thread's first post.
+    :param index: The position of the post being generated.
+    :param entity_rate: The probability of each word being followed by an
+                        HTML entity.
+    :return: The comment HTML.
+    """
+    lines = []
+    if index and rng.random() < 0.4:
+        quoted = thread_no + rng.randint(0, index - 1)
+        lines.append('<a href="#p{0}" class="quotelink">&gt;&gt;{0}</a>'
+                     .format(quoted))
+    if rng.random() < 0.15:
+        lines.append('<span class="quote">&gt;{0}</span>'.format(
+            _sentence(rng, entity_rate)))
+    for _ in range(rng.randint(1, 3)):
+        lines.append(_sentence(rng, entity_rate))
+    return '<br>'.join(lines)
+
+
+def realistic_post_json(rng, index, thread_no=_FIRST_NO, file_rate=0.4,
+                        entity_rate=0.05):
+    """
+    Generate a post in 4chan's API format with a plausible mix of fields.
+    Unlike `post_json()`, files are not backed by any media source.
+
+    :param rng: The random number generator to use.
+    :param index: The position of the post within its thread, from 0.
+    :param thread_no: The post number of the thread's first post.
+    :param file_rate: The probability of a reply having a file; the first post
+                      always has one.
+    :param entity_rate: The probability of each word in a comment being
+                        followed by an HTML entity.
+    :return: The post as a dictionary.
+    """
+    post = {
+        'no': thread_no + index,
+        'now': '02/02/17(Thu)01:25:15',
+        'name': 'Anonymous',
+        'time': 1486016715 + index * 7,
+        'resto': 0 if index == 0 else thread_no
+    }
+    if index == 0 or rng.random() < 0.9:
+        post['com'] = _comment(rng, thread_no, index, entity_rate)
+    if index == 0 or rng.random() < file_rate:
+        post.update({
+            'filename': _sentence(rng, entity_rate)[:rng.randint(5, 40)],
+            'ext': _weighted_choice(rng, _EXTENSIONS),
+            'w': rng.choice([1280, 1366, 1920, 2560, 3840]),
+            'h': rng.choice([720, 768, 1080, 1440, 2160]),
+            'tn_w': 250,
+            'tn_h': 140,
+            'tim': (_FIRST_TIM + (thread_no - _FIRST_NO + index) * 1000 +
+                    rng.randint(0, 999)),
+            'md5': base64.b64encode(bytes(bytearray(
+                rng.getrandbits(8) for _ in range(16)))).decode('ascii'),
+            'fsize': rng.randint(10 * 1024, 4 * 1024 * 1024)
+        })
+    if index == 0:
+        post.update({
+            'sub': _sentence(rng, entity_rate)[:60],
+            'semantic_url': 'synthetic-thread-{0}'.format(thread_no),
+            'bumplimit': 0,
+            'imagelimit': 0
+        })
+    return post
+
+
+def iter_posts(count, seed=0, thread_no=_FIRST_NO, file_rate=0.4,
+               entity_rate=0.05):
+    """
+    Lazily generate the posts of a realistic thread, so threads too large to
+    hold in memory as dictionaries can still be written out.
+
+    :param count: The number of posts; at least 1.
+    :param seed: Seeds the random number generator; the same seed always
+                 produces the same posts.
+    :param thread_no: The post number of the thread's first post.
+    :param file_rate: The probability of a reply having a file.
+    :param entity_rate: The probability of each word in a comment being
+                        followed by an HTML entity.
+    :return: A generator of post dictionaries.
+    """
+    rng = random.Random(seed)
+    for index in range(count):
+        yield realistic_post_json(rng, index, thread_no, file_rate,
+                                  entity_rate)
+
+
+def realistic_thread_json(count, seed=0, thread_no=_FIRST_NO, file_rate=0.4,
+                          entity_rate=0.05):
+    """
+    Generate a realistic thread in 4chan's API format.
+
+    :param count: The number of posts; at least 1.
+    :param seed: Seeds the random number generator.
+    :param thread_no: The post number of the thread's first post.
+    :param file_rate: The probability of a reply having a file.
+    :param entity_rate: The probability of each word in a comment being
+                        followed by an HTML entity.
+    :return: The thread as a dictionary.
+    """
+    return {
+        'posts': list(iter_posts(count, seed, thread_no, file_rate,
+                                 entity_rate))
+    }
+
+
+def write_thread(handle, count, seed=0, file_rate=0.4, entity_rate=0.05):
+    """
+    Write a realistic thread as JSON one post at a time, keeping memory use
+    constant regardless of size.
+
+    :param handle: A text file object to write to.
+    :param count: The number of posts; at least 1.
+    :param seed: Seeds the random number generator.
+    :param file_rate: The probability of a reply having a file.
+    :param entity_rate: The probability of each word in a comment being
+                        followed by an HTML entity.
+    """
+    handle.write('{"posts": [')
+    for index, post in enumerate(iter_posts(count, seed, file_rate=file_rate,
+                                            entity_rate=entity_rate)):
+        if index:
+            handle.write(', ')
+        handle.write(json.dumps(post))
+    handle.write(']}')
+
+
+def catalog_json(threads, seed=0, replies=5):
+    """
+    Generate a board catalog in 4chan's API format: a list of pages, each
+    holding the first post of several threads along with their latest replies.
+
+    :param threads: The number of threads on the board.
+    :param seed: Seeds the random number generator.
+    :param replies: The number of latest replies included with each thread.
+    :return: The catalog as a list.
+    """
+    rng = random.Random(seed)
+    pages = []
+    for index in range(threads):
+        thread_no = _FIRST_NO + index * 1000
+        op = realistic_post_json(rng, 0, thread_no)
+        op['replies'] = rng.randint(replies, 300)
+        op['images'] = rng.randint(0, op['replies'])
+        op['last_replies'] = [
+            realistic_post_json(rng, op['replies'] - replies + i + 1,
+                                thread_no)
+            for i in range(replies)]
+        if index % _CATALOG_PAGE_SIZE == 0:
+            pages.append({'page': len(pages) + 1, 'threads': []})
+        pages[-1]['threads'].append(op)
+    return pages
+
+
+def catalog_posts(catalog):
+    """
+    Flatten a catalog into the posts it contains.
+
+    :param catalog: A catalog, as returned by `catalog_json()`.
+    :return: A generator of (board-relative) post dictionaries.
+    """
+    for page in catalog:
+        for op in page['threads']:
+            yield op
+            for reply in op.get('last_replies', []):
+                yield reply
+
+
+def write_file(path, writer, *args, **kwargs):
+    """
+    Write generated JSON to a file path, creating parent directories.
+
+    :param path: The file to write.
+    :param writer: A function taking a handle as its first argument, e.g.
+                   `write_thread`.
+    :param args: Further arguments to the writer.
+    :param kwargs: Further keyword arguments to the writer.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as handle:
+        writer(handle, *args, **kwargs)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed storage of files, keeping each thread directory small. Files
+live in a tree sharded by checksum, shared between threads, and thread
+directories only refer to them.
+"""
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from chandl.model import file
+
+
+# the name of the manifest written to thread directories in place of links
+MANIFEST_NAME = 'manifest.jsonl'
+
+logger = logging.getLogger(__name__)
+
+
+def object_path(file_):
+    """
+    Find where a file is kept relative to the root of a content tree, e.g.
+    `ab/cd/abcd...ef.webm`. Two levels of 256 directories keep each directory
+    small for any realistic number of files.
+
+    :param file_: The file.
+    :return: The relative path.
+    """
+    return os.path.join(file_.md5[:2], file_.md5[2:4],
+                        '{0}.{1}'.format(file_.md5, file_.extension))
+
+
+def _make_dirs(path):
+    """
+    Create a directory and its parents, tolerating another thread creating
+    them at the same time.
+
+    :param path: The directory to create.
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+class ContentDirectory:
+    """
+    A thread directory whose files are stored by checksum under a shared root,
+    so files appear only once however many threads they are posted in. The
+    thread directory contains symlinks to the stored files, or if links are
+    disabled, a manifest listing them. A file is known to be stored if its path
+    exists, as files are only moved into place once verified.
+    """
+
+    def __init__(self, root, path, link=True, cache=True):
+        """
+        Initialise a new content directory, creating the root if necessary.
+
+        :param root: The directory at the root of the content tree.
+        :param path: The thread directory, which must exist.
+        :param link: Whether to add a symlink to each file to the thread
+                     directory. If false, a manifest is written instead.
+                     Defaults to true.
+        :param cache: Whether the OS may keep stored files in its page cache.
+                      Defaults to true.
+        :raises IOError: If the root or manifest could not be created.
+        """
+        self.root = root
+        self.path = path
+        self._link = link
+        self._cache = cache
+        _make_dirs(root)
+
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+        self._listed = set()
+        if not link:
+            manifest_path = os.path.join(path, MANIFEST_NAME)
+            if os.path.isfile(manifest_path):
+                with io.open(manifest_path, encoding='utf-8') as handle:
+                    for line in handle:
+                        try:
+                            self._listed.add(json.loads(line)['file'])
+                        except ValueError:
+                            # cut short by an earlier run being killed
+                            continue
+            self._manifest = io.open(manifest_path, 'a', encoding='utf-8')
+
+    def save(self, post_, name, session=None):
+        """
+        Download a post's file into the content tree if it is not already
+        there, and refer to it from the thread directory. This is the
+        counterpart of `File.save_to()`.
+
+        :param post_: The post whose file to download.
+        :param name: The name of the file within the thread directory.
+        :param session: The transport to use for the download.
+        :return: True if the file was skipped because it was already stored;
+                 False if it was downloaded successfully.
+        :raise IOError: If the file could not be downloaded or written, or its
+                        checksum did not match the one reported by 4chan.
+        """
+        relative = object_path(post_.file)
+        destination = os.path.join(self.root, relative)
+
+        existed = os.path.exists(destination)
+        if existed:
+            logger.debug('%s already stored; skipping download', post_.file)
+        else:
+            self._download(post_, destination, session)
+
+        if self._link:
+            self._symlink(destination, name)
+        else:
+            self._list(post_, name, relative)
+        return existed
+
+    def _download(self, post_, destination, session):
+        """
+        Download a file to a temporary name next to its destination, moving it
+        into place once its checksum has been verified.
+
+        :param post_: The post whose file to download.
+        :param destination: The file's path in the content tree.
+        :param session: The transport to use for the download.
+        """
+        directory = os.path.dirname(destination)
+        _make_dirs(directory)
+        handle = tempfile.NamedTemporaryFile(dir=directory, suffix='.part',
+                                             delete=False)
+        try:
+            with handle:
+                file.preallocate(handle, post_.file.size)
+                md5 = post_.file.fetch(handle, session)
+                handle.truncate()
+                if not self._cache:
+                    file.drop_cache(handle)
+            if md5 != post_.file.md5:
+                raise IOError('Verify failed: checksum mismatch')
+            # another thread may have stored the same file meanwhile; either
+            # copy is correct
+            os.rename(handle.name, destination)
+        except BaseException:
+            os.remove(handle.name)
+            raise
+
+    def _symlink(self, destination, name):
+        """
+        Link to a stored file from the thread directory.
+
+        :param destination: The file's path in the content tree.
+        :param name: The link's name within the thread directory.
+        """
+        link = os.path.join(self.path, name)
+        if os.path.lexists(link):
+            return
+        os.symlink(os.path.relpath(destination, os.path.dirname(link)), link)
+
+    def _list(self, post_, name, relative):
+        """
+        Record a stored file in the thread directory's manifest.
+
+        :param post_: The post the file belongs to.
+        :param name: The name the file would have in the thread directory.
+        :param relative: The file's path relative to the root.
+        """
+        with self._manifest_lock:
+            if post_.file.id in self._listed:
+                return
+            self._manifest.write(json.dumps({
+                'board': post_.board,
+                'post': post_.id,
+                'file': post_.file.id,
+                'name': name,
+                'md5': post_.file.md5,
+                'size': post_.file.size,
+                'path': relative
+            }) + '\n')
+            self._manifest.flush()
+            self._listed.add(post_.file.id)
+
+    def close(self):
+        """
+        Close the manifest, if one is being written.
+        """
+        if self._manifest:
+            self._manifest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
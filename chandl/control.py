@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Retuning a download while it runs: through a control file of settings, read
+again whenever it changes or on SIGUSR2, and SIGUSR1 to print a snapshot of
+its progress.
+"""
+from __future__ import unicode_literals, print_function
+
+import collections
+import contextlib
+import io
+import logging
+import os
+import signal
+import sys
+import threading
+
+
+# the multipliers of rate suffixes
+_RATE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+# how often the control file is checked for changes, in seconds
+_INTERVAL = 1
+
+logger = logging.getLogger(__name__)
+
+
+def parse_rate(value):
+    """
+    Interpret a transfer rate, as passed to --limit-rate.
+
+    :param value: The number of bytes per second, optionally suffixed by K, M
+                  or G for multiples of 1024, e.g. '500K'.
+    :return: The number of bytes per second.
+    :raises ValueError: If the rate is invalid.
+    """
+    number = value.strip()
+    unit = number[-1:].lower() if number[-1:].isalpha() else ''
+    if unit:
+        number = number[:-1]
+    try:
+        rate = float(number) * _RATE_UNITS[unit]
+    except (KeyError, ValueError):
+        raise ValueError('Invalid rate: {0}'.format(value))
+    if rate < 0:
+        raise ValueError('Invalid rate: {0}'.format(value))
+    return int(rate)
+
+
+def read_settings(path):
+    """
+    Read a control file: lines such as `parallelism = 8` or
+    `limit-rate = 2M`, as the corresponding options take. Blank lines, and
+    those starting with #, are ignored.
+
+    :param path: The path of the file.
+    :return: A dict of the settings in the file, by name, interpreted.
+    :raises IOError: If the file could not be read.
+    :raises ValueError: If the file contains an invalid line.
+    """
+    settings = {}
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, _, value = (part.strip() for part in line.partition('='))
+            if name == 'parallelism' and value.isdigit() and int(value):
+                settings[name] = int(value)
+            elif name == 'limit-rate':
+                settings[name] = parse_rate(value)
+            else:
+                raise ValueError('Invalid line: {0}'.format(line))
+    return settings
+
+
+def apply_settings(downloader, path, scale=1):
+    """
+    Retune a download to the settings in a control file. Invalid files are
+    logged and ignored.
+
+    :param downloader: The `Downloader`.
+    :param path: The path of the file.
+    :param scale: What to multiply the parallelism in the file by.
+    """
+    try:
+        settings = read_settings(path)
+    except (IOError, ValueError) as e:
+        logger.warning('Failed to read the control file %s: %s', path, e)
+        return
+    if 'parallelism' in settings:
+        downloader.resize(settings['parallelism'] * scale)
+    if 'limit-rate' in settings:
+        downloader.throttle.rate = settings['limit-rate'] or None
+    logger.info('Applied the control file %s: %s', path, ', '.join(
+        '{0} = {1}'.format(*item) for item in sorted(settings.items())))
+
+
+@contextlib.contextmanager
+def controlled(downloader, control=None, scale=1):
+    """
+    For the duration of the context, SIGUSR1 prints a snapshot of a download
+    to stderr and the log, and SIGUSR2 applies the control file, if any,
+    which is also applied whenever it is modified. The handlers only note
+    which signals arrived; a thread of its own does the work, so neither the
+    handlers nor the download threads wait on each other. Signals can only
+    be handled on the main thread, and do not exist on Windows; there, only
+    the file is watched.
+
+    :param downloader: The `Downloader`.
+    :param control: The path of the control file, if any.
+    :param scale: What to multiply the parallelism in the file by, e.g. for
+                  thumbnails.
+    """
+    received = collections.deque()
+    wake = threading.Event()
+    stopped = []
+
+    # noinspection PyUnusedLocal
+    def handler(number, frame):
+        received.append(number)
+        wake.set()
+
+    def control_loop():
+        modified = None
+        while True:
+            # read first: the handlers run before the context exits, so every
+            # signal received before then is handled
+            done = bool(stopped)
+            reload_ = False
+            while received:
+                if received.popleft() == signal.SIGUSR1:
+                    snapshot = downloader.snapshot()
+                    print(os.linesep + str(snapshot), file=sys.stderr)
+                    logger.info('Snapshot:%s%s', os.linesep, snapshot)
+                elif control:
+                    reload_ = True
+                else:
+                    logger.warning('Received SIGUSR2 without a control file')
+            if control:
+                try:
+                    mtime = os.path.getmtime(control)
+                except OSError:
+                    mtime = None
+                if reload_ or mtime is not None and mtime != modified:
+                    apply_settings(downloader, control, scale)
+                modified = mtime
+            if done:
+                break
+            wake.wait(_INTERVAL)
+            wake.clear()
+
+    original_handlers = {}
+    for name in ('SIGUSR1', 'SIGUSR2'):
+        number = getattr(signal, name, None)
+        if number is None:
+            continue
+        try:
+            original_handlers[number] = signal.signal(number, handler)
+        except ValueError:
+            break
+
+    thread = threading.Thread(target=control_loop)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        for number, original_handler in original_handlers.items():
+            signal.signal(number, original_handler)
+        stopped.append(True)
+        wake.set()
+        thread.join()
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+A long-running process downloading threads submitted over a local HTTP API.
+Jobs are queued in a state database, so they survive restarts, and run one
+after another through a single connection pool.
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import multiprocessing
+import os
+import re
+import stat
+import threading
+import time
+
+import six
+from six.moves import BaseHTTPServer, socketserver
+
+from chandl import transport, util
+from chandl.downloader import Cancellation, Downloader
+from chandl.model import file, post
+from chandl.model.thread import Thread
+
+
+# how often the worker checks the database for jobs submitted by another
+# process sharing it, in seconds
+_POLL_INTERVAL = 1
+
+# the number of jobs listed by `GET /jobs`
+_JOB_LIST_LIMIT = 100
+
+logger = logging.getLogger(__name__)
+
+
+def _check_options(options):
+    """
+    Validate the options of a submitted job.
+
+    :param options: A dictionary which may contain a list of `filter` and
+                    `exclude` strings, and `name` and `thread_dir` strings,
+                    with the same meanings as the CLI's options.
+    :raises ValueError: If an option is unknown or invalid.
+    """
+    for key, value in options.items():
+        if key in ('filter', 'exclude'):
+            if not isinstance(value, list) or \
+                    not all(isinstance(v, six.string_types) for v in value):
+                raise ValueError('{0} must be a list of strings'.format(key))
+        elif key in ('name', 'thread_dir'):
+            if not isinstance(value, six.string_types) or not value:
+                raise ValueError('{0} must be a string'.format(key))
+        else:
+            raise ValueError('Unknown option: {0}'.format(key))
+
+    # jobs may only write within the output directory
+    thread_dir = options.get('thread_dir')
+    if thread_dir and (os.path.basename(thread_dir) != thread_dir or
+                       thread_dir in (os.curdir, os.pardir)):
+        raise ValueError('thread_dir must be a single directory name')
+    name = options.get('name')
+    if name and (os.path.isabs(name) or name.startswith(('/', '\\')) or
+                 os.pardir in re.split(r'[\\/]', name)):
+        raise ValueError('name must be relative to the thread directory')
+
+
+def _inside(directory, name):
+    """
+    Find whether a file name resolves to a path within a directory.
+
+    :param directory: The directory.
+    :param name: The file name, possibly with subdirectories.
+    :return: True if it does.
+    """
+    root = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(root, name))
+    return path.startswith(root + os.sep)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server handling each connection on its own thread.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    An HTTP server listening on a Unix socket, handling each connection on its
+    own thread.
+    """
+
+    daemon_threads = True
+
+    # noinspection PyAttributeOutsideInit
+    def server_bind(self):
+        # mirror HTTPServer, which handlers expect
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the API of a `Daemon`.
+    """
+
+    _JOB_PATH = re.compile(r'^/jobs/([0-9]+)$')
+
+    # noinspection PyPep8Naming
+    def do_GET(self):
+        daemon = self.server.daemon
+        if self.path == '/jobs':
+            self._send_json(200, {'jobs': daemon.jobs()})
+        elif self.path == '/metrics':
+            self._send(200, daemon.metrics().encode('utf-8'),
+                       'text/plain; version=0.0.4')
+        else:
+            match = self._JOB_PATH.match(self.path)
+            job = daemon.job(int(match.group(1))) if match else None
+            if job:
+                self._send_json(200, job)
+            else:
+                self._send_json(404, {'error': 'Not found'})
+
+    # noinspection PyPep8Naming
+    def do_POST(self):
+        if self.path != '/jobs':
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(request, dict) or 'url' not in request:
+                raise ValueError('Expected an object with a url')
+            url = request.pop('url')
+            job = self.server.daemon.submit(url, request)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        self._send_json(202, job, {'Location': '/jobs/{0}'.format(job['id'])})
+
+    def _send_json(self, status, body, headers=None):
+        """
+        Write a complete JSON response.
+
+        :param status: The HTTP status code.
+        :param body: The object to encode.
+        :param headers: A dictionary of additional headers, if any.
+        """
+        self._send(status, json.dumps(body).encode('utf-8'),
+                   'application/json', headers)
+
+    def _send(self, status, body, content_type, headers=None):
+        """
+        Write a complete response.
+
+        :param status: The HTTP status code.
+        :param body: The response body as a bytestring.
+        :param content_type: The value of the Content-Type header.
+        :param headers: A dictionary of additional headers, if any.
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of Unix sockets have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format_, *args):
+        logger.debug('%s %s', self.address_string(), format_ % args)
+
+
+class Daemon:
+    """
+    Downloads threads submitted over a local HTTP API, one after another.
+    Queued jobs are kept in a `Store`, so a restarted daemon carries on where
+    it left off; other processes sharing the store can also add jobs to it.
+
+    The API has the following endpoints:
+
+    - `POST /jobs` queues a thread, taking an object with a `url`, and
+      optionally `filter`, `exclude`, `name` and `thread_dir`, with the same
+      meanings as the CLI's options. Responds with the job.
+    - `GET /jobs` lists recent jobs, newest first.
+    - `GET /jobs/<id>` gets a single job, including the outcome of its run.
+    - `GET /metrics` reports counters in Prometheus' text format.
+    """
+
+    def __init__(self, store_, output_dir, name_fmt, parallelism=4):
+        """
+        Initialise a new daemon.
+
+        :param store_: The `Store` to queue jobs in and record files in.
+        :param output_dir: The directory to create thread directories within.
+        :param name_fmt: The default format for file names.
+        :param parallelism: The maximum number of threads to use to download
+                            files per CPU.
+        """
+        self._store = store_
+        self._output_dir = output_dir
+        self._name_fmt = name_fmt
+        self._parallelism = parallelism
+
+        # shared by every job, so connections to 4chan are reused
+        self._session = transport.pooled(multiprocessing.cpu_count() *
+                                         parallelism)
+
+        # cancels the job in progress when the daemon is stopped, without
+        # affecting other downloaders in the process
+        self._cancellation = Cancellation()
+
+        self._wakeup = threading.Condition()
+        self._stopping = False
+        self._worker = None
+        self._server = None
+        self._server_thread = None
+        self._socket_path = None
+
+        self._started = time.time()
+        self._counters_lock = threading.Lock()
+        self._counters = {
+            'downloaded': 0,
+            'failed': 0,
+            'skipped': 0,
+            'bytes': 0
+        }
+
+    def start(self, address):
+        """
+        Start serving the API and working through queued jobs, including any
+        left unfinished by a previous daemon.
+
+        :param address: Either a (host, port) tuple to listen on, or the path
+                        of a Unix socket.
+        :raises socket.error: If the address could not be bound.
+        """
+        if isinstance(address, six.string_types):
+            # remove the socket of a previous daemon that did not exit cleanly
+            if os.path.exists(address) and \
+                    stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)
+            self._server = _UnixServer(address, _Handler)
+            self._socket_path = address
+        else:
+            self._server = _TCPServer(address, _Handler)
+        self._server.daemon = self
+
+        requeued = self._store.requeue_jobs()
+        if requeued:
+            logger.info('Resuming %d unfinished jobs', requeued)
+
+        self._worker = threading.Thread(target=self._work)
+        self._worker.daemon = True
+        self._worker.start()
+
+        self._server_thread = threading.Thread(
+            target=self._server.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+
+    @property
+    def address(self):
+        """
+        Get the address the API is being served on.
+
+        :return: A (host, port) tuple, or the path of a Unix socket.
+        """
+        return self._socket_path or self._server.server_address
+
+    def stop(self):
+        """
+        Stop serving and abandon downloads in progress. A job whose files were
+        not all downloaded is resumed when the daemon next starts.
+        """
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        self._cancellation.cancel()
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._server_thread.join()
+        if self._socket_path:
+            os.remove(self._socket_path)
+        self._worker.join()
+        self._session.close()
+
+    def submit(self, url, options=None):
+        """
+        Queue a thread to be downloaded.
+
+        :param url: The URL of the thread.
+        :param options: A dictionary of options; see `Daemon`.
+        :return: The job as a dictionary.
+        :raises ValueError: If the URL or an option is invalid.
+        """
+        options = options or {}
+        Thread.parse_url(url)
+        _check_options(options)
+
+        job_id = self._store.add_job(url, options)
+        logger.info('Queued job %d for %s', job_id, url)
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return self._store.job(job_id)
+
+    def job(self, job_id):
+        """
+        Look up a job.
+
+        :param job_id: The job's id.
+        :return: The job as a dictionary, or None if it does not exist.
+        """
+        return self._store.job(job_id)
+
+    def jobs(self):
+        """
+        List recently submitted jobs.
+
+        :return: A list of job dictionaries, newest first.
+        """
+        return self._store.jobs(_JOB_LIST_LIMIT)
+
+    def metrics(self):
+        """
+        Report the daemon's counters.
+
+        :return: The counters in Prometheus' text exposition format.
+        """
+        with self._counters_lock:
+            counters = dict(self._counters)
+
+        lines = ['# TYPE chandl_jobs gauge']
+        for status, count in sorted(self._store.job_counts().items()):
+            lines.append('chandl_jobs{{status="{0}"}} {1}'.format(
+                status, count))
+        lines.append('# TYPE chandl_files_total counter')
+        for outcome in ('downloaded', 'failed', 'skipped'):
+            lines.append('chandl_files_total{{outcome="{0}"}} {1}'.format(
+                outcome, counters[outcome]))
+        lines.extend([
+            '# TYPE chandl_downloaded_bytes_total counter',
+            'chandl_downloaded_bytes_total {0}'.format(counters['bytes']),
+            '# TYPE chandl_uptime_seconds gauge',
+            'chandl_uptime_seconds {0:.3f}'.format(time.time() - self._started)
+        ])
+        return '\n'.join(lines) + '\n'
+
+    def _work(self):
+        """
+        Run queued jobs until stopped. Runs on its own thread.
+        """
+        while not self._stopping:
+            job = self._store.claim_job()
+            if job is None:
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(_POLL_INTERVAL)
+                continue
+
+            logger.info('Starting job %d for %s', job['id'], job['url'])
+            try:
+                run_id = self._download(job)
+            except (ValueError, IOError, OSError) as e:
+                logger.error('Job %d failed: %s', job['id'], e)
+                self._store.finish_job(job['id'], error=str(e))
+                continue
+            except Exception as e:
+                # a bug in one job must not stop the worker running the rest
+                logger.exception('Job %d failed unexpectedly', job['id'])
+                self._store.finish_job(job['id'], error=str(e) or repr(e))
+                continue
+
+            if self._stopping:
+                # leave the job running, so it is resumed on restart
+                logger.info('Job %d interrupted', job['id'])
+            else:
+                self._store.finish_job(job['id'], run_id)
+                logger.info('Finished job %d', job['id'])
+
+    def _download(self, job):
+        """
+        Download a thread's files.
+
+        :param job: The job dictionary.
+        :return: The id of the run recording the outcome, or None if the daemon
+                 was stopped before downloading started.
+        :raises ValueError: If the file name format is invalid.
+        :raises IOError: If the thread could not be retrieved, or its
+                         directory created.
+        """
+        options = job['options']
+        thread = Thread.from_url(job['url'], self._session, lazy=True)
+        self._store.add_thread(thread)
+        self._store.add_raw_posts(thread, thread.posts.raw())
+
+        directory = os.path.abspath(os.path.join(
+            self._output_dir,
+            options.get('thread_dir') or util.make_filename(thread.title)))
+
+        posts = post.select(thread.posts,
+                            file.expand_filters(options.get('filter', [])),
+                            util.expand_cli_args(options.get('exclude', [])))
+        done = self._store.downloaded(thread.board, thread.id, directory)
+        if done:
+            posts = posts.filter(lambda json_: json_['tim'] not in done)
+
+        # validate the name with the first post, unless it could not be
+        # decoded, in which case the downloader counts it as failed
+        name_fmt = options.get('name', self._name_fmt)
+        if posts and not isinstance(posts[0], post.MalformedPost):
+            try:
+                name = posts[0].format(name_fmt)
+            except (KeyError, AttributeError, IndexError, ValueError) as e:
+                raise ValueError('Invalid file name specifier: {0}'.format(e))
+            if not _inside(directory, name):
+                raise ValueError('File name {0} is outside the thread '
+                                 'directory'.format(name))
+        if not os.path.isdir(directory):
+            os.mkdir(directory, 0o700)
+
+        if self._stopping:
+            return None
+
+        run_id = self._store.start_run(thread)
+        result = Downloader(directory, name_fmt, self._parallelism,
+                            self._store, session=self._session,
+                            cancellation=self._cancellation,
+                            summary_only=True).download(posts)
+        self._store.finish_run(run_id, result)
+
+        with self._counters_lock:
+            self._counters['downloaded'] += result.downloaded_job_count
+            self._counters['failed'] += result.failed_job_count
+            self._counters['skipped'] += result.skipped_job_count
+            self._counters['bytes'] += result.downloaded_bytes
+        return run_id
@@ -1,110 +1,277 @@
 # -*- coding: utf-8 -*-
-from __future__ import unicode_literals, print_function
+from __future__ import unicode_literals, print_function, division
 
 import logging
 import multiprocessing
+import io
 import time
-import signal
 import functools
 import threading
-import collections
-import contextlib
+import copy
+import sys
 import six
 import datetime
 import os
-import requests
+from six.moves import queue as queue_
 from progress.bar import Bar
 
-from chandl import util
+from chandl import util, store, jobs, mirrors, stats, timeline, transport
+from chandl.model import file
+from chandl.model.post import MalformedPost
 
 
+# when files saved in the thread directory are flushed to disk: never, leaving
+# it to the OS; after each file; by each download thread once it runs out of
+# jobs; or once all threads have finished
+FSYNC_NONE = 'none'
+FSYNC_FILE = 'file'
+FSYNC_THREAD = 'thread'
+FSYNC_END = 'end'
+
+FSYNC_MODES = [FSYNC_NONE, FSYNC_FILE, FSYNC_THREAD, FSYNC_END]
+
+# what became of a job, as reported by `Downloader.as_completed()`
+OUTCOME_DOWNLOADED = 'downloaded'
+OUTCOME_SKIPPED = 'skipped'
+OUTCOME_FAILED = 'failed'
+
+# a job not yet done when its download was cancelled; only counted
+OUTCOME_REMAINING = 'remaining'
+
 logger = logging.getLogger(__name__)
 
-_interrupted = False
+
+class Cancelled(IOError):
+    """
+    Raised when a transfer is abandoned because its download was cancelled.
+    """
 
 
-def _handle_sigint(number, frame):
+class Cancellation:
+    """
+    A token by which a download is cancelled, e.g. from another thread or a
+    signal handler. Each `Downloader` has its own unless given one, so
+    several can run in a process and be cancelled independently.
     """
-    Called when we receive a SIGINT.
 
-    :param number: The signal number (2 in this case).
-    :param frame: The stack frame.
+    def __init__(self):
+        # a plain attribute rather than an Event, so cancelling is safe from a
+        # signal handler
+        self._cancelled = False
+
+    def cancel(self):
+        """
+        Cancel the download: no further jobs are started, and transfers in
+        progress are abandoned at their next read.
+        """
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        """
+        Find whether the download has been cancelled.
+
+        :return: True if it has.
+        """
+        return self._cancelled
+
+
+class Throttle:
+    """
+    Counts the bytes received by a download's threads, and limits the rate
+    they are received at, if asked to. The limit can be changed at any time,
+    e.g. from a signal handler, and applies to all threads together. Each
+    `Downloader` has its own unless given one.
     """
-    del number, frame
-    global _interrupted
-    _interrupted = True
 
+    def __init__(self, rate=None):
+        """
+        Initialise a new throttle.
 
-@contextlib.contextmanager
-def _redirect_sigint(handler=_handle_sigint):
+        :param rate: The most bytes to receive per second, or None for no
+                     limit. Defaults to no limit.
+        """
+        self.rate = rate
+        self.transferred = 0
+        self._lock = threading.Lock()
+        # when the bytes received so far may all have been received at the
+        # limit
+        self._clock = 0
+
+    def consume(self, size, cancellation=None):
+        """
+        Count bytes just received, waiting until they are within the limit,
+        so the sender is slowed down by the connection backing up.
+
+        :param size: The number of bytes.
+        :param cancellation: The `Cancellation` to stop waiting early on, if
+                             any.
+        """
+        with self._lock:
+            self.transferred += size
+            rate = self.rate
+            if not rate:
+                return
+            now = time.time()
+            # allow bursts of at most a quarter of a second's worth after a
+            # lull
+            self._clock = max(self._clock, now - .25) + size / rate
+            delay = self._clock - now
+        while delay > 0 and not (cancellation and cancellation.cancelled):
+            # wake periodically to notice cancellation
+            time.sleep(min(delay, .5))
+            delay = self._clock - time.time()
+
+
+class _CancellableBody(io.RawIOBase):
+    """
+    A response body that stops being readable once its download is cancelled,
+    and is read no faster than its download's `Throttle` allows.
     """
-    For the duration of this function, a SIGINT will call _handle_sigint()
-    rather than the normal Python routine.
 
-    :param handler: The function to invoke if SIGINT is received.
+    def __init__(self, raw, cancellation, throttle=None):
+        """
+        Initialise a new body.
+
+        :param raw: The body being read.
+        :param cancellation: The download's `Cancellation`.
+        :param throttle: The download's `Throttle`, if any.
+        """
+        super(_CancellableBody, self).__init__()
+        self._raw = raw
+        self._cancellation = cancellation
+        self._throttle = throttle
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer_):
+        if self._cancellation.cancelled:
+            raise Cancelled('Download cancelled')
+        read = self._raw.readinto(buffer_)
+        if read and self._throttle:
+            self._throttle.consume(read, self._cancellation)
+        return read
+
+    def close(self):
+        self._raw.close()
+        super(_CancellableBody, self).close()
+
+
+class _CancellableTransport:
+    """
+    A transport whose requests and response bodies fail with `Cancelled` once
+    their download is cancelled, and whose response bodies are throttled.
     """
-    original_handler = signal.getsignal(signal.SIGINT)
-    signal.signal(signal.SIGINT, handler)
-    try:
-        yield
-    except:
-        raise
-    finally:
-        signal.signal(signal.SIGINT, original_handler)
 
+    def __init__(self, transport_, cancellation, throttle=None):
+        """
+        Initialise a new cancellable transport.
 
-@six.python_2_unicode_compatible
-class DownloadResult:
+        :param transport_: The transport to send requests with.
+        :param cancellation: The download's `Cancellation`.
+        :param throttle: The download's `Throttle`, if any.
+        """
+        self._transport = transport_
+        self._cancellation = cancellation
+        self._throttle = throttle
+
+    def get(self, url, stream=False):
+        """
+        Send a GET request.
+
+        :param url: The URL to request.
+        :param stream: Whether to stream the body.
+        :return: The response.
+        :raises Cancelled: If the download has been cancelled.
+        """
+        if self._cancellation.cancelled:
+            raise Cancelled('Download cancelled')
+        response = self._transport.get(url, stream=stream)
+        return transport.Response(
+            url, response.status_code,
+            _CancellableBody(response.raw, self._cancellation,
+                             self._throttle))
+
+
+def _thumbnail_post(post_):
     """
-    Represents the outcome of a thread download.
+    Get a copy of a post whose file is replaced by its thumbnail.
+
+    :param post_: The post.
+    :return: The copy.
     """
+    thumbnail = copy.copy(post_)
+    thumbnail.file = post_.file.thumbnail
+    return thumbnail
 
-    @staticmethod
-    def _posts_size(posts):
+
+class Outcome:
+    """
+    What became of a single job, reported as soon as it is handled.
+    """
+
+    def __init__(self, post_, status, path=None, error=None):
         """
-        Find the total size of the files in all posts in a list.
+        Initialise a new outcome.
 
-        :param posts: The posts whose files to count.
-        :return: The total size of the files in the posts in bytes.
+        :param post_: The post whose file was to be downloaded.
+        :param status: One of the `OUTCOME_` constants.
+        :param path: Where the file was saved, if it was downloaded or skipped
+                     by this downloader, as reported to the store.
+        :param error: The exception the job failed with, if it failed.
         """
-        return sum([post_.file.size for post_ in posts if post_.has_file])
+        self.post = post_
+        self.status = status
+        self.path = path
+        self.error = error
 
-    def __init__(self, downloaded_jobs, failed_jobs, skipped_jobs,
-                 remaining_jobs, elapsed):
+
+@six.python_2_unicode_compatible
+class DownloadResult:
+    """
+    Represents the outcome of a thread download.
+    """
+
+    def __init__(self, tally, elapsed, hosts=None, thumbnails=False):
         """
         Initialise a new download result.
 
-        :param downloaded_jobs: A list of posts that downloaded successfully.
-        :param failed_jobs: A list of posts that failed to download.
-        :param skipped_jobs: A list of posts that were skipped because the file
-                             already existed.
-        :param remaining_jobs: Jobs yet to be processed when the download was
-                               cancelled.
+        :param tally: The `Tally` of jobs by outcome: downloaded, failed,
+                      skipped because the file already existed or another
+                      process downloaded it, or remaining because the download
+                      was cancelled before they were done.
         :param elapsed: A timedelta representing the duration of the download.
+        :param hosts: The media `Host`s files were downloaded from, if several
+                      were used.
+        :param thumbnails: Whether the posts' thumbnails were downloaded rather
+                           than their files; each post's file is then its
+                           `Thumbnail`. Defaults to false.
         """
-        self.downloaded_bytes = self._posts_size(downloaded_jobs)
-        self.failed_bytes = self._posts_size(failed_jobs)
-        self.skipped_bytes = self._posts_size(skipped_jobs)
-        self.remaining_bytes = self._posts_size(remaining_jobs)
+        self.downloaded_bytes = tally.bytes[OUTCOME_DOWNLOADED]
+        self.failed_bytes = tally.bytes[OUTCOME_FAILED]
+        self.skipped_bytes = tally.bytes[OUTCOME_SKIPPED]
+        self.remaining_bytes = tally.bytes[OUTCOME_REMAINING]
         self.total_bytes = self.downloaded_bytes + \
             self.failed_bytes + \
             self.skipped_bytes + \
             self.remaining_bytes
 
-        self.downloaded_job_count = len(downloaded_jobs)
-        self.failed_job_count = len(failed_jobs)
-        self.skipped_job_count = len(skipped_jobs)
-        self.remaining_job_count = len(remaining_jobs)
+        self.downloaded_job_count = tally.counts[OUTCOME_DOWNLOADED]
+        self.failed_job_count = tally.counts[OUTCOME_FAILED]
+        self.skipped_job_count = tally.counts[OUTCOME_SKIPPED]
+        self.remaining_job_count = tally.counts[OUTCOME_REMAINING]
         self.total_jobs = self.downloaded_job_count + \
             self.failed_job_count + \
             self.skipped_job_count + \
             self.remaining_job_count
 
-        self.downloaded_jobs = downloaded_jobs
-        self.failed_jobs = failed_jobs
-        self.skipped_jobs = skipped_jobs
-        self.remaining_jobs = remaining_jobs
+        # None if only a summary was kept
+        self.failed_jobs = tally.posts(OUTCOME_FAILED)
+        self.latency = tally.latencies[OUTCOME_DOWNLOADED]
         self.elapsed = elapsed
+        self.hosts = hosts or []
+        self.thumbnails = thumbnails
 
     def __str__(self):
         """
@@ -112,9 +279,10 @@ class DownloadResult:
 
         :return: The download statistics as a human-readable string.
         """
-        string = '{0}/{1} jobs completed, {2} failed, {3} skipped{4}'.format(
+        string = '{0}/{1} {2} completed, {3} failed, {4} skipped{5}'.format(
             self.downloaded_job_count + self.skipped_job_count,
             self.total_jobs,
+            'thumbnails' if self.thumbnails else 'jobs',
             self.failed_job_count,
             self.skipped_job_count,
             os.linesep)
@@ -127,6 +295,85 @@ class DownloadResult:
             self.elapsed.total_seconds(),
             util.bytes_fmt(int((self.downloaded_bytes + self.skipped_bytes) //
                                self.elapsed.total_seconds())))
+        if self.latency.count:
+            string += os.linesep + 'Download times: 50% within {0}, 90% ' \
+                                   'within {1}, slowest {2}'.format(
+                                       stats.seconds_fmt(
+                                           self.latency.percentile(.5)),
+                                       stats.seconds_fmt(
+                                           self.latency.percentile(.9)),
+                                       stats.seconds_fmt(self.latency.max))
+        for host in self.hosts:
+            string += os.linesep + str(host)
+        for post_ in self.failed_jobs or []:
+            string += os.linesep + 'Failed: {0}'.format(
+                post_.file if post_.has_file else post_)
+        return string
+
+
+@six.python_2_unicode_compatible
+class Snapshot:
+    """
+    Represents the state of a download while it is running.
+    """
+
+    def __init__(self, queued, tally, elapsed, transferred, threads, workers,
+                 rate=None):
+        """
+        Initialise a new snapshot.
+
+        :param queued: The number of jobs not yet started.
+        :param tally: The `Tally` of jobs handled so far.
+        :param elapsed: The seconds since the download started.
+        :param transferred: The bytes received since the download started,
+                            including those of files still being downloaded.
+        :param threads: The number of threads the download should use.
+        :param workers: A tuple per running thread of its name, the post
+                        whose file it is downloading or None if it is idle,
+                        and the seconds it has been doing so.
+        :param rate: The most bytes to receive per second, if limited.
+        """
+        self.queued = queued
+        self.completed = tally.counts[OUTCOME_DOWNLOADED] + \
+            tally.counts[OUTCOME_SKIPPED] + \
+            tally.counts[OUTCOME_FAILED]
+        self.failed = tally.counts[OUTCOME_FAILED]
+        self.elapsed = elapsed
+        self.transferred = transferred
+        self.threads = threads
+        self.workers = workers
+        self.rate = rate
+
+    @property
+    def in_progress(self):
+        """
+        Get the number of files being downloaded.
+
+        :return: The number of threads that are not idle.
+        """
+        return sum(1 for _, post_, _ in self.workers if post_ is not None)
+
+    def __str__(self):
+        """
+        Get a formatted representation of this snapshot.
+
+        :return: The state of the download as a human-readable string.
+        """
+        string = '{0} jobs queued, {1} in progress, {2} completed, {3} ' \
+                 'failed{4}'.format(self.queued, self.in_progress,
+                                    self.completed, self.failed, os.linesep)
+        string += '{0} received in {1} ({2}/s){3}'.format(
+            util.bytes_fmt(self.transferred), stats.seconds_fmt(self.elapsed),
+            util.bytes_fmt(int(self.transferred // self.elapsed)
+                           if self.elapsed else 0),
+            ', limited to {0}/s'.format(util.bytes_fmt(self.rate))
+            if self.rate else '')
+        string += os.linesep + '{0} threads running, {1} wanted'.format(
+            len(self.workers), self.threads)
+        for name, post_, seconds in self.workers:
+            string += os.linesep + '{0}: {1} for {2}'.format(
+                name, post_.file if post_ else 'idle',
+                stats.seconds_fmt(seconds))
         return string
 
 
@@ -136,7 +383,11 @@ class Downloader:
     simultaneously.
     """
 
-    def __init__(self, directory, name_fmt, parallelism=4):
+    def __init__(self, directory, name_fmt, parallelism=4, store_=None,
+                 output=None, session=None, queue=None, cache=True,
+                 fsync=FSYNC_NONE, mirrors_=None, thumbnails=False,
+                 cancellation=None, summary_only=False, timeline_=None,
+                 throttle=None):
         """
         Initialise a new downloader instance. Instances should not be reused.
 
@@ -145,20 +396,178 @@ class Downloader:
         :param parallelism: The maximum number of threads to use to download
                             files per CPU. E.g. parallelism of 4 on a quad core
                             results in 16 threads.
+        :param store_: A `Store` to record the outcome of each file in, if
+                       any.
+        :param output: Where to save files instead of directly in
+                       `directory`, if anywhere: an `Archive` or a
+                       `ContentDirectory`. It is not closed.
+        :param session: A transport for all threads to share, e.g. so
+                        connections are reused between downloaders. Its
+                        connection pool should hold at least as many
+                        connections as there are threads. By default, each
+                        thread creates its own with
+                        `transport.create()`.
+        :param queue: The queue to take jobs from, e.g. an `SQLiteQueue` to
+                      share files with other processes. It is not closed.
+                      Defaults to a new `MemoryQueue`.
+        :param cache: Whether the OS may keep files saved in `directory` in
+                      its page cache. Defaults to true.
+        :param fsync: When to flush files saved in `directory` to disk, one of
+                      `FSYNC_MODES`. Defaults to `FSYNC_NONE`. Files are
+                      renamed into place once complete whatever the mode; this
+                      only matters if the machine loses power.
+        :param mirrors_: The `Mirrors` to download files from instead of
+                         `file.MEDIA_ROOT`, if any. A file that fails part way
+                         through because of its host is retried on another.
+        :param thumbnails: Whether to download each post's thumbnail rather
+                           than its file, e.g. to preview a thread quickly.
+                           Thumbnails are always saved in `directory`, and are
+                           not recorded in `store_`. Defaults to false.
+        :param cancellation: The `Cancellation` to cancel the download with,
+                             e.g. one shared with other downloaders to cancel
+                             them together. Defaults to a new one, also
+                             cancelled by `cancel()`.
+        :param summary_only: Whether to only count failed jobs, rather than
+                             keep their posts for the result to list, so
+                             memory use does not grow with the number of files.
+                             Other jobs are only ever counted. Defaults to
+                             false.
+        :param timeline_: The `Timeline` to record what each thread spends its
+                          time on in, if any, e.g. one shared with other
+                          downloaders.
+        :param throttle: The `Throttle` to limit the rate files are received
+                         at with, e.g. one shared with other downloaders so
+                         the limit applies to them together. Defaults to a
+                         new one, without a limit.
+        :raises ValueError: If thumbnails are to be downloaded with a store or
+                            output.
         """
+        if thumbnails and (store_ or output):
+            raise ValueError('Thumbnails can only be saved in a directory')
         self._directory = directory
+        self._store = store_
+        self._output = output
+        self._session = session
+        self._cache = cache
+        self._fsync = fsync
+        self._mirrors = mirrors_
+        self._thumbnails = thumbnails
+        self.cancellation = cancellation or Cancellation()
+        self.throttle = throttle or Throttle()
         self._name_fmt = name_fmt
         self._threads = multiprocessing.cpu_count() * parallelism
-        self._queue = collections.deque()
+        self._queue = queue if queue is not None else jobs.MemoryQueue()
+
+        # guards the queue while it is being fed from an iterator, letting
+        # idle threads wait for more jobs rather than exiting
+        self._queue_condition = threading.Condition()
+        self._feeding = False
+        self._queued = 0
+
+        self._tally = stats.Tally(() if summary_only else (OUTCOME_FAILED,))
+        self._timeline = timeline_
+
+        # guards the thread pool, which can be resized while downloading
+        self._pool_lock = threading.Lock()
+        # the threads launched, or None unless downloading
+        self._pool = None
+        # thread name -> the post it is downloading, or None if idle, and
+        # since when, for each thread still running
+        self._workers = {}
+        # when the download started, and how many bytes the throttle had
+        # counted by then
+        self._started = None
+        self._transferred = 0
+
+        # thread ident -> paths of files written but not yet flushed to disk
+        self._unsynced_lock = threading.Lock()
+        self._unsynced = {}
+
+        # receives an `Outcome` for each job while `as_completed()` is iterated
+        self._outcomes = None
+
+        # the `DownloadResult`, once the download has finished
+        self.result = None
+
+    def cancel(self):
+        """
+        Cancel the download, e.g. from another thread: no further jobs are
+        started, and files being downloaded are abandoned and reported as
+        remaining. Other downloaders are unaffected unless they share this
+        one's `Cancellation`.
+        """
+        self.cancellation.cancel()
+
+    def resize(self, parallelism):
+        """
+        Change the number of threads downloading files, e.g. from another
+        thread while downloading. Threads are added straight away; surplus
+        threads stop once they have finished their current file, so no
+        transfer is interrupted.
 
-        self._downloaded_jobs_lock = threading.Lock()
-        self._downloaded_jobs = []
+        :param parallelism: The maximum number of threads to use per CPU, as
+                            for the constructor.
+        """
+        with self._pool_lock:
+            self._threads = multiprocessing.cpu_count() * parallelism
+            if self._pool is not None:
+                self._launch(self._threads - len(self._workers))
 
-        self._failed_jobs_lock = threading.Lock()
-        self._failed_jobs = []
+    def snapshot(self):
+        """
+        Describe the download while it runs, e.g. to report on a long one.
 
-        self._skipped_jobs_lock = threading.Lock()
-        self._skipped_jobs = []
+        :return: A `Snapshot`.
+        """
+        now = time.time()
+        with self._pool_lock:
+            workers = [(name, post_, now - since) for name, (post_, since)
+                       in sorted(self._workers.items())]
+            threads = self._threads
+        return Snapshot(len(self._queue), self._tally,
+                        now - (self._started or now),
+                        self.throttle.transferred - self._transferred, threads,
+                        workers, self.throttle.rate)
+
+    def _launch(self, count):
+        """
+        Start download threads. Call with `_pool_lock` held.
+
+        :param count: The number of threads to start.
+        """
+        target = functools.partial(Downloader.runner, self)
+        for _ in range(count):
+            thread = threading.Thread(target=target)
+            # counted as running straight away, so a resize does not launch
+            # more threads than wanted
+            self._workers[thread.name] = (None, time.time())
+            thread.start()
+            self._pool.append(thread)
+
+    def _work_on(self, post_):
+        """
+        Note what the calling thread is doing, for `snapshot()`.
+
+        :param post_: The post whose file it is downloading, or None if it is
+                      idle.
+        """
+        with self._pool_lock:
+            self._workers[threading.current_thread().name] = (post_,
+                                                              time.time())
+
+    def _retire(self, surplus=False):
+        """
+        Stop counting the calling thread as running.
+
+        :param surplus: Whether to only do so if more threads are running than
+                        wanted. Defaults to false.
+        :return: Whether the thread should stop.
+        """
+        with self._pool_lock:
+            if surplus and len(self._workers) <= self._threads:
+                return False
+            self._workers.pop(threading.current_thread().name, None)
+            return True
 
     # noinspection PyProtectedMember
     @staticmethod
@@ -168,14 +577,57 @@ class Downloader:
 
         :param downloader: The downloader instance the thread belongs to.
         """
-        session = requests.Session()
-        while not _interrupted:
-            try:
-                post_ = downloader._queue.popleft()
-                Downloader.handle(downloader, post_, session)
-            except IndexError:
-                # no items left to process - let function return
-                break
+        session = downloader._session or transport.create()
+        if downloader._mirrors:
+            session = mirrors.MirrorTransport(downloader._mirrors, session)
+        session = _CancellableTransport(session, downloader.cancellation,
+                                        downloader.throttle)
+        timeline.bind(downloader._timeline)
+        try:
+            while not downloader.cancellation.cancelled and \
+                    not downloader._retire(surplus=True):
+                timeline.mark(timeline.PHASE_IDLE)
+                downloader._work_on(None)
+                lease = downloader._next_job()
+                if lease is None:
+                    # no items left to process - let function return
+                    break
+                downloader._work_on(lease.post)
+                if Downloader.handle(downloader, lease.post, session):
+                    downloader._queue.ack(lease)
+                else:
+                    downloader._queue.release(lease)
+
+            if downloader._fsync == FSYNC_THREAD:
+                timeline.mark(timeline.PHASE_WRITING)
+                downloader._sync(threading.current_thread().ident)
+        finally:
+            downloader._retire()
+            timeline.bind(None)
+
+    def _next_job(self):
+        """
+        Lease the next job from the queue, waiting for one to be added if the
+        queue is still being fed, or for one leased by another worker to be
+        returned.
+
+        :return: The `Lease`, or None if there are no more jobs.
+        """
+        while True:
+            # claimed without holding the condition, as a shared queue may
+            # wait on its database, which would hold up the feeder
+            queued = self._queued
+            lease = self._queue.claim()
+            if lease:
+                return lease
+            with self._queue_condition:
+                if not (self._feeding or self._queue) or \
+                        self.cancellation.cancelled:
+                    return None
+                # nothing to wait for if a job was added while claiming; time
+                # out periodically to notice cancellation
+                if self._queued == queued:
+                    self._queue_condition.wait(.5)
 
     # noinspection PyProtectedMember
     @staticmethod
@@ -185,22 +637,117 @@ class Downloader:
 
         :param downloader: The downloader context.
         :param post_: The post to download.
-        :param session: The requests session to use for the download.
+        :param session: The transport to use for the download.
+        :return: True if the file was downloaded or skipped; false if it
+                 failed or the download was cancelled.
         """
+        if downloader._thumbnails:
+            post_ = _thumbnail_post(post_)
+        start = time.time()
         try:
-            name = downloader._name_fmt.format(**post_.__dict__)
-            existed = post_.file.save_to(downloader._directory, name,
-                                         session=session)
-            if existed:
-                with downloader._skipped_jobs_lock:
-                    downloader._skipped_jobs.append(post_)
-            else:
-                with downloader._downloaded_jobs_lock:
-                    downloader._downloaded_jobs.append(post_)
+            name = post_.format(downloader._name_fmt)
+            attempts = len(downloader._mirrors) if downloader._mirrors else 1
+            for attempt in range(attempts):
+                try:
+                    existed, path = Downloader._save(downloader, post_, name,
+                                                     session)
+                    break
+                except mirrors.HostError as e:
+                    if attempt + 1 == attempts:
+                        raise
+                    logger.warning('Failed to download %s: %s; retrying',
+                                   post_.file, e)
+            if downloader._thumbnails:
+                # only known once downloaded
+                post_.file.size = os.path.getsize(path)
+            downloader._tally.add(
+                OUTCOME_SKIPPED if existed else OUTCOME_DOWNLOADED, post_,
+                time.time() - start)
+            if downloader._store:
+                downloader._store.set_status(post_, store.STATUS_DOWNLOADED,
+                                             path)
+            downloader._report(Outcome(
+                post_, OUTCOME_SKIPPED if existed else OUTCOME_DOWNLOADED,
+                path))
+            return True
+        except Cancelled:
+            logger.debug('Abandoned %s', post_.file)
+            downloader._tally.add(OUTCOME_REMAINING, post_)
+            return False
         except IOError as e:
             logger.exception('Failed to write %s: %s', post_.file, str(e))
-            with downloader._failed_jobs_lock:
-                downloader._failed_jobs.append(post_)
+            downloader._tally.add(OUTCOME_FAILED, post_, time.time() - start)
+            if downloader._store:
+                downloader._store.set_status(post_, store.STATUS_FAILED)
+            downloader._report(Outcome(post_, OUTCOME_FAILED, error=e))
+            return False
+
+    def _report(self, outcome):
+        """
+        Pass the outcome of a job to `as_completed()`, if it is being iterated.
+
+        :param outcome: The `Outcome`.
+        """
+        if self._outcomes is not None:
+            self._outcomes.put(outcome)
+
+    # noinspection PyProtectedMember
+    @staticmethod
+    def _save(downloader, post_, name, session):
+        """
+        Save the file in a post where the downloader puts files.
+
+        :param downloader: The downloader context.
+        :param post_: The post to download.
+        :param name: The name to save the file under.
+        :param session: The transport to use for the download.
+        :return: A tuple of whether the file already existed, and its path.
+        :raises IOError: If the file could not be downloaded or saved.
+        """
+        if downloader._output:
+            existed = downloader._output.save(post_, name, session)
+            path = os.path.join(downloader._output.path, name)
+        else:
+            # files flushed later in a batch are dropped from the cache then,
+            # rather than each flushed on its own to drop it now
+            batched = downloader._fsync in (FSYNC_THREAD, FSYNC_END)
+            existed = post_.file.save_to(
+                downloader._directory, name, session=session,
+                cache=downloader._cache or batched,
+                fsync=downloader._fsync == FSYNC_FILE)
+            path = os.path.join(downloader._directory, name)
+            if not existed and batched:
+                with downloader._unsynced_lock:
+                    downloader._unsynced.setdefault(
+                        threading.current_thread().ident, []).append(path)
+        return existed, path
+
+    def _sync(self, ident=None):
+        """
+        Flush files written but not yet flushed to disk.
+
+        :param ident: The ident of the thread whose files to flush. Defaults
+                      to those of all threads.
+        """
+        with self._unsynced_lock:
+            if ident is None:
+                paths = [path for paths in self._unsynced.values()
+                         for path in paths]
+                self._unsynced.clear()
+            else:
+                paths = self._unsynced.pop(ident, [])
+        if paths:
+            logger.debug('Flushing %d files to disk', len(paths))
+            file.sync(paths, self._cache)
+
+    def _malformed(self, post_):
+        """
+        Count a post that could not be decoded as failed, rather than queue it.
+
+        :param post_: The `MalformedPost`.
+        """
+        self._tally.add(OUTCOME_FAILED, post_)
+        self._report(Outcome(post_, OUTCOME_FAILED, error=post_.error))
 
     def _queue_all(self, posts):
         """
@@ -208,73 +755,174 @@ class Downloader:
 
         :param posts: The posts to add.
         """
+        wanted = []
         for post_ in posts:
-            self._queue.append(post_)
+            if isinstance(post_, MalformedPost):
+                self._malformed(post_)
+            else:
+                wanted.append(post_)
+        self._queue.put_all(wanted)
+        self._queued += len(wanted)
+
+    def _feed(self, posts):
+        """
+        Add posts to the download queue as an iterable yields them, e.g. while
+        a thread is still being received. Runs on its own thread.
+
+        :param posts: The posts to add.
+        """
+        try:
+            for post_ in posts:
+                if self.cancellation.cancelled:
+                    break
+                if isinstance(post_, MalformedPost):
+                    self._malformed(post_)
+                    continue
+                with self._queue_condition:
+                    self._queue.put(post_)
+                    self._queued += 1
+                    self._queue_condition.notify()
+        except (ValueError, IOError) as e:
+            logger.error('Failed to read further posts: %s', e)
+        finally:
+            with self._queue_condition:
+                self._feeding = False
+                self._queue_condition.notify_all()
 
     def download(self, posts, interactive=False):
         """
         Download the files contained within a list of posts.
 
         :param posts: An iterable containing the posts to download. They will
-                      be downloaded in order.
+                      be downloaded in order. If it does not have a length,
+                      e.g. a `PostStream`, downloading starts immediately and
+                      posts are queued as the iterable yields them.
         :param interactive: Whether to print a progress bar that updates as
                             the thread is downloading, and display a message if
-                            the process is interrupted. Defaults to false.
+                            the download is cancelled. Defaults to false.
+        :return: The `DownloadResult`, also kept in `result`.
         """
-        global _interrupted
-        _interrupted = False
-
-        # populate the queue
-        self._queue_all(posts)
-        job_count = len(self._queue)
-
-        # don't launch more threads than files
-        threads = min(self._threads, len(self._queue))
+        start = datetime.datetime.now()
+        self._started = time.time()
+        if not self._output and os.path.isdir(self._directory):
+            file.remove_stale_parts(self._directory)
+        self._transferred = self.throttle.transferred
+        feeder = None
+        if hasattr(posts, '__len__'):
+            # populate the queue
+            self._queue_all(posts)
+
+            # don't launch more threads than files
+            threads = min(self._threads, len(self._queue))
+        else:
+            self._feeding = True
+            feeder = threading.Thread(target=self._feed, args=(posts,))
+            feeder.daemon = True
+            feeder.start()
+            threads = self._threads
         logger.debug('Will use %d threads for downloading', threads)
 
         # launch threads
-        thread_pool = []
-        target = functools.partial(Downloader.runner, self)
-        start = datetime.datetime.now()
-        for _ in range(threads):
-            thread = threading.Thread(target=target)
-            thread.start()
-            thread_pool.append(thread)
+        with self._pool_lock:
+            self._pool = []
+            self._launch(threads)
         logger.debug('All threads launched')
 
         if interactive:
             progress = Bar('Downloading',
-                           max=job_count,
+                           max=self._queued,
                            suffix='%(index)d/%(max)d - %(elapsed_td)s elapsed, '
                                   '%(eta_td)s remaining')
-            with _redirect_sigint():
-                while self._queue and not _interrupted:
-                    progress.goto(len(self._downloaded_jobs) +
-                                  len(self._failed_jobs) +
-                                  len(self._skipped_jobs))
-                    time.sleep(.5)
-
-        if interactive and _interrupted:
+            while (self._queue or self._feeding) and \
+                    not self.cancellation.cancelled:
+                progress.max = self._queued
+                progress.goto(len(self._tally))
+                time.sleep(.5)
+
+        if interactive and self.cancellation.cancelled:
             # the act of C-c does not print a line break; we do not want a
             # continuation of the previous line
-            print(os.linesep + 'Interrupted; waiting for download threads to '
-                               'finish their current jobs. This may take a few '
-                               'seconds.')
-
-        # wait for all threads to finish
-        for i in range(threads):
-            thread_pool[i].join()
+            print(os.linesep + 'Interrupted; abandoning downloads in progress.')
+
+        # wait for all threads to finish, including any added by a resize
+        while True:
+            with self._pool_lock:
+                if not self._pool:
+                    self._pool = None
+                    break
+                thread = self._pool.pop()
+            thread.join()
+        if feeder:
+            feeder.join()
+        self._sync()
         finish = datetime.datetime.now()
 
+        if self._store:
+            self._store.flush()
+
         if interactive:
             # complete the progress bar if the queue is empty
             if not self._queue:
                 # noinspection PyUnboundLocalVariable
-                progress.goto(job_count)
+                progress.max = self._queued
+                progress.goto(self._queued)
             progress.finish()
 
-        return DownloadResult(self._downloaded_jobs,
-                              self._failed_jobs,
-                              self._skipped_jobs,
-                              list(self._queue),
-                              finish - start)
+        for post_ in self._queue.done_elsewhere():
+            self._tally.add(OUTCOME_SKIPPED, post_)
+            self._report(Outcome(post_, OUTCOME_SKIPPED))
+        for post_ in self._queue.pending():
+            self._tally.add(OUTCOME_REMAINING, _thumbnail_post(post_)
+                            if self._thumbnails else post_)
+        self.result = DownloadResult(
+            self._tally, finish - start,
+            self._mirrors.hosts if self._mirrors else None, self._thumbnails)
+        return self.result
+
+    def as_completed(self, posts):
+        """
+        Download the files contained within a list of posts, yielding the
+        outcome of each job as soon as it is handled, so callers can e.g.
+        index or upload files while others are still downloading. Outcomes are
+        yielded in the order jobs finish, not the order of `posts`. Once the
+        iterator is exhausted, the overall `DownloadResult` is in `result`.
+
+        The download runs on a background thread. If the iterator is closed
+        before it is exhausted, e.g. by breaking out of a loop over it, the
+        download is cancelled, and has stopped once `close()` returns.
+
+        :param posts: An iterable containing the posts to download, as for
+                      `download()`.
+        :return: An iterator of `Outcome`s.
+        :raises Exception: Whatever the download raised, once every outcome
+                           before it has been yielded.
+        """
+        self._outcomes = queue_.Queue()
+        done = object()
+        failure = []
+
+        def run():
+            try:
+                self.download(posts)
+            except BaseException:
+                failure.append(sys.exc_info())
+            finally:
+                self._outcomes.put(done)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                outcome = self._outcomes.get()
+                if outcome is done:
+                    break
+                yield outcome
+        except GeneratorExit:
+            self.cancel()
+            thread.join()
+            raise
+        thread.join()
+        if failure:
+            six.reraise(*failure[0])
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+The queues a `Downloader` takes its jobs from. Jobs are leased from a queue
+and acknowledged once handled, so a queue shared between processes, possibly
+on different hosts, can hand each file to exactly one of them.
+"""
+from __future__ import unicode_literals
+
+import collections
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+# how long to wait for another process to release the database, in seconds
+_BUSY_TIMEOUT = 30
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queue (
+    md5 TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    owner TEXT,
+    expires REAL
+);
+'''
+
+# the files put by this worker and not yet resolved; private to its connection
+_WORKER_SCHEMA = '''
+CREATE TEMP TABLE mine (
+    md5 TEXT PRIMARY KEY,
+    claimed INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+# the number of files leased by a single claim, so a worker does not write to
+# the database for every file, but also does not hold more files than it is
+# about to download
+_CLAIM_BATCH = 8
+
+_PENDING = 'pending'
+_LEASED = 'leased'
+_DONE = 'done'
+
+logger = logging.getLogger(__name__)
+
+
+class Lease:
+    """
+    A job taken from a queue, which must be acknowledged or released once the
+    job has been handled.
+    """
+
+    def __init__(self, post_):
+        """
+        Initialise a new lease.
+
+        :param post_: The post whose file is to be downloaded.
+        """
+        self.post = post_
+
+
+class MemoryQueue:
+    """
+    A queue private to a single downloader. Leases never expire, and there
+    are no other workers to share jobs with.
+    """
+
+    def __init__(self):
+        self._posts = collections.deque()
+
+    def put(self, post_):
+        """
+        Add a post whose file is to be downloaded.
+
+        :param post_: The post.
+        """
+        self._posts.append(post_)
+
+    def put_all(self, posts):
+        """
+        Add many posts whose files are to be downloaded.
+
+        :param posts: A list of posts.
+        """
+        self._posts.extend(posts)
+
+    def claim(self):
+        """
+        Lease the next job. Safe to call from many threads.
+
+        :return: A `Lease`, or None if no job is available.
+        """
+        try:
+            return Lease(self._posts.popleft())
+        except IndexError:
+            return None
+
+    def ack(self, lease):
+        """
+        Record that a leased job has been done.
+
+        :param lease: The lease.
+        """
+
+    def release(self, lease):
+        """
+        Give up a leased job without doing it, e.g. because it failed.
+
+        :param lease: The lease.
+        """
+
+    def pending(self):
+        """
+        Get the jobs not yet claimed.
+
+        :return: A list of posts.
+        """
+        return list(self._posts)
+
+    def done_elsewhere(self):
+        """
+        Get the jobs that were put but then done by another worker.
+
+        :return: A list of posts.
+        """
+        return []
+
+    def close(self):
+        """
+        Release any resources held by the queue.
+        """
+
+    def __len__(self):
+        return len(self._posts)
+
+
+class SQLiteQueue:
+    """
+    A queue in an SQLite database shared by several downloaders, possibly in
+    different processes or on different hosts, e.g. archiving the same board.
+    Files are identified by checksum, so each is downloaded once, by whichever
+    worker claims it first. Leases are renewed in the background while a
+    worker is alive; if it dies, they expire and the file is returned to the
+    queue for another worker to claim.
+
+    Workers only claim files they have put themselves, so each saves files
+    where it expects them. A file done by another worker is not downloaded
+    again, and is reported by `done_elsewhere()`. A file this worker put for
+    several posts, e.g. a repost, is saved for each of them: the first claim
+    leases the file, and the others are claimed once this worker has done it.
+
+    The database does not use write-ahead logging, so it can be placed on a
+    network filesystem shared between hosts.
+    """
+
+    def __init__(self, path, lease_time=60):
+        """
+        Open a queue, creating it if necessary.
+
+        :param path: The path of the database file.
+        :param lease_time: The number of seconds a lease lasts without being
+                           renewed. Defaults to 60.
+        :raises sqlite3.Error: If the database could not be opened.
+        """
+        self._connection = sqlite3.connect(path, timeout=_BUSY_TIMEOUT,
+                                           check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        self._connection.executescript(_WORKER_SCHEMA)
+        self._lock = threading.Lock()
+        self._lease_time = lease_time
+
+        # identifies this worker's leases in the database
+        self.owner = '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(),
+                                          uuid.uuid4().hex[:8])
+
+        # posts put by this worker that are neither claimed nor resolved, by
+        # checksum, in the order they were put
+        self._waiting = collections.OrderedDict()
+        # posts whose files are leased to this worker, waiting to be claimed
+        self._ready = collections.deque()
+        self._length = 0
+        self._elsewhere = []
+
+        self._closed = threading.Event()
+        self._renewer = threading.Thread(target=self._renew_all)
+        self._renewer.daemon = True
+        self._renewer.start()
+
+    def put(self, post_):
+        """
+        Add a post whose file is to be downloaded. If another worker has
+        already put the same file, this worker may still claim it if that
+        worker does not.
+
+        :param post_: The post.
+        """
+        self.put_all([post_])
+
+    def put_all(self, posts):
+        """
+        Add many posts whose files are to be downloaded, in a single
+        transaction.
+
+        :param posts: A list of posts.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO queue (md5, state) VALUES (?, ?)',
+                [(post_.file.md5, _PENDING) for post_ in posts])
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO mine (md5) VALUES (?)',
+                [(post_.file.md5,) for post_ in posts])
+            for post_ in posts:
+                self._waiting.setdefault(post_.file.md5, []).append(post_)
+            self._length += len(posts)
+
+    def claim(self):
+        """
+        Lease the next file that is neither done nor leased by an unexpired
+        lease. Several files are leased at once, and handed out by later
+        calls. Files leased by other workers are retried on later calls, in
+        case their leases expire.
+
+        :return: A `Lease`, or None if no file is available right now.
+        """
+        with self._lock:
+            if not self._ready:
+                self._claim_batch()
+            if not self._ready:
+                self._resolve()
+            if not self._ready:
+                return None
+            self._length -= 1
+            return Lease(self._ready.popleft())
+
+    def _claim_batch(self):
+        """
+        Lease up to `_CLAIM_BATCH` of the files put by this worker that are
+        pending or whose leases have expired, oldest first, in a single
+        statement. The first post waiting for each file becomes ready; any
+        others wait for this worker to finish the file. The lock must be
+        held.
+        """
+        now = time.time()
+        expires = now + self._lease_time
+        with self._connection:
+            claimed = self._connection.execute(
+                'UPDATE queue SET state = ?, owner = ?, expires = ? '
+                'WHERE md5 IN (SELECT queue.md5 FROM mine '
+                'JOIN queue ON queue.md5 = mine.md5 '
+                'WHERE NOT mine.claimed AND (queue.state = ? OR '
+                '(queue.state = ? AND queue.expires < ?)) '
+                'ORDER BY mine.rowid LIMIT ?)',
+                (_LEASED, self.owner, expires, _PENDING, _LEASED, now,
+                 _CLAIM_BATCH)).rowcount
+            if not claimed:
+                return
+            # the new leases are the only ones expiring at this instant;
+            # renewals cannot run until the lock is released
+            md5s = [row[0] for row in self._connection.execute(
+                'SELECT queue.md5 FROM queue '
+                'JOIN mine ON mine.md5 = queue.md5 '
+                'WHERE queue.owner = ? AND queue.state = ? '
+                'AND queue.expires = ? ORDER BY mine.rowid',
+                (self.owner, _LEASED, expires))]
+
+            handed_out = []
+            for md5 in md5s:
+                posts = self._waiting[md5]
+                self._ready.append(posts.pop(0))
+                if not posts:
+                    del self._waiting[md5]
+                    handed_out.append((md5,))
+            self._connection.executemany(
+                'UPDATE mine SET claimed = 1 WHERE md5 = ?',
+                [(md5,) for md5 in md5s])
+            self._connection.executemany('DELETE FROM mine WHERE md5 = ?',
+                                         handed_out)
+
+    def _resolve(self):
+        """
+        Check on the files put by this worker that could not be claimed. Posts
+        whose files this worker has done become ready, as this worker saves
+        each file for every post it put it for; files done by other workers
+        are not downloaded again. The lock must be held.
+        """
+        if not self._waiting:
+            return
+
+        resolved = []
+        for md5, state, owner in self._connection.execute(
+                'SELECT mine.md5, queue.state, queue.owner FROM mine '
+                'LEFT JOIN queue ON queue.md5 = mine.md5').fetchall():
+            if state not in (None, _DONE):
+                # leased, by this worker for another post, or by another
+                # worker whose lease may yet expire
+                continue
+            posts = self._waiting.pop(md5, [])
+            if owner == self.owner:
+                self._ready.extend(posts)
+            else:
+                for post_ in posts:
+                    logger.debug('%s was downloaded by another worker',
+                                 post_.file)
+                self._elsewhere.extend(posts)
+                self._length -= len(posts)
+            resolved.append((md5,))
+
+        with self._connection:
+            self._connection.executemany('DELETE FROM mine WHERE md5 = ?',
+                                         resolved)
+
+    def renew(self):
+        """
+        Extend all leases held by this worker. This happens automatically in
+        the background.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE queue SET expires = ? WHERE owner = ? AND state = ?',
+                (time.time() + self._lease_time, self.owner, _LEASED))
+
+    def _renew_all(self):
+        """
+        Renew leases well before they expire until the queue is closed. Runs
+        on its own thread.
+        """
+        while not self._closed.wait(self._lease_time / 3.0):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.warning('Failed to renew leases: %s', e)
+
+    def ack(self, lease):
+        """
+        Record that a file has been downloaded, so no other worker downloads
+        it again. The file stays owned by this worker, which saves it for any
+        other post it put it for.
+
+        :param lease: The lease.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE queue SET state = ?, owner = ?, expires = NULL '
+                'WHERE md5 = ?', (_DONE, self.owner, lease.post.file.md5))
+
+    def release(self, lease):
+        """
+        Return a file to the queue without downloading it, e.g. because the
+        download failed, so another worker can try. This worker will not.
+
+        :param lease: The lease.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE queue SET state = ?, owner = NULL, expires = NULL '
+                'WHERE md5 = ? AND owner = ? AND state = ?',
+                (_PENDING, lease.post.file.md5, self.owner, _LEASED))
+
+    def pending(self):
+        """
+        Get the files put by this worker that have not been resolved.
+
+        :return: A list of posts.
+        """
+        with self._lock:
+            return list(self._ready) + [post_ for posts in
+                                        self._waiting.values()
+                                        for post_ in posts]
+
+    def done_elsewhere(self):
+        """
+        Get the files put by this worker that another worker downloaded.
+
+        :return: A list of posts.
+        """
+        with self._lock:
+            return list(self._elsewhere)
+
+    def close(self):
+        """
+        Stop renewing leases, return any still held to the queue, and close
+        the database. Further calls do nothing.
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._renewer.join()
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'UPDATE queue SET state = ?, owner = NULL, expires = NULL '
+                    'WHERE owner = ? AND state = ?',
+                    (_PENDING, self.owner, _LEASED))
+            self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._length
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental decoding of large JSON documents, yielding the elements of an
+array as soon as each has been received, rather than waiting for the whole
+document.
+"""
+from __future__ import unicode_literals
+
+import codecs
+import json
+import re
+import six
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+_DECODER = json.JSONDecoder()
+
+
+class _Reader:
+    """
+    A cursor over JSON text arriving in chunks.
+    """
+
+    def __init__(self, chunks):
+        """
+        Initialise a new reader.
+
+        :param chunks: An iterable of bytestrings containing UTF-8 encoded
+                       JSON, e.g. `response.iter_content()`.
+        """
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._text = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """
+        Append the next chunk to the buffer, discarding consumed text.
+
+        :return: False if there was no more input, otherwise true.
+        """
+        if self._eof:
+            return False
+
+        try:
+            chunk = self._decoder.decode(next(self._chunks))
+        except StopIteration:
+            chunk = self._decoder.decode(b'', final=True)
+            self._eof = True
+
+        self._text = self._text[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and look at the next character without consuming it.
+
+        :return: The character, or None at the end of the input.
+        """
+        while True:
+            self._pos = _WHITESPACE.match(self._text, self._pos).end()
+            if self._pos < len(self._text):
+                return self._text[self._pos]
+            if not self._fill():
+                return None
+
+    def expect(self, char):
+        """
+        Consume the next non-whitespace character, which must be `char`.
+
+        :param char: The expected character.
+        :raises ValueError: If a different character, or the end of the input,
+                            was found.
+        """
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected {0!r} at position {1}, found {2}'.format(
+                char, self._pos,
+                'end of input' if found is None else repr(found)))
+        self._pos += 1
+
+    def value(self):
+        """
+        Decode and consume the next complete JSON value.
+
+        :return: The decoded value.
+        :raises ValueError: If the input is not valid JSON.
+        """
+        if self.peek() is None:
+            raise ValueError('Unexpected end of input')
+
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._text, self._pos)
+            except ValueError:
+                # either malformed or not fully received yet
+                if not self._fill():
+                    raise
+                continue
+
+            # a number or literal at the end of the buffer may be cut short
+            # (`12` of `123`); only accept it once something follows it
+            if not isinstance(value, (dict, list, six.string_types)) and \
+                    _WHITESPACE.match(self._text, end).end() == \
+                    len(self._text) and self._fill():
+                continue
+
+            self._pos = end
+            return value
+
+
+def iter_array(chunks, key=None):
+    """
+    Yield the elements of a JSON array as they are received.
+
+    :param chunks: An iterable of bytestrings containing UTF-8 encoded JSON,
+                   e.g. `response.iter_content()`.
+    :param key: If the document is an object, the name of the member holding
+                the array, e.g. 'posts' for a thread. If None, the document
+                itself must be the array, as with a catalog.
+    :return: A generator of decoded elements.
+    :raises ValueError: If the JSON is malformed, or `key` is not found.
+    """
+    reader = _Reader(chunks)
+
+    if key is not None:
+        reader.expect('{')
+        while True:
+            if reader.peek() == '}':
+                raise ValueError('Member {0!r} not found'.format(key))
+            name = reader.value()
+            reader.expect(':')
+            if name == key:
+                break
+            reader.value()  # skip over members we aren't interested in
+            if reader.peek() == ',':
+                reader.expect(',')
+
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+
+    while True:
+        yield reader.value()
+        if reader.peek() == ']':
+            return
+        reader.expect(',')
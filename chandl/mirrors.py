@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Spreading file downloads across several hosts serving the same media, e.g.
+4chan's CDN edges. Each host's latency is tracked as an exponentially
+weighted moving average; requests go to the fastest healthy host, and hosts
+that fail are left alone for a while, with requests failing over to the next.
+"""
+from __future__ import unicode_literals, division
+
+import io
+import logging
+import threading
+import time
+import six
+
+from chandl import util, transport
+from chandl.model import file
+
+
+# the weight given to each new latency measurement
+_ALPHA = .3
+
+# how long a host is avoided after its first consecutive error, in seconds;
+# this doubles with each further error, up to `_MAX_COOLDOWN`
+_COOLDOWN = 5
+_MAX_COOLDOWN = 300
+
+logger = logging.getLogger(__name__)
+
+
+class HostError(IOError):
+    """
+    Raised when a download fails because of the host it was from, so it may
+    succeed from another.
+    """
+
+
+@six.python_2_unicode_compatible
+class Host:
+    """
+    A host serving media files, and what has been seen of it.
+    """
+
+    def __init__(self, root):
+        """
+        Initialise a new host.
+
+        :param root: The URL files are served from, in the form of
+                     `file.MEDIA_ROOT`, e.g. 'https://i.4cdn.org'.
+        """
+        self.root = root.rstrip('/')
+        self.latency = None
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.consecutive_errors = 0
+        self.down_until = 0
+
+    def healthy(self, now=None):
+        """
+        Find whether requests may be sent to this host.
+
+        :param now: The current time. Defaults to `time.time()`.
+        :return: True if it has not failed recently.
+        """
+        return (now or time.time()) >= self.down_until
+
+    def __str__(self):
+        return '{0}: {1} requests, {2} errors, {3} downloaded{4}'.format(
+            self.root, self.requests, self.errors, util.bytes_fmt(self.bytes),
+            '' if self.latency is None else
+            ', {0:.0f} ms latency'.format(self.latency * 1000))
+
+
+class Mirrors:
+    """
+    A set of hosts serving the same files, choosing between them. Safe to use
+    from many threads.
+    """
+
+    def __init__(self, roots):
+        """
+        Initialise a new set of hosts.
+
+        :param roots: The hosts' URLs, in order of preference until their
+                      latency is known.
+        :raises ValueError: If no hosts are given.
+        """
+        if not roots:
+            raise ValueError('At least one media host is required')
+        self.hosts = [Host(root) for root in roots]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def choose(self, exclude=()):
+        """
+        Choose the host to send a request to: the healthy host with the lowest
+        latency, trying each host once before its latency is known. If every
+        host is unhealthy, the one due to recover first.
+
+        :param exclude: Hosts not to choose, e.g. those that already failed
+                        the request. Ignored if every host is excluded.
+        :return: The `Host`.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [host for host in self.hosts
+                          if host not in exclude] or self.hosts
+            healthy = [host for host in candidates if host.healthy(now)]
+            if not healthy:
+                return min(candidates, key=lambda host: host.down_until)
+            return min(healthy, key=lambda host: host.latency or 0)
+
+    def succeeded(self, host, latency):
+        """
+        Record a response from a host.
+
+        :param host: The `Host`.
+        :param latency: The seconds until the response's headers arrived.
+        """
+        with self._lock:
+            host.requests += 1
+            host.consecutive_errors = 0
+            host.down_until = 0
+            host.latency = latency if host.latency is None else \
+                _ALPHA * latency + (1 - _ALPHA) * host.latency
+
+    def failed(self, host, request=True):
+        """
+        Record an error from a host, avoiding it for a while.
+
+        :param host: The `Host`.
+        :param request: Whether the error was in response to a new request,
+                        rather than while reading the body of one already
+                        counted.
+        """
+        with self._lock:
+            if request:
+                host.requests += 1
+            host.errors += 1
+            host.consecutive_errors += 1
+            cooldown = min(_COOLDOWN * 2 ** (host.consecutive_errors - 1),
+                           _MAX_COOLDOWN)
+            host.down_until = time.time() + cooldown
+        logger.info('Avoiding %s for %d seconds', host.root, cooldown)
+
+    def received(self, host, bytes_):
+        """
+        Record data received from a host.
+
+        :param host: The `Host`.
+        :param bytes_: The number of bytes.
+        """
+        with self._lock:
+            host.bytes += bytes_
+
+
+class _Body(io.RawIOBase):
+    """
+    The body of a response from a mirror, counting the bytes received and
+    blaming the mirror if reading fails.
+    """
+
+    def __init__(self, raw, mirrors, host):
+        """
+        Initialise a new body.
+
+        :param raw: The body being read.
+        :param mirrors: The `Mirrors` to record what happens in.
+        :param host: The `Host` the body is from.
+        """
+        super(_Body, self).__init__()
+        self._raw = raw
+        self._mirrors = mirrors
+        self._host = host
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer_):
+        try:
+            read = self._raw.readinto(buffer_)
+        except Exception as e:  # e.g. urllib3's errors are not IOErrors
+            self._mirrors.failed(self._host, False)
+            raise HostError('Failed to read from {0}: {1}'.format(
+                self._host.root, e))
+        self._mirrors.received(self._host, read or 0)
+        return read
+
+    def close(self):
+        self._raw.close()
+        super(_Body, self).close()
+
+
+class MirrorTransport:
+    """
+    A transport sending requests for media files to the best of several
+    hosts, failing over to the others if a host cannot be reached or returns
+    a server error. Other requests are sent unchanged.
+    """
+
+    def __init__(self, mirrors, transport_=None):
+        """
+        Initialise a new mirror transport.
+
+        :param mirrors: The `Mirrors` to choose between.
+        :param transport_: The transport to send requests with. Defaults to
+                           `transport.create()`.
+        """
+        self._mirrors = mirrors
+        self._transport = transport_ or transport.create()
+
+    def _path(self, url):
+        """
+        Find the path of a media file on any host.
+
+        :param url: The URL requested.
+        :return: The path, starting with a slash, or None if the URL is not
+                 of a media file.
+        """
+        for root in [file.MEDIA_ROOT] + [host.root
+                                         for host in self._mirrors.hosts]:
+            if url.startswith(root + '/'):
+                return url[len(root):]
+        return None
+
+    def get(self, url, stream=False):
+        """
+        Send a GET request, to the best host if it is for a media file.
+
+        :param url: The URL to request.
+        :param stream: Whether to stream the body; always true for media.
+        :return: The response.
+        :raises HostError: If the request failed on every host.
+        """
+        path = self._path(url)
+        if path is None:
+            return self._transport.get(url, stream=stream)
+
+        tried = []
+        while True:
+            host = self._mirrors.choose(tried)
+            tried.append(host)
+            mirror_url = host.root + path
+            start = time.time()
+            try:
+                response = self._transport.get(mirror_url, stream=True)
+            except IOError as e:
+                error = e
+            else:
+                if response.status_code < 500:
+                    self._mirrors.succeeded(host, time.time() - start)
+                    return transport.Response(
+                        mirror_url, response.status_code,
+                        _Body(response.raw, self._mirrors, host))
+                response.close()
+                error = 'status {0}'.format(response.status_code)
+
+            self._mirrors.failed(host)
+            if len(tried) == len(self._mirrors):
+                raise HostError('Request to every media host failed; last '
+                                'error from {0}: {1}'.format(host.root, error))
+            logger.warning('Request to %s failed (%s); failing over',
+                           host.root, error)
@@ -4,12 +4,14 @@ from __future__ import unicode_literals
 import logging
 import os
 import binascii
-import base64
+import hashlib
+import tempfile
+import threading
+import time
 import six
 import requests
-import shutil
 
-from chandl import util
+from chandl import util, timeline, transport
 
 
 TYPE_VIDEO = ['webm', 'gif']
@@ -21,9 +23,192 @@ _FILTERS = {
     'images': TYPE_IMAGE
 }
 
+# how much of a file to read from the network at a time; the size of each
+# thread's download buffer
+_CHUNK_SIZE = 64 * 1024
+
+# each thread's download buffer
+_buffers = threading.local()
+
+# unavailable on some platforms, and in Python 2
+_fallocate = getattr(os, 'posix_fallocate', None)
+_fadvise = getattr(os, 'posix_fadvise', None)
+
+# where media files are served from; overridable for testing
+MEDIA_ROOT = 'https://i.4cdn.org'
+
+# the suffix of files still being downloaded
+_PART_SUFFIX = '.part'
+
+# how long a file must have been left untouched, in seconds, before
+# `remove_stale_parts()` takes it for one abandoned by a killed run, rather
+# than one another process sharing the directory is still writing
+_STALE_PART_AGE = 60 * 60
+
 logger = logging.getLogger(__name__)
 
 
+def preallocate(handle, size):
+    """
+    Reserve space for a file about to be written, so the filesystem can lay it
+    out in one piece rather than growing it a chunk at a time. Does nothing
+    where unsupported. The file should be truncated once written, in case it
+    turns out smaller.
+
+    :param handle: The binary file object, open on an empty file.
+    :param size: The number of bytes that will be written.
+    """
+    if not _fallocate or not size:
+        return
+    try:
+        _fallocate(handle.fileno(), 0, size)
+    except OSError as e:
+        # e.g. the filesystem does not support it
+        logger.debug('Failed to preallocate %d bytes: %s', size, e)
+
+
+def _advise_dontneed(fd):
+    """
+    Advise the OS that a file will not be read again soon. Only pages already
+    written to disk are dropped from the page cache.
+
+    :param fd: The file descriptor.
+    """
+    try:
+        _fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError as e:
+        logger.debug('Failed to drop cached pages: %s', e)
+
+
+def drop_cache(handle, sync=True):
+    """
+    Write a file to disk and advise the OS that it will not be read again
+    soon, so it does not displace more useful data from the page cache. Does
+    nothing where unsupported. To flush many files at once instead, leave
+    their pages cached, and drop them with `sync()`.
+
+    :param handle: The binary file object, once fully written.
+    :param sync: Whether to write the file to disk first, as only pages on
+                 disk can be dropped. Pass false if it was just flushed.
+                 Defaults to true.
+    """
+    if not _fadvise:
+        return
+    handle.flush()
+    if sync:
+        try:
+            os.fdatasync(handle.fileno())
+        except OSError as e:
+            logger.debug('Failed to drop cached pages: %s', e)
+            return
+    _advise_dontneed(handle.fileno())
+
+
+def remove_stale_parts(directory, age=_STALE_PART_AGE):
+    """
+    Remove the partial files a killed run left behind in a directory and its
+    subdirectories, which `File.save_to()` cannot tell apart from its own.
+
+    :param directory: The directory files were saved in.
+    :param age: How long a partial file must have been left untouched, in
+                seconds, to be removed. Defaults to an hour.
+    :return: The number of files removed.
+    """
+    removed = 0
+    cutoff = time.time() - age
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if not (name.startswith('.') and name.endswith(_PART_SUFFIX)):
+                continue
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError as e:
+                # e.g. finished by another process meanwhile
+                logger.debug('Failed to remove %s: %s', path, e)
+    if removed:
+        logger.info('Removed %d partial files left by an earlier run from %s',
+                    removed, directory)
+    return removed
+
+
+def _sync_directory(directory):
+    """
+    Flush a directory's entries to disk, so files renamed into it survive a
+    power loss.
+
+    :param directory: The directory.
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError as e:
+        # e.g. Windows, where directories cannot be opened
+        logger.debug('Failed to open %s to sync it: %s', directory, e)
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        logger.debug('Failed to sync %s: %s', directory, e)
+    finally:
+        os.close(fd)
+
+
+def sync(paths, cache=True):
+    """
+    Flush files already written and closed to disk, along with the
+    directories containing them. Syncing many files at once lets the OS write
+    them out together, rather than waiting on the disk after each one.
+
+    :param paths: The paths of the files.
+    :param cache: Whether the OS may keep the files in its page cache once
+                  flushed. Defaults to true; see `drop_cache()`.
+    """
+    directories = set()
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                if not cache and _fadvise:
+                    _advise_dontneed(fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.warning('Failed to sync %s: %s', path, e)
+        directories.add(os.path.dirname(path))
+    for directory in directories:
+        _sync_directory(directory)
+
+
+def _copy(raw, handle):
+    """
+    Copy a response body to a file, hashing it on the way. The body is read
+    into the calling thread's buffer rather than returned as a new bytes
+    object per chunk, though it may still allocate internally, e.g. while
+    decoding.
+
+    :param raw: The body, a binary file object.
+    :param handle: The binary file object to write to.
+    :return: The hex MD5 digest of the data copied.
+    """
+    buffer_ = getattr(_buffers, 'buffer', None)
+    if buffer_ is None:
+        buffer_ = _buffers.buffer = bytearray(_CHUNK_SIZE)
+    view = memoryview(buffer_)
+
+    hash_ = hashlib.md5()
+    timeline.mark(timeline.PHASE_TRANSFERRING)
+    while True:
+        read = raw.readinto(buffer_)
+        if not read:
+            timeline.mark(timeline.PHASE_WRITING)
+            return hash_.hexdigest()
+        hash_.update(view[:read])
+        handle.write(view[:read])
+
+
 def expand_filters(filters):
     """
     Expand a list of file filters passed on the command line. Each item could be
@@ -52,6 +237,28 @@ def expand_filters(filters):
     return extensions
 
 
+def unpack_hashes(encoded):
+    """
+    Unpack a list of base64 encoded MD5 checksums, as found in 4chan's API, in
+    one go. Decoding a whole thread's checksums together is considerably
+    faster than decoding them one at a time.
+
+    :param encoded: The unicode representations of the encoded checksums.
+    :return: A list of the corresponding unicode, 32-character lowercase hex
+             checksums, in the same order.
+    """
+    raw = [binascii.a2b_base64(hash_) for hash_ in encoded]
+    hexed = binascii.hexlify(b''.join(raw)).decode('ascii')
+
+    hashes = []
+    offset = 0
+    for digest in raw:
+        end = offset + len(digest) * 2
+        hashes.append(hexed[offset:end])
+        offset = end
+    return hashes
+
+
 @six.python_2_unicode_compatible
 class File:
     """
@@ -90,6 +297,15 @@ class File:
         """
         return six.u(str(self.id)) + '.' + self.extension
 
+    @property
+    def thumbnail(self):
+        """
+        Get the small JPEG 4chan generates of this file.
+
+        :return: The `Thumbnail`.
+        """
+        return Thumbnail(self)
+
     @property
     def url(self):
         """
@@ -97,18 +313,63 @@ class File:
 
         :return: The URL.
         """
-        return 'https://i.4cdn.org/{0}/{1}'.format(self.board, self.filename)
+        return '{0}/{1}/{2}'.format(MEDIA_ROOT, self.board, self.filename)
+
+    def _request(self, session=None):
+        """
+        Start downloading this file.
+
+        :param session: The transport to use; see `chandl.transport`. If
+                        omitted, a new one will be used.
+        :return: The streaming response.
+        :raise IOError: If the request failed.
+        """
+        logger.debug('Downloading %s', self)
+        if not session:
+            session = transport.create()
+        timeline.mark(timeline.PHASE_CONNECTING)
+        response = session.get(self.url, stream=True)
+        if response.status_code != requests.codes.ok:
+            raise IOError('File failed to download with status {0}'.format(
+                response.status_code))
+        return response
+
+    def fetch(self, handle, session=None):
+        """
+        Download this file into an open file object, hashing it on the way.
 
-    def save_to(self, directory, name, verify=True, session=None):
+        :param handle: The binary file object to write to.
+        :param session: The requests session to use for this download. If
+                        omitted, a new session will be used.
+        :return: The hex MD5 digest of the data received.
+        :raise IOError: If the file could not be downloaded or written.
         """
-        Download and save this file.
+        return _copy(self._request(session).raw, handle)
+
+    def save_to(self, directory, name, verify=True, session=None, cache=True,
+                fsync=False):
+        """
+        Download and save this file. It is written to a hidden `.part` file
+        next to its destination, then renamed into place once complete and
+        verified, so a file with the final name is never partial, even if the
+        process is killed. A killed process leaves the `.part` file behind;
+        see `remove_stale_parts()`.
 
         :param directory: The directory to save this file within.
-        :param name: The file name to save under.
+        :param name: The file name to save under, which may include existing
+                     subdirectories of `directory`.
         :param verify: Whether to verify the file's checksum once it is written.
-                       Defaults to true.
+                       Defaults to true. Files whose checksum is unknown, e.g.
+                       thumbnails, are not verified, and are skipped if they
+                       exist at all.
         :param session: The requests session to use for this download. If
                         omitted, a new session will be used.
+        :param cache: Whether the OS may keep the file in its page cache once
+                      written. Defaults to true; see `drop_cache()`. Files
+                      flushed later with `sync()` are better dropped by it.
+        :param fsync: Whether to flush the file to disk before renaming it, so
+                      it also survives a power loss. Defaults to false; see
+                      `sync()` to flush many files at once instead.
         :return: True if the file was skipped because it exists; False if it was
                  downloaded successfully.
         :raise IOError: If the file could not be downloaded, written, or if
@@ -117,55 +378,60 @@ class File:
         """
         destination = os.path.join(directory, name)
 
-        if os.path.isfile(destination) and \
-                util.md5_file(destination) == self.md5:
-            logger.debug('%s already exists; skipping download', self)
-            return True
-
-        logger.debug('Downloading %s', self)
-        if not session:
-            session = util.create_session()
-        response = session.get(self.url, stream=True)
-        if response.status_code != requests.codes.ok:
-            raise IOError('File failed to download with status {0}'.format(
-                response.status_code))
-
-        with open(destination, 'wb') as handle:
-            shutil.copyfileobj(response.raw, handle)
-
-        if verify and util.md5_file(destination) != self.md5:
-            raise IOError('Verify failed: checksum mismatch')
-
+        if os.path.isfile(destination):
+            timeline.mark(timeline.PHASE_VERIFYING)
+            if self.md5 is None or util.md5_file(destination) == self.md5:
+                logger.debug('%s already exists; skipping download', self)
+                return True
+
+        parent = os.path.dirname(destination)
+        handle = tempfile.NamedTemporaryFile(
+            dir=parent, prefix='.{0}.'.format(os.path.basename(destination)),
+            suffix=_PART_SUFFIX, delete=False)
+        try:
+            with handle:
+                preallocate(handle, self.size)
+                md5 = _copy(self._request(session).raw, handle)
+                handle.truncate()
+                if fsync:
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                if not cache:
+                    drop_cache(handle, sync=not fsync)
+
+            if verify and self.md5 is not None and md5 != self.md5:
+                raise IOError('Verify failed: checksum mismatch')
+            os.rename(handle.name, destination)
+        except BaseException:
+            os.remove(handle.name)
+            raise
+
+        if fsync:
+            _sync_directory(parent)
         return False
 
     @staticmethod
-    def parse_json(board, json):
+    def parse_json(board, json, md5=None):
         """
         Create a file object from 4Chan's API format.
 
         :param board: The name of the board this file was uploaded to, e.g.
                       'wg'.
         :param json: The JSON of the post containing this file.
+        :param md5: The file's checksum, if it has already been unpacked with
+                    `unpack_hashes()`. If omitted, it is unpacked from the
+                    JSON.
         :return: The created file instance.
         :raises ValueError: If the post does not contain an image.
         """
-
-        def unpack_hash(encoded):
-            """
-            Unpacks a packed, base64 encoded MD5 checksum.
-            :param encoded: The unicode representation of the encoded checksum.
-            :return: The unicode representation of the unpacked, 32-character
-                     checksum.
-            """
-            return binascii.hexlify(
-                base64.b64decode(encoded.encode('ascii'))).decode('ascii')
-
         if 'filename' not in json:
             raise ValueError('Post does not contain an image')
 
+        if md5 is None:
+            md5 = unpack_hashes([json['md5']])[0]
+
         return File(json['tim'], board, util.unescape_html(json['filename']),
-                    json['ext'][1:], json['fsize'], json['w'], json['h'],
-                    unpack_hash(json['md5']).rstrip())
+                    json['ext'][1:], json['fsize'], json['w'], json['h'], md5)
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and \
@@ -175,3 +441,36 @@ class File:
         return 'File({0}, {1}.{2}, {3}, {4}x{5})'.format(
             self.id, self.name, self.extension, util.bytes_fmt(self.size),
             self.width, self.height)
+
+
+@six.python_2_unicode_compatible
+class Thumbnail(File):
+    """
+    Represents the thumbnail of a media file: a small JPEG, whatever the type
+    of the file. 4chan does not report its size or checksum.
+    """
+
+    def __init__(self, file_):
+        """
+        Initialise a new thumbnail instance.
+
+        :param file_: The `File` the thumbnail is of.
+        """
+        File.__init__(self, file_.id, file_.board, file_.name, 'jpg', 0, None,
+                      None, None)
+
+    @property
+    def filename(self):
+        """
+        Get the name of this thumbnail as it appears on the 4chan website.
+
+        :return: The file's id, suffixed with 's', with extension.
+        """
+        return six.u(str(self.id)) + 's.' + self.extension
+
+    @property
+    def thumbnail(self):
+        return self
+
+    def __str__(self):
+        return 'Thumbnail({0}, {1})'.format(self.id, self.name)
@@ -1,14 +1,83 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import logging
+import string
 import six
 import pytz
 
 from chandl import util
+from chandl.model import file
 from chandl.model.file import File
 
 
+# post times are UNIX timestamps; adding to this is cheaper than going via
+# utcfromtimestamp() and attaching the timezone afterwards
+_EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+# what decoding a post from malformed JSON can raise, e.g. when a field is
+# missing or of the wrong type
+_DECODE_ERRORS = (ValueError, KeyError, TypeError)
+
+logger = logging.getLogger(__name__)
+
+
+def _utc_datetime(timestamp):
+    """
+    Convert a UNIX timestamp into a timezone-aware datetime.
+
+    :param timestamp: The number of seconds since the epoch.
+    :return: The equivalent datetime in UTC.
+    """
+    return _EPOCH + timedelta(seconds=timestamp)
+
+
+def select(posts, extensions=None, exclusions=None, ids=None):
+    """
+    Narrow posts down to those with a file that should be downloaded. Posts are
+    selected based on their raw JSON, so those removed are never decoded.
+
+    :param posts: A `LazyPosts` or `PostStream`.
+    :param extensions: If given, the set of file extensions to keep.
+    :param exclusions: If given, a set of original file names to leave out.
+    :param ids: If given, the set of ids of the only files to keep.
+    :return: The selected posts, of the same type.
+    """
+    posts = posts.filter(lambda json: 'tim' in json)
+    if extensions:
+        posts = posts.filter(
+            lambda json: json.get('ext', '')[1:] in extensions)
+    if exclusions:
+        posts = posts.filter(
+            lambda json: util.unescape_html(json.get('filename', '')) not in
+            exclusions)
+    if ids:
+        posts = posts.filter(lambda json: json['tim'] in ids)
+    return posts
+
+
+# the post attributes available to format strings, e.g. the CLI's --name
+_FORMAT_FIELDS = frozenset(['board', 'id', 'timestamp', 'body', 'file'])
+
+_FORMATTER = string.Formatter()
+
+
+class _FormatFields(object):
+    """
+    Exposes a post's attributes to `string.Formatter`. Attributes are only
+    looked up if the format string refers to them.
+    """
+
+    def __init__(self, post):
+        self._post = post
+
+    def __getitem__(self, key):
+        if key not in _FORMAT_FIELDS:
+            raise KeyError(key)
+        return getattr(self._post, key)
+
+
 @six.python_2_unicode_compatible
 class Post:
     """
@@ -41,26 +110,270 @@ class Post:
         return self.file is not None
 
     @staticmethod
-    def parse_json(board, json):
+    def parse_json(board, json, md5=None):
         """
         Create a post instance from JSON returned by the 4Chan API.
 
         :param board: The board that was requested.
         :param json: The post's parsed JSON as a dictionary.
+        :param md5: The unpacked checksum of the post's file, if it has one and
+                    it is already known.
         :return: The created post instance.
         """
-        file_ = File.parse_json(board, json) if 'tim' in json else None
+        file_ = File.parse_json(board, json, md5) if 'tim' in json else None
         comment = util.unescape_html(json['com']) if 'com' in json else None
-        return Post(board, json['no'],
-                    datetime.utcfromtimestamp(
-                        json['time']).replace(tzinfo=pytz.utc),
-                    comment, file_)
+        return Post(board, json['no'], _utc_datetime(json['time']), comment,
+                    file_)
+
+    @staticmethod
+    def parse_json_all(board, json):
+        """
+        Create post instances from a list of posts returned by the 4Chan API.
+        Equivalent to calling `parse_json()` on each, but faster for large
+        lists.
+
+        :param board: The board that was requested.
+        :param json: A list of posts' parsed JSON as dictionaries.
+        :return: A list of the created post instances, in the same order.
+        """
+        hashes = iter(file.unpack_hashes([post['md5'] for post in json
+                                          if 'tim' in post]))
+        return [Post.parse_json(board, post,
+                                next(hashes) if 'tim' in post else None)
+                for post in json]
+
+    def format(self, format_string):
+        """
+        Format a string with this post's attributes, e.g.
+        `'{id} - {file.name}.{file.extension}'`.
+
+        :param format_string: The format specifier.
+        :return: The formatted string.
+        :raises KeyError: If the format string refers to a field posts do not
+                          have.
+        """
+        return _FORMATTER.vformat(format_string, (), _FormatFields(self))
+
+    def _key(self):
+        """
+        Get the values that determine whether two posts are equal.
+
+        :return: A tuple of this post's attributes.
+        """
+        return self.board, self.id, self.timestamp, self.body, self.file
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) \
-               and other.__dict__ == self.__dict__
+        return isinstance(other, Post) and other._key() == self._key()
+
+    def __ne__(self, other):
+        return not self == other
 
     def __str__(self):
         return 'Post({0}, {1}, {2})'.format(self.id,
                                             str(self.timestamp),
                                             self.file)
+
+
+class LazyPost(Post, object):
+    """
+    A post whose comment is only unescaped when its body is first read. In all
+    other respects, it is equal to the `Post` parsed from the same JSON.
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, board, json, md5=None):
+        """
+        Initialise a new lazy post from JSON returned by the 4Chan API.
+
+        :param board: The board that was requested.
+        :param json: The post's parsed JSON as a dictionary.
+        :param md5: The unpacked checksum of the post's file, if it has one and
+                    it is already known.
+        """
+        self.board = board
+        self.id = json['no']
+        self.timestamp = _utc_datetime(json['time'])
+        self._escaped_body = json.get('com')
+        self._body = None
+        self.file = File.parse_json(board, json, md5) if 'tim' in json \
+            else None
+
+    @property
+    def body(self):
+        """
+        Get the body of this post, unescaping it if this is the first read.
+
+        :return: The body, or None if the post does not have one.
+        """
+        if self._escaped_body is not None:
+            self._body = util.unescape_html(self._escaped_body)
+            self._escaped_body = None
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._escaped_body = None
+        self._body = value
+
+
+class MalformedPost(Post):
+    """
+    Stands in for a post whose JSON could not be decoded, so iterating lazily
+    decoded posts does not stop at it, and it can be counted as failed. It
+    never has a file.
+    """
+
+    def __init__(self, board, json, error):
+        """
+        Initialise a new malformed post.
+
+        :param board: The board that was requested.
+        :param json: The post's parsed JSON.
+        :param error: The exception decoding it raised.
+        """
+        Post.__init__(self, board,
+                      json.get('no') if isinstance(json, dict) else None, None)
+        self.error = error
+
+    def __str__(self):
+        return 'MalformedPost({0}, {1})'.format(self.id, self.error)
+
+
+def decode(board, json, md5=None):
+    """
+    Decode a post from 4Chan's API format lazily, tolerating malformed JSON.
+
+    :param board: The board that was requested.
+    :param json: The post's parsed JSON as a dictionary.
+    :param md5: The unpacked checksum of the post's file, if it is known.
+    :return: The `LazyPost`, or a `MalformedPost` if the JSON is malformed.
+    """
+    try:
+        return LazyPost(board, json, md5)
+    except _DECODE_ERRORS as e:
+        logger.warning('Failed to decode post %s: %r',
+                       json.get('no') if isinstance(json, dict) else None, e)
+        return MalformedPost(board, json, e)
+
+
+class LazyPosts:
+    """
+    A read-only sequence of posts, each decoded from 4Chan's API format only
+    when it is accessed, as a `MalformedPost` if its JSON is malformed.
+    Filtering on the raw JSON avoids building posts that would be thrown away,
+    e.g.
+
+        posts.filter(lambda json: json.get('ext') == '.webm')
+    """
+
+    def __init__(self, board, json):
+        """
+        Initialise a new lazy sequence of posts.
+
+        :param board: The board that was requested.
+        :param json: A list of posts' parsed JSON as dictionaries.
+        """
+        self._board = board
+        self._json = json
+        self._posts = [None] * len(json)
+
+    def filter(self, predicate):
+        """
+        Select posts without decoding them.
+
+        :param predicate: A function taking a post's raw JSON dictionary, and
+                          returning whether to keep it.
+        :return: A new lazy sequence containing the selected posts.
+        """
+        return LazyPosts(self._board,
+                         [json for json in self._json if predicate(json)])
+
+    def raw(self):
+        """
+        Get the posts without decoding them.
+
+        :return: A list of the posts' parsed JSON as dictionaries.
+        """
+        return self._json
+
+    def __len__(self):
+        return len(self._json)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        post = self._posts[index]
+        if post is None:
+            post = decode(self._board, self._json[index])
+            self._posts[index] = post
+        return post
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class PostStream:
+    """
+    A one-shot iterable of posts, each decoded as its JSON arrives, as a
+    `MalformedPost` if its JSON is malformed. Like `LazyPosts`, it can be
+    filtered on the raw JSON before any post is built.
+    """
+
+    def __init__(self, board, json, predicates=()):
+        """
+        Initialise a new stream of posts.
+
+        :param board: The board that was requested.
+        :param json: An iterable of posts' parsed JSON as dictionaries, e.g.
+                     from `jsonstream.iter_array()`.
+        :param predicates: Functions taking a post's raw JSON; only posts
+                           satisfying all of them are yielded.
+        """
+        self._board = board
+        self._json = json
+        self._predicates = tuple(predicates)
+
+    def filter(self, predicate):
+        """
+        Select posts without decoding them. The returned stream shares its
+        source with this one, so only one of them should be iterated.
+
+        :param predicate: A function taking a post's raw JSON dictionary, and
+                          returning whether to keep it.
+        :return: A new stream yielding only the selected posts.
+        """
+        return PostStream(self._board, self._json,
+                          self._predicates + (predicate,))
+
+    def tap(self, function):
+        """
+        Observe every post in the stream, including those later filtered out,
+        as it is received. The returned stream shares its source with this
+        one, so only one of them should be iterated.
+
+        :param function: Called with each post's raw JSON dictionary before
+                         any predicates are applied.
+        :return: A new stream yielding the same posts.
+        """
+        def tapped():
+            for json in self._json:
+                function(json)
+                yield json
+
+        return PostStream(self._board, tapped(), self._predicates)
+
+    def __iter__(self):
+        for json in self._json:
+            if all(predicate(json) for predicate in self._predicates):
+                yield decode(self._board, json)
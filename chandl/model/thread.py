@@ -2,13 +2,19 @@
 from __future__ import unicode_literals
 
 import logging
+import itertools
 import re
 import six
 import requests
-import bleach
 
-from chandl import util
-from chandl.model.post import Post
+from chandl import util, jsonstream, transport
+from chandl.model.post import Post, LazyPosts, PostStream
+
+# the root of 4chan's read-only JSON API; overridable for testing
+API_ROOT = 'https://a.4cdn.org'
+
+# the number of bytes to read from the network at a time when streaming
+_STREAM_CHUNK_SIZE = 64 * 1024
 
 logger = logging.getLogger(__name__)
 
@@ -69,8 +75,7 @@ class Thread:
         if line_break != -1:
             comment = comment[:line_break]
 
-        comment = bleach.clean(comment, tags=[], strip=True)
-        comment = util.unescape_html(comment)
+        comment = util.strip_html(comment)
 
         # attempt to identify the first sentence
         result = re.match(r'([^.:;?]+)', comment)
@@ -81,59 +86,117 @@ class Thread:
         return str(post['no'])
 
     @staticmethod
-    def parse_json(board, json_):
+    def parse_json(board, json_, lazy=False):
         """
         Create a thread instance from JSON returned by the 4Chan API.
 
         :param board: The board that was requested.
         :param json_: The thread's parsed JSON as a dictionary.
+        :param lazy: Whether to decode posts only when they are accessed. If
+                     true, the thread's posts will be a `LazyPosts` sequence,
+                     which can be filtered on the raw JSON. Defaults to false.
         :return: The created thread instance.
         """
         if 'posts' not in json_ or not json_['posts']:
             raise ValueError('Thread does not contain any posts')
 
-        first = json_['posts'][0]
+        return Thread._from_first(board, json_['posts'][0],
+                                  LazyPosts(board, json_['posts']) if lazy
+                                  else Post.parse_json_all(board,
+                                                           json_['posts']))
 
+    @staticmethod
+    def _from_first(board, first, posts):
+        """
+        Create a thread instance, taking its details from its first post.
+
+        :param board: The board that was requested.
+        :param first: The first post's JSON as a dictionary.
+        :param posts: The thread's posts, including the first.
+        :return: The created thread instance.
+        """
         return Thread(board,
                       first['no'],
                       util.unescape_html(first['sub'])
                       if 'sub' in first else None,
                       Thread._find_subject(first),
                       first['semantic_url'],
-                      [Post.parse_json(board, post)
-                       for post in json_['posts']])
+                      posts)
+
+    @staticmethod
+    def parse_stream(board, chunks):
+        """
+        Create a thread instance from JSON returned by the 4Chan API as it is
+        received. Only the first post is read before returning; the rest are
+        decoded as the thread's posts are iterated.
+
+        :param board: The board that was requested.
+        :param chunks: An iterable of bytestrings making up the thread's JSON.
+        :return: The created thread instance, whose posts are a `PostStream`.
+        :raises ValueError: If the thread does not contain any posts, or its
+                            JSON is malformed.
+        """
+        json_posts = jsonstream.iter_array(chunks, 'posts')
+        try:
+            first = next(json_posts)
+        except StopIteration:
+            raise ValueError('Thread does not contain any posts')
+
+        return Thread._from_first(
+            board, first,
+            PostStream(board, itertools.chain([first], json_posts)))
+
+    @staticmethod
+    def parse_url(url):
+        """
+        Extract the board and id of a thread from its URL.
+
+        :param url: The URL of the thread.
+        :return: A (board, thread id) tuple.
+        :raises ValueError: If the URL is not that of a thread.
+        """
+        result = re.search(r'boards\.4chan\.org/([a-z]+)/thread/([0-9]+)', url)
+        if not result:
+            raise ValueError('Invalid thread URL: {0}'.format(url))
+        return result.group(1), int(result.group(2))
 
     @staticmethod
-    def from_url(url, session=None):
+    def from_url(url, session=None, lazy=False, stream=False):
         """
         Construct a thread instance from its URL.
 
         :param url: The URL of the thread to retrieve.
-        :param session: The requests session to use to send the request.
+        :param session: The transport to send the request with; see
+                        `chandl.transport`. If omitted, a new one is used.
+        :param lazy: Whether to decode posts only when they are accessed; see
+                     `parse_json()`.
+        :param stream: Whether to return as soon as the first post has been
+                       received, decoding the rest while the thread's posts
+                       are iterated; see `parse_stream()`. Takes precedence
+                       over `lazy`.
         :return: The created thread instance.
         :raises IOError: If the thread could not be retrieved from 4chan.
         """
-        # extract the board and thread ids
-        result = re.search(r'boards\.4chan\.org/([a-z]+)/thread/([0-9]+)', url)
-        if not result:
-            raise ValueError('Invalid thread URL: {0}'.format(url))
+        board, id_ = Thread.parse_url(url)
 
-        # construct a session if necessary
+        # construct a transport if necessary
         if not session:
-            session = util.create_session()
+            session = transport.create()
 
         # determine the URL
-        api_url = 'https://a.4cdn.org/{0}/thread/{1}.json'.format(
-            result.group(1), result.group(2))
+        api_url = '{0}/{1}/thread/{2}.json'.format(API_ROOT, board, id_)
 
         # download the JSON
         logger.debug('Retrieving JSON from %s', api_url)
-        response = session.get(api_url)
+        response = session.get(api_url, stream=stream)
         if response.status_code != requests.codes.ok:
             raise IOError('Request to 4chan failed with status code {0}'.format(
                 response.status_code))
         try:
-            return Thread.parse_json(result.group(1), response.json())
+            if stream:
+                return Thread.parse_stream(
+                    board, response.iter_content(chunk_size=_STREAM_CHUNK_SIZE))
+            return Thread.parse_json(board, response.json(), lazy)
         except ValueError as e:
             raise IOError('Error parsing 4chan response: {0}'.format(e))
 
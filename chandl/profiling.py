@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling chandl itself: running everything, including the download threads,
+under a deterministic or sampling profiler, and tracing memory allocations.
+"""
+from __future__ import unicode_literals, division
+
+import collections
+import contextlib
+import cProfile
+import io
+import linecache
+import os
+import pstats
+import sys
+import threading
+import six
+
+from chandl import util
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+# cProfile in every thread, written in pstats' format, or periodic samples of
+# every thread's stack, written as collapsed stacks for flame graph tools
+PROFILER_DETERMINISTIC = 'deterministic'
+PROFILER_SAMPLING = 'sampling'
+
+PROFILERS = [PROFILER_DETERMINISTIC, PROFILER_SAMPLING]
+
+# how often the sampling profiler samples, in seconds
+SAMPLE_INTERVAL = .005
+
+
+class _DeterministicProfiler:
+    """
+    Runs cProfile in every thread started while it is active, combining the
+    results. cProfile only profiles the thread that enabled it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = []
+
+    def _enable(self):
+        """
+        Start profiling the calling thread.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # newer Pythons profile every thread from the first profile, and
+            # refuse to start another
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    # noinspection PyUnusedLocal
+    def _enable_thread(self, frame, event, arg):
+        """
+        Installed by `threading.setprofile()`, so called as each new thread
+        makes its first call. Replaces itself with cProfile.
+        """
+        sys.setprofile(None)
+        self._enable()
+
+    def start(self):
+        """
+        Start profiling the calling thread, and threads it starts.
+        """
+        threading.setprofile(self._enable_thread)
+        self._enable()
+
+    def stop(self, path):
+        """
+        Stop profiling, and write the results.
+
+        :param path: The file to write statistics to, in pstats' format.
+        """
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self._profiles)
+        # the calling thread's first, as collecting statistics stops it
+        profiles[0].disable()
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(path)
+
+
+class _SamplingProfiler:
+    """
+    Samples the stack of every thread periodically from a thread of its own,
+    counting identical stacks.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        """
+        Initialise a new sampling profiler.
+
+        :param interval: The seconds between samples.
+        """
+        self._interval = interval
+        self._stacks = collections.defaultdict(int)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+
+    @staticmethod
+    def _collapse(frame):
+        """
+        Describe a stack as a single line.
+
+        :param frame: The innermost frame.
+        :return: Each frame's module and function, outermost first, separated
+                 by semicolons.
+        """
+        names = []
+        while frame is not None:
+            names.append('{0}:{1}'.format(
+                frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _sample(self):
+        """
+        Take samples until stopped. Runs on its own thread.
+        """
+        own = threading.current_thread().ident
+        # noinspection PyProtectedMember
+        while not self._stopped.wait(self._interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._stacks[self._collapse(frame)] += 1
+
+    def start(self):
+        """
+        Start sampling every thread.
+        """
+        self._thread.start()
+
+    def stop(self, path):
+        """
+        Stop sampling, and write the results.
+
+        :param path: The file to write each stack and its number of samples
+                     to, one per line, as expected by e.g. flamegraph.pl.
+        """
+        self._stopped.set()
+        self._thread.join()
+        with io.open(path, 'w', encoding='utf-8') as handle:
+            for stack, count in sorted(self._stacks.items()):
+                handle.write('{0} {1}\n'.format(stack, count))
+
+
+@contextlib.contextmanager
+def profiled(path, profiler=PROFILER_DETERMINISTIC):
+    """
+    Profile every thread for the duration of the context, including threads
+    started within it, and write the results once it exits.
+
+    :param path: The file to write the profile to.
+    :param profiler: One of `PROFILERS`. Defaults to
+                     `PROFILER_DETERMINISTIC`.
+    :raises ValueError: If the profiler is unknown.
+    """
+    if profiler == PROFILER_DETERMINISTIC:
+        profiler_ = _DeterministicProfiler()
+    elif profiler == PROFILER_SAMPLING:
+        profiler_ = _SamplingProfiler()
+    else:
+        raise ValueError('Unknown profiler: {0}'.format(profiler))
+
+    profiler_.start()
+    try:
+        yield
+    finally:
+        profiler_.stop(path)
+
+
+@six.python_2_unicode_compatible
+class AllocationReport:
+    """
+    What was allocated while memory was traced: the peak, and the sites that
+    allocated most of the memory still held at the end.
+    """
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        # (filename, line number, size in bytes, number of blocks) tuples,
+        # largest first
+        self.sites = []
+
+    def __str__(self):
+        lines = ['Traced memory: {0} peak, {1} at the end'.format(
+            util.bytes_fmt(self.peak), util.bytes_fmt(self.current))]
+        for filename, lineno, size, count in self.sites:
+            lines.append('{0} in {1} blocks: {2}:{3}'.format(
+                util.bytes_fmt(size), count, filename, lineno))
+            line = linecache.getline(filename, lineno).strip()
+            if line:
+                lines.append('    ' + line)
+        return os.linesep.join(lines)
+
+
+@contextlib.contextmanager
+def traced_allocations(limit=10):
+    """
+    Trace memory allocations by every thread for the duration of the context.
+
+    :param limit: The number of allocation sites to report.
+    :return: An `AllocationReport`, filled in once the context exits.
+    :raises ValueError: If memory cannot be traced, i.e. on Python 2.
+    """
+    if tracemalloc is None:
+        raise ValueError('Tracing memory allocations requires Python 3.4 or '
+                         'later')
+
+    report = AllocationReport()
+    tracemalloc.start()
+    try:
+        yield report
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        report.current, report.peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>')])
+        for statistic in snapshot.statistics('lineno')[:limit]:
+            frame = statistic.traceback[0]
+            report.sites.append((frame.filename, frame.lineno,
+                                 statistic.size, statistic.count))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregating what happens to each job of a download as it happens, in memory
+that does not grow with the number of files, so board-wide crawls running for
+days can still report totals.
+"""
+from __future__ import unicode_literals, division
+
+import bisect
+import collections
+import threading
+
+
+# the upper bounds of latency histogram buckets in seconds: 10 ms, doubling up
+# to about 5.5 minutes; anything slower falls into a final, unbounded bucket
+_LATENCY_BOUNDS = [.01 * 2 ** i for i in range(16)]
+
+
+def seconds_fmt(seconds):
+    """
+    Format a duration for display.
+
+    :param seconds: The duration in seconds.
+    :return: The duration as a human-readable string, e.g. '80 ms' or '1.2 s'.
+    """
+    if seconds < 1:
+        return '{0:.0f} ms'.format(seconds * 1000)
+    return '{0:.1f} s'.format(seconds)
+
+
+class Histogram:
+    """
+    Counts values in fixed buckets, so its size is bounded however many values
+    are added. Not thread-safe.
+    """
+
+    def __init__(self, bounds=None):
+        """
+        Initialise a new, empty histogram.
+
+        :param bounds: The ascending upper bounds of the buckets. Defaults to
+                       buckets suitable for latencies in seconds.
+        """
+        self.bounds = bounds or _LATENCY_BOUNDS
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def add(self, value):
+        """
+        Count a value.
+
+        :param value: The value.
+        """
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        Find a value at least the given fraction of values are within. This is
+        the upper bound of a bucket, so is only as precise as the buckets are.
+
+        :param fraction: The fraction, e.g. .9 for the 90th percentile.
+        :return: The value, or None if the histogram is empty.
+        """
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+
+class Tally:
+    """
+    Counts jobs and their bytes by outcome, with a latency histogram per
+    outcome. Posts themselves are only kept for the outcomes asked for, e.g.
+    failures, so they can be reported. Safe to use from many threads.
+    """
+
+    def __init__(self, keep=()):
+        """
+        Initialise a new, empty tally.
+
+        :param keep: The outcomes whose posts to keep, e.g. failures.
+        """
+        self._lock = threading.Lock()
+        self._keep = frozenset(keep)
+        self.counts = collections.defaultdict(int)
+        self.bytes = collections.defaultdict(int)
+        self.latencies = collections.defaultdict(Histogram)
+        self._posts = collections.defaultdict(list)
+
+    def add(self, outcome, post_, latency=None):
+        """
+        Record the outcome of a job.
+
+        :param outcome: What became of the job, e.g. `OUTCOME_FAILED`.
+        :param post_: The post whose file the job was for.
+        :param latency: How long the job took in seconds, if it was attempted.
+        """
+        size = post_.file.size if post_.has_file else 0
+        with self._lock:
+            self.counts[outcome] += 1
+            self.bytes[outcome] += size
+            if latency is not None:
+                self.latencies[outcome].add(latency)
+            if outcome in self._keep:
+                self._posts[outcome].append(post_)
+
+    def posts(self, outcome):
+        """
+        Get the posts recorded with an outcome.
+
+        :param outcome: The outcome.
+        :return: A list of posts, or None if posts with this outcome are not
+                 kept.
+        """
+        if outcome not in self._keep:
+            return None
+        with self._lock:
+            return list(self._posts[outcome])
+
+    def __len__(self):
+        return sum(self.counts.values())
@@ -0,0 +1,637 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import binascii
+import calendar
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from chandl import util
+from chandl.model import file as file_, post as post_
+
+
+STATUS_PENDING = 'pending'
+STATUS_DOWNLOADED = 'downloaded'
+STATUS_FAILED = 'failed'
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# the number of buffered rows that triggers a write
+_BATCH_SIZE = 500
+
+# how long to wait for another process to release the database, in seconds
+_BUSY_TIMEOUT = 30
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS threads (
+    board TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    subject TEXT,
+    title TEXT NOT NULL,
+    slug TEXT,
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    PRIMARY KEY (board, id)
+);
+CREATE TABLE IF NOT EXISTS posts (
+    board TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    thread INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    body TEXT,
+    PRIMARY KEY (board, id)
+);
+CREATE TABLE IF NOT EXISTS files (
+    board TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    thread INTEGER NOT NULL,
+    post INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    md5 TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    path TEXT,
+    updated INTEGER,
+    PRIMARY KEY (board, id)
+);
+CREATE INDEX IF NOT EXISTS files_by_status ON files (board, thread, status);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    board TEXT NOT NULL,
+    thread INTEGER NOT NULL,
+    started INTEGER NOT NULL,
+    finished INTEGER,
+    downloaded INTEGER,
+    failed INTEGER,
+    skipped INTEGER,
+    remaining INTEGER,
+    downloaded_bytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    submitted INTEGER NOT NULL,
+    started INTEGER,
+    finished INTEGER,
+    run INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, id);
+'''
+
+# the columns of a job, as returned by `job()` and `jobs()`; the outcome of its
+# run is joined on
+_JOB_QUERY = '''
+SELECT jobs.id, jobs.url, jobs.options, jobs.status, jobs.submitted,
+    jobs.started, jobs.finished, jobs.error, runs.downloaded, runs.failed,
+    runs.skipped, runs.remaining, runs.downloaded_bytes
+FROM jobs LEFT JOIN runs ON runs.id = jobs.run
+'''
+
+# only created when indexing is enabled, as it needs SQLite built with FTS5
+_SEARCH_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5 (
+    title,
+    body,
+    filename,
+    board UNINDEXED,
+    thread UNINDEXED,
+    post UNINDEXED,
+    file UNINDEXED
+);
+CREATE INDEX IF NOT EXISTS files_by_post ON files (board, post);
+'''
+
+# the number of tokens to show around matches in search results
+_SNIPPET_TOKENS = 12
+
+
+def _job(row):
+    """
+    Convert a row selected by `_JOB_QUERY` into a dictionary.
+
+    :param row: The row.
+    :return: The job as a dictionary, with its options decoded.
+    """
+    job = dict(zip(('id', 'url', 'options', 'status', 'submitted', 'started',
+                    'finished', 'error', 'downloaded', 'failed', 'skipped',
+                    'remaining', 'downloaded_bytes'), row))
+    job['options'] = json.loads(job['options'])
+    return job
+
+
+def _post_rows(thread, post):
+    """
+    Convert a post into the rows recording it.
+
+    :param thread: The thread the post belongs to.
+    :param post: The post.
+    :return: A tuple of the thread's title, the `posts` row, and the `files`
+             row, or None if the post has no file.
+    """
+    return (thread.title,
+            (post.board, post.id, thread.id, _unix(post.timestamp), post.body),
+            (post.board, post.file.id, thread.id, post.id, post.file.name,
+             post.file.extension, post.file.size, post.file.width,
+             post.file.height, post.file.md5) if post.has_file else None)
+
+
+def _raw_post_rows(thread, json):
+    """
+    Convert a post in 4Chan's API format into the rows recording it, without
+    decoding it into a `Post`.
+
+    :param thread: The thread the post belongs to.
+    :param json: The post's parsed JSON as a dictionary.
+    :return: A tuple like `_post_rows()`.
+    :raises KeyError: If the JSON is missing a field.
+    :raises TypeError: If a field has the wrong type.
+    :raises ValueError: If a field is malformed.
+    """
+    comment = json.get('com')
+    return (thread.title,
+            (thread.board, json['no'], thread.id, int(json['time']),
+             util.unescape_html(comment) if comment is not None else None),
+            (thread.board, json['tim'], thread.id, json['no'],
+             util.unescape_html(json['filename']), json['ext'][1:],
+             json['fsize'], json['w'], json['h'],
+             file_.unpack_hashes([json['md5']])[0]) if 'tim' in json else None)
+
+
+def _unix(datetime_):
+    """
+    Convert a timezone-aware datetime into a UNIX timestamp.
+
+    :param datetime_: The datetime to convert.
+    :return: The number of seconds since the epoch.
+    """
+    return calendar.timegm(datetime_.utctimetuple())
+
+
+class SearchResult:
+    """
+    A post matching a search of the store.
+    """
+
+    def __init__(self, board, thread_id, post_id, title, snippet, path=None):
+        """
+        Initialise a new search result.
+
+        :param board: The board the post was made on.
+        :param thread_id: The id of the post's thread.
+        :param post_id: The id of the post.
+        :param title: The title of the post's thread.
+        :param snippet: The matching part of the post's text, with matches
+                        enclosed in square brackets.
+        :param path: Where the post's file was downloaded to, if it was.
+        """
+        self.board = board
+        self.thread_id = thread_id
+        self.post_id = post_id
+        self.title = title
+        self.snippet = snippet
+        self.path = path
+
+    def __str__(self):
+        return '/{0}/{1}#p{2} {3}'.format(self.board, self.thread_id,
+                                          self.post_id, self.title)
+
+
+class Store:
+    """
+    A local SQLite database remembering threads, posts and files between runs,
+    so the files already downloaded can be found without touching the
+    filesystem. The database uses write-ahead logging, so several processes
+    can share it. Instances can be used from multiple threads.
+    """
+
+    def __init__(self, path, index=False):
+        """
+        Open a store, creating it if necessary.
+
+        :param path: The path of the database file.
+        :param index: Whether to also add posts to the full-text search index
+                      used by `search()`. Defaults to false.
+        :raises sqlite3.Error: If the database cannot be opened, or indexing
+                               was requested but SQLite lacks FTS5.
+        """
+        self._connection = sqlite3.connect(path, timeout=_BUSY_TIMEOUT,
+                                           check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_SCHEMA)
+        if index:
+            self._connection.executescript(_SEARCH_SCHEMA)
+            self._index_stored()
+        self._index = index
+        self._lock = threading.Lock()
+        self._posts = []
+        self._statuses = []
+
+    def _index_stored(self):
+        """
+        Index the posts stored while indexing was disabled, e.g. by runs
+        before it was first enabled, as posts are otherwise only indexed when
+        they are first stored.
+        """
+        posts = self._connection.execute(
+            'SELECT COUNT(*) FROM posts').fetchone()[0]
+        if posts == self._connection.execute(
+                'SELECT COUNT(*) FROM search').fetchone()[0]:
+            return
+
+        indexed = set(self._connection.execute(
+            'SELECT board, post FROM search'))
+        rows = self._connection.execute(
+            'SELECT threads.title, posts.body, files.name, files.extension, '
+            'posts.board, posts.thread, posts.id, files.id '
+            'FROM posts JOIN threads ON threads.board = posts.board '
+            'AND threads.id = posts.thread '
+            'LEFT JOIN files ON files.board = posts.board '
+            'AND files.post = posts.id').fetchall()
+        self._write('INSERT INTO search VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(title, util.strip_html(body) if body else None,
+                      '{0}.{1}'.format(name, extension)
+                      if file_id is not None else None,
+                      board, thread_id, post_id, file_id)
+                     for title, body, name, extension, board, thread_id,
+                     post_id, file_id in rows
+                     if (board, post_id) not in indexed])
+
+    def _write(self, sql, rows):
+        """
+        Execute a statement for many rows in a single transaction.
+
+        :param sql: The statement.
+        :param rows: A list of parameter tuples.
+        """
+        if not rows:
+            return
+        with self._connection:
+            self._connection.executemany(sql, rows)
+
+    def add_thread(self, thread):
+        """
+        Record that a thread has been seen.
+
+        :param thread: The thread.
+        """
+        now = int(time.time())
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR IGNORE INTO threads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (thread.board, thread.id, thread.subject, thread.title,
+                 thread.slug, now, now))
+            self._connection.execute(
+                'UPDATE threads SET last_seen = ? WHERE board = ? AND id = ?',
+                (now, thread.board, thread.id))
+
+    def add_post(self, thread, post):
+        """
+        Record a post and its file. Posts are buffered and written in batches;
+        call `flush()` to write them immediately. Posts that are already
+        stored are left alone, so file statuses are preserved.
+
+        :param thread: The thread the post belongs to.
+        :param post: The post. A `MalformedPost` is not recorded, as too little
+                     is known about it.
+        """
+        if isinstance(post, post_.MalformedPost):
+            return
+        self._buffer_post(_post_rows(thread, post))
+
+    def add_raw_post(self, thread, json):
+        """
+        Record a post and its file straight from 4Chan's API format, so posts
+        that are not otherwise needed are never decoded. Buffered like
+        `add_post()`.
+
+        :param thread: The thread the post belongs to.
+        :param json: The post's parsed JSON as a dictionary. It is not recorded
+                     if it is malformed.
+        """
+        try:
+            rows = _raw_post_rows(thread, json)
+        except (KeyError, TypeError, ValueError, binascii.Error):
+            # decoding the post reports the problem, if it is ever needed
+            return
+        self._buffer_post(rows)
+
+    def _buffer_post(self, rows):
+        """
+        Buffer the rows recording a post, writing them if the buffer is full.
+
+        :param rows: A tuple returned by `_post_rows()`.
+        """
+        with self._lock:
+            self._posts.append(rows)
+            if len(self._posts) >= _BATCH_SIZE:
+                self._flush_posts()
+
+    def add_posts(self, thread, posts):
+        """
+        Record many posts and their files.
+
+        :param thread: The thread the posts belong to.
+        :param posts: An iterable of posts.
+        """
+        for post in posts:
+            self.add_post(thread, post)
+        self.flush()
+
+    def add_raw_posts(self, thread, json):
+        """
+        Record many posts and their files straight from 4Chan's API format.
+
+        :param thread: The thread the posts belong to.
+        :param json: An iterable of posts' parsed JSON as dictionaries.
+        """
+        for json_ in json:
+            self.add_raw_post(thread, json_)
+        self.flush()
+
+    def _unseen(self, posts):
+        """
+        Find which of a batch of posts are not yet stored.
+
+        :param posts: A list of tuples returned by `_post_rows()`.
+        :return: The tuples whose posts are new.
+        """
+        seen = set()
+        for board in set(post[0] for _, post, _ in posts):
+            ids = [post[1] for _, post, _ in posts if post[0] == board]
+            seen.update((board, row[0]) for row in self._connection.execute(
+                'SELECT id FROM posts WHERE board = ? AND id IN ({0})'.format(
+                    ', '.join('?' * len(ids))), [board] + ids))
+        return [rows for rows in posts if rows[1][:2] not in seen]
+
+    def _flush_posts(self):
+        """
+        Write buffered posts. The lock must be held.
+        """
+        posts, self._posts = self._posts, []
+        if not posts:
+            return
+
+        with self._connection:
+            if self._index:
+                # only index posts once, as FTS tables have no unique key
+                self._connection.executemany(
+                    'INSERT INTO search VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(title, util.strip_html(post[4]) if post[4] else None,
+                      '{0}.{1}'.format(file[4], file[5]) if file else None,
+                      post[0], post[2], post[1], file[1] if file else None)
+                     for title, post, file in self._unseen(posts)])
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO posts VALUES (?, ?, ?, ?, ?)',
+                [post for _, post, _ in posts])
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO files (board, id, thread, post, name, '
+                'extension, size, width, height, md5) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [file for _, _, file in posts if file])
+
+    def set_status(self, post, status, path=None):
+        """
+        Record the outcome of downloading a post's file. Statuses are buffered
+        and written in batches; call `flush()` to write them immediately.
+
+        :param post: The post whose file was processed.
+        :param status: One of the `STATUS_` constants.
+        :param path: Where the file was saved, if anywhere.
+        """
+        with self._lock:
+            self._statuses.append((status, path, int(time.time()), post.board,
+                                   post.file.id))
+            if len(self._statuses) >= _BATCH_SIZE:
+                self._flush_statuses()
+
+    def _flush_statuses(self):
+        """
+        Write buffered statuses. The lock must be held.
+        """
+        # the files being updated may still be waiting to be inserted
+        self._flush_posts()
+        statuses, self._statuses = self._statuses, []
+        self._write('UPDATE files SET status = ?, path = ?, updated = ? '
+                    'WHERE board = ? AND id = ?', statuses)
+
+    def flush(self):
+        """
+        Write all buffered posts and statuses.
+        """
+        with self._lock:
+            self._flush_posts()
+            self._flush_statuses()
+
+    def downloaded(self, board, thread_id, directory=None):
+        """
+        Find the files in a thread that have already been downloaded.
+
+        :param board: The thread's board.
+        :param thread_id: The id of the thread.
+        :param directory: The absolute path files are being saved under, e.g.
+                          the thread directory or archive. If given, files
+                          downloaded elsewhere are not counted, so they are
+                          downloaded again.
+        :return: A set of file ids.
+        """
+        sql = 'SELECT id FROM files WHERE board = ? AND thread = ? ' \
+              'AND status = ?'
+        params = (board, thread_id, STATUS_DOWNLOADED)
+        if directory is not None:
+            prefix = os.path.join(directory, '')
+            sql += ' AND substr(path, 1, ?) = ?'
+            params += (len(prefix), prefix)
+        with self._lock:
+            return set(row[0] for row in self._connection.execute(sql,
+                                                                  params))
+
+    def saved_files(self, directory):
+        """
+        Find the files recorded as downloaded into a directory.
+
+        :param directory: The absolute path of the directory.
+        :return: A list of (board, file id, path, md5) tuples.
+        """
+        prefix = os.path.join(directory, '')
+        with self._lock:
+            self._flush_statuses()
+            return [tuple(row) for row in self._connection.execute(
+                'SELECT board, id, path, md5 FROM files WHERE status = ? '
+                'AND substr(path, 1, ?) = ?',
+                (STATUS_DOWNLOADED, len(prefix), prefix))]
+
+    def reset_files(self, files):
+        """
+        Forget that files were downloaded, so the next run downloads them
+        again.
+
+        :param files: An iterable of (board, file id) tuples.
+        """
+        with self._lock:
+            self._flush_statuses()
+            self._write('UPDATE files SET status = ?, path = NULL, updated = ? '
+                        'WHERE board = ? AND id = ?',
+                        [(STATUS_PENDING, int(time.time()), board, id_)
+                         for board, id_ in files])
+
+    def search(self, query, limit=20):
+        """
+        Search the text of indexed posts, their file names and their threads'
+        titles.
+
+        :param query: An FTS5 query, e.g. `mountain` or `title:space NOT moon`.
+        :param limit: The maximum number of results to return.
+        :return: A list of `SearchResult`s, best match first.
+        :raises sqlite3.Error: If the query is malformed, or the store has
+                               never been indexed.
+        """
+        self.flush()
+        with self._lock:
+            return [SearchResult(*row) for row in self._connection.execute(
+                'SELECT search.board, search.thread, search.post, '
+                'search.title, snippet(search, -1, \'[\', \']\', \'...\', ?), '
+                'files.path '
+                'FROM search LEFT JOIN files ON files.board = search.board '
+                'AND files.id = search.file AND files.status = ? '
+                'WHERE search MATCH ? ORDER BY rank LIMIT ?',
+                (_SNIPPET_TOKENS, STATUS_DOWNLOADED, query, limit))]
+
+    def start_run(self, thread):
+        """
+        Record the start of a download.
+
+        :param thread: The thread being downloaded.
+        :return: The run's id.
+        """
+        with self._lock, self._connection:
+            return self._connection.execute(
+                'INSERT INTO runs (board, thread, started) VALUES (?, ?, ?)',
+                (thread.board, thread.id, int(time.time()))).lastrowid
+
+    def finish_run(self, run_id, result):
+        """
+        Record the outcome of a download.
+
+        :param run_id: The id returned by `start_run()`.
+        :param result: The `DownloadResult`.
+        """
+        self.flush()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE runs SET finished = ?, downloaded = ?, failed = ?, '
+                'skipped = ?, remaining = ?, downloaded_bytes = ? '
+                'WHERE id = ?',
+                (int(time.time()), result.downloaded_job_count,
+                 result.failed_job_count, result.skipped_job_count,
+                 result.remaining_job_count, result.downloaded_bytes, run_id))
+
+    def add_job(self, url, options):
+        """
+        Queue a thread to be downloaded.
+
+        :param url: The thread's URL.
+        :param options: A dictionary of download options, stored as JSON.
+        :return: The job's id.
+        """
+        with self._lock, self._connection:
+            return self._connection.execute(
+                'INSERT INTO jobs (url, options, submitted) VALUES (?, ?, ?)',
+                (url, json.dumps(options), int(time.time()))).lastrowid
+
+    def claim_job(self):
+        """
+        Mark the oldest queued job as running.
+
+        :return: The job as a dictionary, or None if no jobs are queued.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                'SELECT id FROM jobs WHERE status = ? ORDER BY id LIMIT 1',
+                (JOB_QUEUED,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                'UPDATE jobs SET status = ?, started = ? WHERE id = ?',
+                (JOB_RUNNING, int(time.time()), row[0]))
+            return _job(self._connection.execute(
+                _JOB_QUERY + 'WHERE jobs.id = ?', row).fetchone())
+
+    def finish_job(self, job_id, run_id=None, error=None):
+        """
+        Record the outcome of a job.
+
+        :param job_id: The job's id.
+        :param run_id: The id of the run that downloaded its files, if any.
+        :param error: A message describing why the job failed, if it did.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE jobs SET status = ?, finished = ?, run = ?, error = ? '
+                'WHERE id = ?',
+                (JOB_FAILED if error else JOB_DONE, int(time.time()), run_id,
+                 error, job_id))
+
+    def requeue_jobs(self):
+        """
+        Return jobs left running, e.g. by a process that was killed, to the
+        queue.
+
+        :return: The number of jobs requeued.
+        """
+        with self._lock, self._connection:
+            return self._connection.execute(
+                'UPDATE jobs SET status = ?, started = NULL WHERE status = ?',
+                (JOB_QUEUED, JOB_RUNNING)).rowcount
+
+    def job(self, job_id):
+        """
+        Look up a job.
+
+        :param job_id: The job's id.
+        :return: The job as a dictionary, or None if it does not exist.
+        """
+        with self._lock:
+            row = self._connection.execute(_JOB_QUERY + 'WHERE jobs.id = ?',
+                                           (job_id,)).fetchone()
+        return _job(row) if row else None
+
+    def jobs(self, limit=100):
+        """
+        List the most recently submitted jobs.
+
+        :param limit: The maximum number of jobs to return.
+        :return: A list of job dictionaries, newest first.
+        """
+        with self._lock:
+            return [_job(row) for row in self._connection.execute(
+                _JOB_QUERY + 'ORDER BY jobs.id DESC LIMIT ?', (limit,))]
+
+    def job_counts(self):
+        """
+        Count jobs by status.
+
+        :return: A dictionary of status -> number of jobs.
+        """
+        with self._lock:
+            return dict(self._connection.execute(
+                'SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+
+    def close(self):
+        """
+        Write anything buffered and close the database.
+        """
+        self.flush()
+        self._connection.close()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+from chandl.benchmarks import hashing
+
+
+class TestHashing(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_files(self):
+        paths = hashing.write_files(self.directory, 2, 1000)
+        self.assertEqual(len(paths), 2)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(len(f.read()), 1000)
+
+    def test_strategies_agree(self):
+        path = hashing.write_files(self.directory, 1, 100000)[0]
+        with open(path, 'rb') as f:
+            expected = hashlib.md5(f.read()).hexdigest()
+        for name, (function, whole) in hashing.BENCHMARKS.items():
+            if not whole:
+                self.assertEqual(function(path), expected, name)
+
+    def test_run_all(self):
+        results = hashing.run_all(2, 1000, repeat=1)
+        self.assertEqual([result['name'] for result in results],
+                         ['hash.' + name for name in hashing.BENCHMARKS])
+        for result in results:
+            self.assertEqual(result['bytes'], 2000)
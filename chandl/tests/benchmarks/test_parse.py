@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+
+from chandl.benchmarks import parse, synthetic
+from chandl.model.post import Post
+
+
+class TestParse(unittest.TestCase):
+
+    def test_run_all(self):
+        results = parse.run_all(20, repeat=1)
+        self.assertEqual([result['name'] for result in results],
+                         ['parse.' + name for name in parse.BENCHMARKS])
+        for result in results:
+            self.assertGreater(result['items'], 0)
+
+    def test_thread_counts_posts(self):
+        result = parse.run_all(20, names=['thread.parse_json'], repeat=1)[0]
+        self.assertEqual(result['items'], 20)
+
+    def test_bulk_matches_individual(self):
+        posts = synthetic.realistic_thread_json(500, seed=7)['posts']
+        self.assertListEqual(Post.parse_json_all('wg', posts),
+                             [Post.parse_json('wg', post) for post in posts])
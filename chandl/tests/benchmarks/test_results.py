@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+
+from chandl.benchmarks import results
+
+
+class TestMedian(unittest.TestCase):
+
+    def test_odd(self):
+        self.assertEqual(results.median([3, 1, 2]), 2)
+
+    def test_even(self):
+        self.assertEqual(results.median([4, 1, 2, 3]), 2.5)
+
+
+class TestCompare(unittest.TestCase):
+
+    _BASELINE = {
+        'results': [
+            {'name': 'a', 'params': {'x': 1}, 'wall': 2.0},
+            {'name': 'b', 'params': {'x': 1}, 'wall': 0}
+        ]
+    }
+
+    _CURRENT = {
+        'results': [
+            {'name': 'a', 'params': {'x': 1}, 'wall': 1.0},
+            {'name': 'a', 'params': {'x': 2}, 'wall': 1.0},
+            {'name': 'b', 'params': {'x': 1}, 'wall': 1.0}
+        ]
+    }
+
+    def test_compare(self):
+        self.assertListEqual(
+            results.compare(self._BASELINE, self._CURRENT, ['wall']),
+            [('a', 'wall', 2.0, 1.0, -0.5),
+             ('b', 'wall', 0, 1.0, None)])
+
+    def test_format_comparison(self):
+        table = results.format_comparison(
+            results.compare(self._BASELINE, self._CURRENT, ['wall']))
+        self.assertIn('-50.0%', table)
+
+
+class TestEnvironment(unittest.TestCase):
+
+    def test_keys(self):
+        environment = results.environment()
+        for key in ['chandl', 'commit', 'python', 'cpus']:
+            self.assertIn(key, environment)
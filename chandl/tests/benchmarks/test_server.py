@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+import hashlib
+import shutil
+import tempfile
+import os
+import requests
+
+from chandl.benchmarks.server import FakeChan
+from chandl.model.thread import Thread
+
+
+class TestFakeChan(unittest.TestCase):
+
+    _POSTS = 10
+    _FILE_SIZE = 1024
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeChan(posts=cls._POSTS, file_size=cls._FILE_SIZE,
+                            failure_rate=0.2, corrupt_rate=0.1)
+        cls.fake.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failure_selection(self):
+        self.assertEqual(len(self.fake.failing), 2)
+        self.assertEqual(len(self.fake.corrupt), 1)
+        self.assertFalse(self.fake.failing & self.fake.corrupt)
+
+    def test_deterministic(self):
+        other = FakeChan(posts=self._POSTS, file_size=self._FILE_SIZE,
+                         failure_rate=0.2, corrupt_rate=0.1)
+        self.assertEqual(other.failing, self.fake.failing)
+        self.assertEqual(other.corrupt, self.fake.corrupt)
+
+    def test_from_url(self):
+        with self.fake.patched():
+            thread = Thread.from_url(self.fake.thread_url)
+        self.assertEqual(len(thread.posts), self._POSTS)
+        self.assertEqual(thread.title, 'Synthetic thread')
+
+    def test_media_checksums(self):
+        with self.fake.patched():
+            posts = Thread.from_url(self.fake.thread_url).posts
+            for post in posts:
+                response = requests.get(post.file.url)
+                if post.file.id in self.fake.failing:
+                    self.assertEqual(response.status_code, 503)
+                    continue
+                self.assertEqual(len(response.content), self._FILE_SIZE)
+                self.assertEqual(
+                    hashlib.md5(response.content).hexdigest() == post.file.md5,
+                    post.file.id not in self.fake.corrupt)
+
+    def test_save_to(self):
+        with self.fake.patched():
+            posts = Thread.from_url(self.fake.thread_url).posts
+            post = [post for post in posts
+                    if post.file.id not in self.fake.failing and
+                    post.file.id not in self.fake.corrupt][0]
+            self.assertFalse(post.file.save_to(self.directory, 'a.jpg'))
+        self.assertEqual(
+            os.path.getsize(os.path.join(self.directory, 'a.jpg')),
+            self._FILE_SIZE)
+
+    def test_unknown_path(self):
+        with self.fake.patched():
+            response = requests.get(self.fake.root + '/wg/thread/1.json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_patched_restores(self):
+        from chandl.model import file, thread
+        with self.fake.patched():
+            pass
+        self.assertEqual(thread.API_ROOT, 'https://a.4cdn.org')
+        self.assertEqual(file.MEDIA_ROOT, 'https://i.4cdn.org')
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+import json
+import six
+
+from chandl.benchmarks import synthetic
+from chandl.model.thread import Thread
+
+
+class TestMedia(unittest.TestCase):
+
+    def test_too_small(self):
+        with self.assertRaises(ValueError):
+            synthetic.Media(7)
+
+    def test_unique(self):
+        media = synthetic.Media(100)
+        self.assertEqual(len(media.content(1)), 100)
+        self.assertNotEqual(media.md5(1), media.md5(2))
+
+
+class TestRealisticThread(unittest.TestCase):
+
+    def test_deterministic(self):
+        self.assertEqual(synthetic.realistic_thread_json(50, seed=3),
+                         synthetic.realistic_thread_json(50, seed=3))
+
+    def test_parses(self):
+        thread = Thread.parse_json(
+            'wg', synthetic.realistic_thread_json(200))
+        self.assertEqual(len(thread.posts), 200)
+        self.assertTrue(thread.posts[0].has_file)
+        self.assertTrue(any(not post.has_file for post in thread.posts))
+
+    def test_unique_files(self):
+        tims = [post['tim'] for post in synthetic.iter_posts(2000)
+                if 'tim' in post]
+        self.assertEqual(len(tims), len(set(tims)))
+
+    def test_write_thread(self):
+        handle = six.StringIO()
+        synthetic.write_thread(handle, 25, seed=1)
+        self.assertEqual(json.loads(handle.getvalue()),
+                         synthetic.realistic_thread_json(25, seed=1))
+
+
+class TestCatalog(unittest.TestCase):
+
+    def test_pages(self):
+        catalog = synthetic.catalog_json(40)
+        self.assertEqual([len(page['threads']) for page in catalog],
+                         [15, 15, 10])
+        self.assertEqual([page['page'] for page in catalog], [1, 2, 3])
+
+    def test_posts(self):
+        posts = list(synthetic.catalog_posts(synthetic.catalog_json(4,
+                                                                    replies=2)))
+        self.assertEqual(len(posts), 12)
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import unittest
+import hashlib
+import io
 import os
+import shutil
+import tempfile
 from httmock import all_requests, response, HTTMock
 from pyfakefs import fake_filesystem_unittest
 
@@ -39,6 +43,131 @@ class TestExpandFilters(unittest.TestCase):
                          set(['webm', 'gif', 'jpg', 'png'] + file.TYPE_VIDEO))
 
 
+class TestUnpackHashes(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertListEqual(file.unpack_hashes([]), [])
+
+    def test_hashes(self):
+        self.assertListEqual(
+            file.unpack_hashes(['iKLZQLYdEGgYi/xuNnd9nQ==',
+                                '56yiIJJgznhqupf3uu2xuA==']),
+            ['88a2d940b61d1068188bfc6e36777d9d',
+             'e7aca2209260ce786aba97f7baedb1b8'])
+
+
+class TestWrite(unittest.TestCase):
+
+    _CONTENT = os.urandom(200 * 1024)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_copy(self):
+        handle = io.BytesIO()
+        md5 = file._copy(io.BytesIO(self._CONTENT), handle)
+        self.assertEqual(handle.getvalue(), self._CONTENT)
+        self.assertEqual(md5, hashlib.md5(self._CONTENT).hexdigest())
+
+    def test_preallocate(self):
+        with io.open(self.path, 'wb') as handle:
+            file.preallocate(handle, 1000)
+            handle.write(b'content')
+            handle.truncate()
+        with io.open(self.path, 'rb') as handle:
+            self.assertEqual(handle.read(), b'content')
+
+    def test_drop_cache(self):
+        with io.open(self.path, 'wb') as handle:
+            handle.write(self._CONTENT)
+            file.drop_cache(handle)
+        self.assertEqual(util.md5_file(self.path),
+                         hashlib.md5(self._CONTENT).hexdigest())
+
+    def test_save_to_shorter(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(content=self._CONTENT, stream=True)
+
+        file_ = File(1, 'wg', 'file', 'jpg', len(self._CONTENT) * 2, 1, 1,
+                     hashlib.md5(self._CONTENT).hexdigest())
+        with HTTMock(response_content):
+            self.assertFalse(file_.save_to(self.directory, 'file',
+                                           cache=False))
+        self.assertEqual(os.path.getsize(self.path), len(self._CONTENT))
+
+    def test_save_to_subdirectory(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(content=self._CONTENT, stream=True)
+
+        os.mkdir(os.path.join(self.directory, 'webm'))
+        file_ = File(1, 'wg', 'file', 'webm', len(self._CONTENT), 1, 1,
+                     hashlib.md5(self._CONTENT).hexdigest())
+        with HTTMock(response_content):
+            self.assertFalse(file_.save_to(self.directory, 'webm/1.webm',
+                                           fsync=True))
+        self.assertListEqual(os.listdir(os.path.join(self.directory, 'webm')),
+                             ['1.webm'])
+
+    def test_remove_stale_parts(self):
+        os.mkdir(os.path.join(self.directory, 'webm'))
+        stale = os.path.join(self.directory, 'webm', '.1.webm.abc.part')
+        fresh = os.path.join(self.directory, '.2.jpg.def.part')
+        for path in [stale, fresh, self.path]:
+            open(path, 'wb').close()
+        os.utime(stale, (0, 0))
+        os.utime(self.path, (0, 0))
+        self.assertEqual(file.remove_stale_parts(self.directory), 1)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_save_to_mismatch_leaves_nothing(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(content=b'corrupt content', stream=True)
+
+        with HTTMock(response_content), self.assertRaises(IOError):
+            TestPost.POST.file.save_to(self.directory, 'file')
+        self.assertListEqual(os.listdir(self.directory), [])
+
+    def test_save_to_replaces(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(content=self._CONTENT, stream=True)
+
+        with open(self.path, 'wb') as f:
+            f.write(b'partial')
+        file_ = File(1, 'wg', 'file', 'jpg', len(self._CONTENT), 1, 1,
+                     hashlib.md5(self._CONTENT).hexdigest())
+        with HTTMock(response_content):
+            self.assertFalse(file_.save_to(self.directory, 'file',
+                                           fsync=True))
+        self.assertListEqual(os.listdir(self.directory), ['file'])
+        self.assertEqual(util.md5_file(self.path), file_.md5)
+
+    def test_sync(self):
+        with open(self.path, 'wb') as f:
+            f.write(self._CONTENT)
+        file.sync([self.path, os.path.join(self.directory, 'missing')])
+
+    def test_sync_drop_cache(self):
+        with open(self.path, 'wb') as f:
+            f.write(self._CONTENT)
+        file.sync([self.path], cache=False)
+        self.assertEqual(util.md5_file(self.path),
+                         hashlib.md5(self._CONTENT).hexdigest())
+
+
 class TestFile(fake_filesystem_unittest.TestCase):
 
     _RESOURCES_DIR = os.path.join(os.path.dirname(__file__), 'resources')
@@ -54,6 +183,11 @@ class TestFile(fake_filesystem_unittest.TestCase):
                         TestPost.POST_JSON['h'], TestPost.POST_JSON_FILE_MD5)
 
     def setUp(self):
+        # these act on real file descriptors, not the fake filesystem's
+        self.addCleanup(setattr, file, '_fallocate', file._fallocate)
+        self.addCleanup(setattr, file, '_fadvise', file._fadvise)
+        file._fallocate, file._fadvise = None, None
+
         self.setUpPyfakefs()
         self.fs.add_real_file(
                 os.path.join(self._RESOURCES_DIR, TestPost.POST.file.filename),
@@ -91,6 +225,11 @@ class TestFile(fake_filesystem_unittest.TestCase):
         self.assertEqual(File.parse_json(TestPost.BOARD, TestPost.POST_JSON),
                          self.file)
 
+    def test_parse_json_md5(self):
+        self.assertEqual(File.parse_json(TestPost.BOARD, TestPost.POST_JSON,
+                                         TestPost.POST_JSON_FILE_MD5),
+                         self.file)
+
     def test_url(self):
         self.assertEqual(self.file.url, TestPost.POST_JSON_FILE_URL)
 
@@ -152,6 +291,55 @@ class TestFile(fake_filesystem_unittest.TestCase):
                                        'dl.jpg')),
             TestPost.POST.file.md5)
 
+    def test_fetch(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(content=b'content', stream=True)
+
+        handle = io.BytesIO()
+        with HTTMock(response_content):
+            md5 = self.file.fetch(handle)
+        self.assertEqual(handle.getvalue(), b'content')
+        self.assertEqual(md5, '9a0364b9e99bb480dd25e1f0284c8555')
+
+    def test_fetch_non_200(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(404)
+
+        with HTTMock(response_content), self.assertRaises(IOError):
+            self.file.fetch(io.BytesIO())
+
+    def test_thumbnail_url(self):
+        self.assertEqual(self.file.thumbnail.url,
+                         '{0}/{1}/{2}s.jpg'.format(file.MEDIA_ROOT,
+                                                   TestPost.BOARD,
+                                                   TestPost.POST_JSON['tim']))
+
+    def test_thumbnail_save_to_exists(self):
+        # the checksum is unknown, so any existing file is kept
+        self.fs.create_file('/tmp/thumbnail.jpg', contents='thumbnail')
+        self.file.thumbnail.save_to(self._FAKE_DIR, 'thumbnail.jpg')
+
+    def test_thumbnail_save_to_ok(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(content=b'thumbnail', stream=True)
+
+        with HTTMock(response_content):
+            self.file.thumbnail.save_to(self._FAKE_DIR, 'thumbnail.jpg')
+        with open('/tmp/thumbnail.jpg', 'rb') as f:
+            self.assertEqual(f.read(), b'thumbnail')
+
+    def test_thumbnail_str(self):
+        self.assertEqual(str(self.file.thumbnail),
+                         'Thumbnail({0}, {1})'.format(
+                             TestPost.POST_JSON['tim'],
+                             TestPost.POST_JSON['filename']))
+
     def test_str(self):
         self.assertEqual(str(self.file),
                          'File({0}, {1}.{2}, {3}, {4}x{5})'.format(
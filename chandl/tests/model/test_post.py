@@ -6,7 +6,9 @@ import pytz
 
 from chandl import util
 from chandl.model.file import File
-from chandl.model.post import Post
+from chandl.model import post
+from chandl.model.post import Post, LazyPost, LazyPosts, MalformedPost, \
+    PostStream
 
 
 class TestPost(TestCase):
@@ -118,6 +120,16 @@ class TestPost(TestCase):
         self.assertEqual(Post.parse_json(self.BOARD, self.POST_JSON),
                          self.POST)
 
+    def test_parse_json_all(self):
+        self.assertListEqual(
+            Post.parse_json_all(self.BOARD, [self.POST_JSON,
+                                             self.POST_NO_FILE_JSON,
+                                             self._POST_NO_BODY_JSON]),
+            [self.POST, self._POST_NO_FILE, self._POST_NO_BODY])
+
+    def test_parse_json_all_empty(self):
+        self.assertListEqual(Post.parse_json_all(self.BOARD, []), [])
+
     def test_str(self):
         self.assertEqual(
             str(self.POST),
@@ -126,3 +138,140 @@ class TestPost(TestCase):
                 str(datetime.datetime.utcfromtimestamp(
                     self.POST_JSON['time']).replace(tzinfo=pytz.utc)),
                 str(self.POST.file)))
+
+
+class TestPostFormat(TestCase):
+
+    def test_fields(self):
+        self.assertEqual(
+            TestPost.POST.format('{board} {id} {file.name}.{file.extension}'),
+            'wg 6849229 wall_2.jpg')
+
+    def test_invalid_field(self):
+        with self.assertRaises(KeyError):
+            TestPost.POST.format('{file_name}')
+
+    def test_no_private_fields(self):
+        with self.assertRaises(KeyError):
+            TestPost.POST.format('{_key}')
+
+
+class TestLazyPost(TestCase):
+
+    def test_equal(self):
+        post = LazyPost(TestPost.BOARD, TestPost.POST_JSON)
+        self.assertEqual(post, TestPost.POST)
+        self.assertEqual(TestPost.POST, post)
+
+    def test_body_unescaped_on_read(self):
+        post = LazyPost(TestPost.BOARD, TestPost.POST_JSON)
+        # noinspection PyProtectedMember
+        self.assertEqual(post._escaped_body, TestPost.POST_JSON['com'])
+        self.assertEqual(post.body, TestPost.POST.body)
+        # noinspection PyProtectedMember
+        self.assertIsNone(post._escaped_body)
+
+    def test_no_file(self):
+        post = LazyPost(TestPost.BOARD, TestPost.POST_NO_FILE_JSON)
+        self.assertFalse(post.has_file)
+
+    def test_no_body(self):
+        json = dict(TestPost.POST_NO_FILE_JSON)
+        del json['com']
+        self.assertIsNone(LazyPost(TestPost.BOARD, json).body)
+
+    def test_set_body(self):
+        post = LazyPost(TestPost.BOARD, TestPost.POST_JSON)
+        post.body = 'replaced'
+        self.assertEqual(post.body, 'replaced')
+
+
+class TestLazyPosts(TestCase):
+
+    _JSON = [TestPost.POST_JSON, TestPost.POST_NO_FILE_JSON]
+
+    def test_len(self):
+        self.assertEqual(len(LazyPosts(TestPost.BOARD, self._JSON)), 2)
+
+    def test_decoded_on_access(self):
+        posts = LazyPosts(TestPost.BOARD, self._JSON)
+        # noinspection PyProtectedMember
+        self.assertEqual(posts._posts, [None, None])
+        self.assertEqual(posts[1], Post.parse_json(TestPost.BOARD,
+                                                   TestPost.POST_NO_FILE_JSON))
+        # noinspection PyProtectedMember
+        self.assertIsNone(posts._posts[0])
+        self.assertIs(posts[1], posts[1])
+
+    def test_raw(self):
+        posts = LazyPosts(TestPost.BOARD, self._JSON)
+        self.assertListEqual(posts.raw(), self._JSON)
+        # noinspection PyProtectedMember
+        self.assertEqual(posts._posts, [None, None])
+
+    def test_slice(self):
+        posts = LazyPosts(TestPost.BOARD, self._JSON)
+        self.assertListEqual(posts[:1], [TestPost.POST])
+
+    def test_filter(self):
+        posts = LazyPosts(TestPost.BOARD, self._JSON).filter(
+            lambda json: 'tim' in json)
+        self.assertListEqual(list(posts), [TestPost.POST])
+
+    def test_malformed(self):
+        json = dict(TestPost.POST_JSON)
+        del json['fsize']
+        posts = list(LazyPosts(TestPost.BOARD, [json] + self._JSON))
+        self.assertIsInstance(posts[0], MalformedPost)
+        self.assertEqual(posts[0].id, json['no'])
+        self.assertFalse(posts[0].has_file)
+        self.assertIsInstance(posts[0].error, KeyError)
+        # later posts are still decoded
+        self.assertListEqual(posts[1:], [TestPost.POST,
+                                         TestPost._POST_NO_FILE])
+
+    def test_equal(self):
+        self.assertEqual(
+            LazyPosts(TestPost.BOARD, self._JSON),
+            Post.parse_json_all(TestPost.BOARD, self._JSON))
+
+
+class TestPostStream(TestCase):
+
+    def test_malformed(self):
+        posts = list(PostStream(TestPost.BOARD, iter([
+            {'no': 1, 'time': 'yesterday'}, TestPost.POST_JSON])))
+        self.assertIsInstance(posts[0], MalformedPost)
+        self.assertIsInstance(posts[0].error, TypeError)
+        self.assertEqual(posts[1], TestPost.POST)
+
+
+class TestSelect(TestCase):
+
+    _JSON = [TestPost.POST_JSON, TestPost.POST_NO_FILE_JSON]
+
+    def _select(self, extensions=None, exclusions=None, ids=None):
+        return list(post.select(LazyPosts(TestPost.BOARD, self._JSON),
+                                extensions, exclusions, ids))
+
+    def test_files_only(self):
+        self.assertListEqual(self._select(), [TestPost.POST])
+
+    def test_extensions(self):
+        self.assertListEqual(self._select({'png'}), [])
+        self.assertListEqual(self._select({TestPost.POST.file.extension}),
+                             [TestPost.POST])
+
+    def test_exclusions(self):
+        self.assertListEqual(self._select(exclusions={TestPost.POST.file.name}),
+                             [])
+
+    def test_malformed(self):
+        json = {'no': 1, 'tim': 1}
+        self.assertListEqual(list(post.select(
+            LazyPosts(TestPost.BOARD, [json]), {'jpg'}, {'name'})), [])
+
+    def test_ids(self):
+        self.assertListEqual(self._select(ids={1}), [])
+        self.assertListEqual(self._select(ids={TestPost.POST.file.id}),
+                             [TestPost.POST])
@@ -7,7 +7,7 @@ import pytz
 from httmock import all_requests, response, HTTMock
 
 from chandl.model.file import File
-from chandl.model.post import Post
+from chandl.model.post import Post, LazyPosts, PostStream
 from chandl.model.thread import Thread
 
 
@@ -178,10 +178,50 @@ class TestThread(unittest.TestCase):
         self.assertEqual(Thread.parse_json(self._BOARD, self._THREAD_JSON),
                          self._thread)
 
+    def test_parse_json_lazy(self):
+        thread = Thread.parse_json(self._BOARD, self._THREAD_JSON, lazy=True)
+        self.assertIsInstance(thread.posts, LazyPosts)
+        self.assertEqual(thread, self._thread)
+
+    def test_parse_stream(self):
+        data = json.dumps(self._THREAD_JSON).encode('utf-8')
+        thread = Thread.parse_stream(self._BOARD,
+                                     [data[i:i + 100]
+                                      for i in range(0, len(data), 100)])
+        self.assertIsInstance(thread.posts, PostStream)
+        self.assertEqual(thread.title, self._TITLE)
+        self.assertListEqual(list(thread.posts), self.POSTS)
+
+    def test_parse_stream_filter(self):
+        thread = Thread.parse_stream(
+            self._BOARD, [json.dumps(self._THREAD_JSON).encode('utf-8')])
+        self.assertListEqual(
+            list(thread.posts.filter(lambda post: post.get('ext') == '.png')),
+            self.POSTS[:1])
+
+    def test_parse_stream_tap(self):
+        seen = []
+        thread = Thread.parse_stream(
+            self._BOARD, [json.dumps(self._THREAD_JSON).encode('utf-8')])
+        posts = thread.posts.tap(lambda post: seen.append(post['no']))
+        list(posts.filter(lambda post: post.get('ext') == '.png'))
+        self.assertListEqual(seen, [post.id for post in self.POSTS])
+
+    def test_parse_stream_no_posts(self):
+        with self.assertRaises(ValueError):
+            Thread.parse_stream(self._BOARD, [b'{"posts": []}'])
+
     def test_parse_json_no_posts(self):
         with self.assertRaises(ValueError):
             Thread.parse_json(self._BOARD, {'posts': []})
 
+    def test_parse_url(self):
+        self.assertEqual(Thread.parse_url(self._VALID_URL), ('wg', 6847183))
+
+    def test_parse_url_invalid(self):
+        with self.assertRaises(ValueError):
+            Thread.parse_url('http://boards.4chan.org/thread/abcd')
+
     def test_from_url_invalid_url(self):
         with self.assertRaises(ValueError):
             Thread.from_url('http://boards.4chan.org/thread/abcd')
@@ -232,6 +272,27 @@ class TestThread(unittest.TestCase):
             self.assertEqual(Thread.from_url(self._VALID_URL),
                              self._thread)
 
+    def test_from_url_stream(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(content=json.dumps(self._THREAD_JSON),
+                            stream=True)
+
+        with HTTMock(response_content):
+            thread = Thread.from_url(self._VALID_URL, stream=True)
+            self.assertEqual(thread.title, self._TITLE)
+            self.assertListEqual(list(thread.posts), self.POSTS)
+
+    def test_from_url_stream_invalid_json(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(content='invalid json here', stream=True)
+
+        with HTTMock(response_content), self.assertRaises(IOError):
+            Thread.from_url(self._VALID_URL, stream=True)
+
     def test_str(self):
         self.assertEqual(str(self._thread),
                          'Thread({0}, {1})'.format(self._ID, self._BOARD))
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from httmock import all_requests, response, HTTMock
+
+from chandl import archive
+from chandl.model.post import Post
+from chandl.tests.model.test_post import TestPost
+
+
+class TestArchive(unittest.TestCase):
+
+    _RESOURCE = os.path.join(os.path.dirname(__file__), 'model', 'resources',
+                             TestPost.POST.file.filename)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _posts(count):
+        return [Post(TestPost.BOARD, i, TestPost.POST.timestamp,
+                     file_=TestPost.POST.file) for i in range(count)]
+
+    def _save(self, path, names, content=None):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            if content is not None:
+                return response(content=content, stream=True)
+            with open(self._RESOURCE, 'rb') as f:
+                return response(content=f.read(), stream=True)
+
+        with HTTMock(response_content), archive.Archive(path) as archive_:
+            return [archive_.save(post, name)
+                    for post, name in zip(self._posts(len(names)), names)]
+
+    def _manifest(self, path):
+        with io.open(path + archive.MANIFEST_SUFFIX, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            archive.Archive(self._path('thread.rar'))
+
+    def test_tar(self):
+        path = self._path('thread.tar')
+        self.assertListEqual(self._save(path, ['a.jpg', 'b.jpg']),
+                             [False, False])
+        with tarfile.open(path) as tar:
+            self.assertListEqual(tar.getnames(), ['a.jpg', 'b.jpg'])
+            self.assertEqual(tar.getmember('a.jpg').size,
+                             os.path.getsize(self._RESOURCE))
+
+    def test_tar_gz(self):
+        path = self._path('thread.tar.gz')
+        self._save(path, ['a.jpg'])
+        with tarfile.open(path) as tar:
+            self.assertListEqual(tar.getnames(), ['a.jpg'])
+
+    def test_zip(self):
+        path = self._path('thread.zip')
+        self._save(path, ['a.jpg', 'b.jpg'])
+        with zipfile.ZipFile(path) as zip_:
+            self.assertListEqual(zip_.namelist(), ['a.jpg', 'b.jpg'])
+            with open(self._RESOURCE, 'rb') as f:
+                self.assertEqual(zip_.read('b.jpg'), f.read())
+
+    @unittest.skipIf(archive.zstandard is None, 'zstandard is not installed')
+    def test_tar_zstd(self):
+        path = self._path('thread.tar.zst')
+        self._save(path, ['a.jpg', 'b.jpg'])
+        with open(path, 'rb') as f:
+            reader = archive.zstandard.ZstdDecompressor().stream_reader(f)
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                self.assertListEqual(tar.getnames(), ['a.jpg', 'b.jpg'])
+
+    def test_manifest(self):
+        path = self._path('thread.zip')
+        self._save(path, ['a.jpg'])
+        entry, = self._manifest(path)
+        self.assertEqual(entry['name'], 'a.jpg')
+        self.assertEqual(entry['md5'], TestPost.POST.file.md5)
+        self.assertEqual(entry['archive'], 'thread.zip')
+
+    def test_manifest_after_flush(self):
+        path = self._path('thread.zip')
+        archive_ = archive.Archive(path)
+        calls = []
+        flush, write = archive_._flush, archive_._manifest.write
+        archive_._flush = lambda: (calls.append('flush'), flush())
+        archive_._manifest.write = lambda line: (calls.append('manifest'),
+                                                 write(line))
+        post, = self._posts(1)
+        with open(self._RESOURCE, 'rb') as f:
+            handle = io.BytesIO(f.read())
+        handle.seek(0, io.SEEK_END)
+        archive_._put((post, 'a.jpg', handle))
+        archive_.close()
+        self.assertListEqual(calls, ['flush', 'manifest'])
+
+    def test_resume_skips(self):
+        path = self._path('thread.tar')
+        self._save(path, ['a.jpg'])
+        self.assertListEqual(self._save(path, ['a.jpg']), [True])
+        with tarfile.open(path) as tar:
+            self.assertListEqual(tar.getnames(), ['a.jpg'])
+
+    def test_resume_appends(self):
+        path = self._path('thread.zip')
+        self._save(path, ['a.jpg'])
+        os.remove(path + archive.MANIFEST_SUFFIX)
+        self._save(path, ['b.jpg'])
+        with zipfile.ZipFile(path) as zip_:
+            self.assertListEqual(zip_.namelist(), ['a.jpg', 'b.jpg'])
+
+    def test_resume_interrupted_zip(self):
+        path = self._path('thread.zip')
+        self._save(path, ['a.jpg'])
+        # as left by a run killed before writing the central directory
+        with zipfile.ZipFile(path) as zip_:
+            end = zip_.getinfo('a.jpg').compress_size + 64
+        with open(path, 'r+b') as f:
+            f.truncate(end)
+        self.assertListEqual(self._save(path, ['a.jpg']), [False])
+        with zipfile.ZipFile(self._path('thread.2.zip')) as zip_:
+            self.assertListEqual(zip_.namelist(), ['a.jpg'])
+        self.assertEqual(self._manifest(path)[-1]['archive'], 'thread.2.zip')
+
+    def test_resume_interrupted_tar(self):
+        path = self._path('thread.tar')
+        self._save(path, ['a.jpg'])
+        entry, = self._manifest(path)
+        # as left by a run killed partway through adding a file
+        info = tarfile.TarInfo('c.jpg')
+        info.size = 1000
+        with open(path, 'r+b') as f:
+            f.seek(entry['end'])
+            f.write(info.tobuf() + b'x' * 300)
+            f.truncate()
+        # every test post has the same file, so make it look like another
+        entry['file'] += 1
+        with io.open(path + archive.MANIFEST_SUFFIX, 'w',
+                     encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.assertListEqual(self._save(path, ['b.jpg']), [False])
+        with tarfile.open(path) as tar, open(self._RESOURCE, 'rb') as f:
+            self.assertListEqual(tar.getnames(), ['a.jpg', 'b.jpg'])
+            self.assertEqual(tar.extractfile('b.jpg').read(), f.read())
+
+    def test_resume_compressed_part(self):
+        path = self._path('thread.tar.gz')
+        self._save(path, ['a.jpg'])
+        os.remove(path + archive.MANIFEST_SUFFIX)
+        self._save(path, ['b.jpg'])
+        with tarfile.open(self._path('thread.2.tar.gz')) as tar:
+            self.assertListEqual(tar.getnames(), ['b.jpg'])
+        self.assertEqual(self._manifest(path)[0]['archive'],
+                         'thread.2.tar.gz')
+
+    def test_resume_nothing_new(self):
+        path = self._path('thread.tar.gz')
+        self._save(path, ['a.jpg'])
+        self._save(path, ['a.jpg'])
+        self.assertFalse(os.path.exists(self._path('thread.2.tar.gz')))
+
+    def test_verify_mismatch(self):
+        path = self._path('thread.tar')
+        with self.assertRaises(IOError):
+            self._save(path, ['a.jpg'], b'corrupt content')
+        self.assertFalse(os.path.exists(path))
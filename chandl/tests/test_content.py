@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from httmock import all_requests, response, HTTMock
+
+from chandl import content
+from chandl.model.post import Post
+from chandl.tests.model.test_post import TestPost
+
+
+class TestObjectPath(unittest.TestCase):
+
+    def test_sharded(self):
+        md5 = TestPost.POST.file.md5
+        self.assertEqual(content.object_path(TestPost.POST.file),
+                         os.path.join(md5[:2], md5[2:4], md5 + '.jpg'))
+
+
+@unittest.skipUnless(hasattr(os, 'symlink'), 'symlinks are unsupported')
+class TestContentDirectory(unittest.TestCase):
+
+    _RESOURCE = os.path.join(os.path.dirname(__file__), 'model', 'resources',
+                             TestPost.POST.file.filename)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.root = os.path.join(self.directory, 'objects')
+        self.thread_dir = os.path.join(self.directory, 'thread')
+        os.mkdir(self.thread_dir)
+        self.object = os.path.join(self.root,
+                                   content.object_path(TestPost.POST.file))
+        self.requests = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _save(self, names, link=True, content_=None):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            self.requests += 1
+            if content_ is not None:
+                return response(content=content_, stream=True)
+            with open(self._RESOURCE, 'rb') as f:
+                return response(content=f.read(), stream=True)
+
+        posts = [Post(TestPost.BOARD, i, TestPost.POST.timestamp,
+                      file_=TestPost.POST.file) for i in range(len(names))]
+        with HTTMock(response_content), \
+                content.ContentDirectory(self.root, self.thread_dir,
+                                         link) as directory:
+            return [directory.save(post, name)
+                    for post, name in zip(posts, names)]
+
+    def test_stored_once(self):
+        self.assertListEqual(self._save(['a.jpg', 'b.jpg']), [False, True])
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(os.path.getsize(self.object),
+                         os.path.getsize(self._RESOURCE))
+
+    def test_symlinks(self):
+        self._save(['a.jpg', 'b.jpg'])
+        self.assertListEqual(sorted(os.listdir(self.thread_dir)),
+                             ['a.jpg', 'b.jpg'])
+        self.assertEqual(
+            os.path.realpath(os.path.join(self.thread_dir, 'a.jpg')),
+            os.path.realpath(self.object))
+
+    def test_rerun_skips_without_hashing(self):
+        self._save(['a.jpg'])
+        with open(self.object, 'ab') as f:
+            f.write(b'corruption a hash would notice')
+        self.assertListEqual(self._save(['a.jpg']), [True])
+        self.assertEqual(self.requests, 1)
+
+    def test_manifest(self):
+        self._save(['a.jpg', 'b.jpg'], link=False)
+        self._save(['a.jpg', 'b.jpg'], link=False)
+        self.assertListEqual(os.listdir(self.thread_dir),
+                             [content.MANIFEST_NAME])
+        with io.open(os.path.join(self.thread_dir, content.MANIFEST_NAME),
+                     encoding='utf-8') as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['path'],
+                         content.object_path(TestPost.POST.file))
+
+    def test_verify_mismatch(self):
+        with self.assertRaises(IOError):
+            self._save(['a.jpg'], content_=b'corrupt content')
+        self.assertListEqual(os.listdir(os.path.dirname(self.object)), [])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+import six
+
+from chandl import control
+from chandl.downloader import Downloader
+
+
+class TestControl(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'control')
+        self.downloader = Downloader(self.directory, '{id}.jpg', 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, text):
+        with io.open(self.path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def test_parse_rate(self):
+        self.assertEqual(control.parse_rate('1000'), 1000)
+        self.assertEqual(control.parse_rate('500K'), 500 * 1024)
+        self.assertEqual(control.parse_rate('1.5m'), 3 * 512 * 1024)
+        self.assertEqual(control.parse_rate('0'), 0)
+        for rate in ['', 'K', 'fast', '-1', '2T']:
+            with self.assertRaises(ValueError):
+                control.parse_rate(rate)
+
+    def test_read(self):
+        self._write('# retune\nparallelism = 8\n\nlimit-rate=2M\n')
+        self.assertDictEqual(control.read_settings(self.path),
+                             {'parallelism': 8, 'limit-rate': 2 * 1024 ** 2})
+
+    def test_read_invalid(self):
+        for text in ['parallelism = 0', 'parallelism = many', 'threads = 8']:
+            self._write(text)
+            with self.assertRaises(ValueError):
+                control.read_settings(self.path)
+
+    def test_apply(self):
+        self._write('parallelism = 8\nlimit-rate = 1K\n')
+        control.apply_settings(self.downloader, self.path, 2)
+        self.assertEqual(self.downloader.snapshot().threads,
+                         multiprocessing.cpu_count() * 16)
+        self.assertEqual(self.downloader.throttle.rate, 1024)
+
+        self._write('limit-rate = 0\n')
+        control.apply_settings(self.downloader, self.path)
+        self.assertIsNone(self.downloader.throttle.rate)
+
+    def test_apply_invalid(self):
+        self._write('parallelism = 0')
+        control.apply_settings(self.downloader, self.path)
+        self.assertEqual(self.downloader.snapshot().threads,
+                         multiprocessing.cpu_count())
+
+    def test_controlled_file(self):
+        self._write('limit-rate = 1K\n')
+        with control.controlled(self.downloader, self.path):
+            pass
+        self.assertEqual(self.downloader.throttle.rate, 1024)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'),
+                         'signals are unavailable')
+    def test_controlled_signals(self):
+        handler = signal.getsignal(signal.SIGUSR2)
+        try:
+            sys.stderr = six.StringIO()
+            with control.controlled(self.downloader, self.path):
+                self._write('limit-rate = 1K\n')
+                os.kill(os.getpid(), signal.SIGUSR2)
+                os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertIn('0 jobs queued, 0 in progress',
+                          sys.stderr.getvalue())
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertEqual(self.downloader.throttle.rate, 1024)
+        self.assertIs(signal.getsignal(signal.SIGUSR2), handler)
+
+
+if __name__ == '__main__':
+    unittest.main()
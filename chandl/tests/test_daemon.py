@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+import requests
+
+from chandl import daemon, store
+from chandl.benchmarks.server import FakeChan
+
+
+class TestCheckOptions(unittest.TestCase):
+
+    def test_valid(self):
+        daemon._check_options({'filter': ['jpg'], 'exclude': [],
+                               'name': '{id}.jpg', 'thread_dir': 'papes'})
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            daemon._check_options({'output_dir': '/'})
+
+    def test_filter_not_list(self):
+        with self.assertRaises(ValueError):
+            daemon._check_options({'filter': 'jpg'})
+
+    def test_thread_dir_escapes(self):
+        for thread_dir in ('../papes', '..', 'a/b'):
+            with self.assertRaises(ValueError):
+                daemon._check_options({'thread_dir': thread_dir})
+
+    def test_name_escapes(self):
+        for name in ('../{id}.jpg', '/tmp/{id}.jpg', 'a/../../{id}.jpg',
+                     '..\\{id}.jpg'):
+            with self.assertRaises(ValueError):
+                daemon._check_options({'name': name})
+
+    def test_name_subdirectory(self):
+        daemon._check_options({'name': 'webm/{id}.webm'})
+
+    def test_inside(self):
+        self.assertTrue(daemon._inside('/out/thread', 'webm/1.webm'))
+        self.assertFalse(daemon._inside('/out/thread', '../1.webm'))
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = store.Store(os.path.join(self.directory, 'chandl.db'))
+        self.chan = FakeChan(posts=5, file_size=1024)
+        self.chan.start()
+        self.patch = self.chan.patched()
+        self.patch.__enter__()
+        self.daemon = daemon.Daemon(self.store, self.directory, '{id}.jpg', 1)
+
+    def tearDown(self):
+        self.patch.__exit__(None, None, None)
+        self.chan.stop()
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def _start(self):
+        self.daemon.start(('127.0.0.1', 0))
+        self.addCleanup(self.daemon.stop)
+        return 'http://{0}:{1}'.format(*self.daemon.address)
+
+    def _wait(self, base, job_id):
+        for _ in range(100):
+            job = requests.get('{0}/jobs/{1}'.format(base, job_id)).json()
+            if job['status'] in (store.JOB_DONE, store.JOB_FAILED):
+                return job
+            time.sleep(.05)
+        self.fail('Job {0} did not finish'.format(job_id))
+
+    def test_submit(self):
+        base = self._start()
+        response = requests.post(base + '/jobs',
+                                 json={'url': self.chan.thread_url,
+                                       'thread_dir': 'papes'})
+        self.assertEqual(response.status_code, 202)
+        job = self._wait(base, response.json()['id'])
+        self.assertEqual(job['status'], store.JOB_DONE)
+        self.assertEqual(job['downloaded'], 5)
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.directory, 'papes'))), 5)
+
+    def test_downloaded_elsewhere(self):
+        base = self._start()
+        first = self._wait(base, self.daemon.submit(
+            self.chan.thread_url, {'thread_dir': 'a'})['id'])
+        again = self._wait(base, self.daemon.submit(
+            self.chan.thread_url, {'thread_dir': 'a'})['id'])
+        elsewhere = self._wait(base, self.daemon.submit(
+            self.chan.thread_url, {'thread_dir': 'b'})['id'])
+        self.assertEqual(first['downloaded'], 5)
+        self.assertEqual(again['downloaded'], 0)
+        self.assertEqual(elsewhere['downloaded'], 5)
+
+    def test_submit_invalid_url(self):
+        response = requests.post(self._start() + '/jobs',
+                                 json={'url': 'http://example.com'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_submit_malformed(self):
+        response = requests.post(self._start() + '/jobs', data='{')
+        self.assertEqual(response.status_code, 400)
+
+    def test_failed_job(self):
+        base = self._start()
+        response = requests.post(
+            base + '/jobs',
+            json={'url': 'https://boards.4chan.org/wg/thread/1'})
+        job = self._wait(base, response.json()['id'])
+        self.assertEqual(job['status'], store.JOB_FAILED)
+        self.assertIn('404', job['error'])
+
+    def test_unexpected_error(self):
+        download = self.daemon._download
+        calls = []
+
+        def _download(job):
+            calls.append(job)
+            if len(calls) == 1:
+                raise RuntimeError('bug')
+            return download(job)
+        self.daemon._download = _download
+
+        base = self._start()
+        with self.assertLogs(daemon.logger, 'ERROR'):
+            first = self.daemon.submit(self.chan.thread_url)['id']
+            second = self.daemon.submit(self.chan.thread_url)['id']
+            job = self._wait(base, first)
+        self.assertEqual(job['status'], store.JOB_FAILED)
+        self.assertEqual(job['error'], 'bug')
+        # the worker survives to run the next job
+        self.assertEqual(self._wait(base, second)['status'], store.JOB_DONE)
+
+    def test_invalid_name(self):
+        base = self._start()
+        for name in ['{file.nope}', '{id:q}']:
+            job = self._wait(base, self.daemon.submit(
+                self.chan.thread_url, {'name': name})['id'])
+            self.assertEqual(job['status'], store.JOB_FAILED, name)
+            self.assertIn('name', job['error'])
+
+    def test_jobs(self):
+        base = self._start()
+        self.daemon.submit(self.chan.thread_url)
+        jobs = requests.get(base + '/jobs').json()['jobs']
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]['url'], self.chan.thread_url)
+
+    def test_job_not_found(self):
+        self.assertEqual(
+            requests.get(self._start() + '/jobs/1').status_code, 404)
+
+    def test_metrics(self):
+        base = self._start()
+        self._wait(base, self.daemon.submit(self.chan.thread_url)['id'])
+        metrics = requests.get(base + '/metrics').text
+        self.assertIn('chandl_jobs{status="done"} 1', metrics)
+        self.assertIn('chandl_files_total{outcome="downloaded"} 5', metrics)
+
+    def test_resume_unfinished(self):
+        job_id = self.store.add_job(self.chan.thread_url, {})
+        self.store.claim_job()  # as if the previous daemon died
+        base = self._start()
+        self.assertEqual(self._wait(base, job_id)['status'], store.JOB_DONE)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'),
+                         'Unix sockets are unsupported')
+    def test_unix_socket(self):
+        path = os.path.join(self.directory, 'chandl.sock')
+        self.daemon.start(path)
+        try:
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(path)
+            client.sendall(b'GET /jobs HTTP/1.0\r\n\r\n')
+            response = b''
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+            client.close()
+        finally:
+            self.daemon.stop()
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.0 200'))
+        self.assertEqual(json.loads(body.decode('utf-8')), {'jobs': []})
+        self.assertFalse(os.path.exists(path))
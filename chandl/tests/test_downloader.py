@@ -2,70 +2,524 @@
 from __future__ import unicode_literals
 
 import datetime
+import io
+import multiprocessing
 import unittest
 import os
-import signal
+import shutil
+import tempfile
+import threading
+import time
+from httmock import all_requests, response, urlmatch, HTTMock
 
-from chandl import downloader
+from chandl import downloader, store, archive, jobs, mirrors, stats, \
+    timeline, transport
+from chandl.model.post import Post, LazyPosts, MalformedPost, PostStream
+from chandl.tests.model.test_post import TestPost
 from chandl.tests.model.test_thread import TestThread
 
 
-class TestHandleSigint(unittest.TestCase):
+class _Body(io.RawIOBase):
 
-    def setUp(self):
-        downloader._interrupted = False
+    def __init__(self, content, on_read):
+        super(_Body, self).__init__()
+        self._content = io.BytesIO(content)
+        self._on_read = on_read
 
-    def tearDown(self):
-        downloader._interrupted = False
+    def readable(self):
+        return True
 
-    def test_interrupted(self):
-        downloader._handle_sigint(None, None)
-        self.assertTrue(downloader._interrupted)
+    def readinto(self, buffer_):
+        self._on_read()
+        return self._content.readinto(buffer_)
 
 
-class TestRedirectSigint(unittest.TestCase):
+class _Transport:
 
-    def setUp(self):
-        downloader._interrupted = False
+    def __init__(self, content, on_read=lambda: None):
+        self._content = content
+        self._on_read = on_read
+
+    def get(self, url, stream=False):
+        return transport.Response(url, 200, _Body(self._content,
+                                                  self._on_read))
+
+
+class TestCancellation(unittest.TestCase):
+
+    def test_cancel(self):
+        cancellation = downloader.Cancellation()
+        self.assertFalse(cancellation.cancelled)
+        cancellation.cancel()
+        self.assertTrue(cancellation.cancelled)
+
+    def test_transport(self):
+        cancellation = downloader.Cancellation()
+        transport_ = downloader._CancellableTransport(
+            _Transport(b'content'), cancellation)
+        response_ = transport_.get('url')
+        self.assertEqual(response_.raw.read(3), b'con')
+        cancellation.cancel()
+        with self.assertRaises(downloader.Cancelled):
+            response_.raw.read()
+        with self.assertRaises(downloader.Cancelled):
+            transport_.get('url')
 
-    def tearDown(self):
-        downloader._interrupted = False
 
-    def test_interrupted(self):
-        with downloader._redirect_sigint():
-            os.kill(os.getpid(), signal.SIGINT)
-        self.assertTrue(downloader._interrupted)
+class TestThrottle(unittest.TestCase):
 
-    def test_exception(self):
-        with self.assertRaises(ValueError), downloader._redirect_sigint():
-            raise ValueError()
+    def test_unlimited(self):
+        throttle = downloader.Throttle()
+        start = time.time()
+        throttle.consume(10 * 1024 ** 3)
+        throttle.consume(10 * 1024 ** 3)
+        self.assertLess(time.time() - start, .1)
+        self.assertEqual(throttle.transferred, 20 * 1024 ** 3)
+
+    def test_limited(self):
+        throttle = downloader.Throttle(100 * 1024)
+        start = time.time()
+        throttle.consume(50 * 1024)
+        throttle.consume(50 * 1024)
+        # a quarter of a second is allowed in a burst
+        self.assertGreaterEqual(time.time() - start, .7)
+
+    def test_cancelled(self):
+        throttle = downloader.Throttle(1024)
+        cancellation = downloader.Cancellation()
+        cancellation.cancel()
+        start = time.time()
+        throttle.consume(10 * 1024, cancellation)
+        self.assertLess(time.time() - start, .1)
+        self.assertEqual(throttle.transferred, 10 * 1024)
+
+    def test_transport(self):
+        throttle = downloader.Throttle()
+        transport_ = downloader._CancellableTransport(
+            _Transport(b'content'), downloader.Cancellation(), throttle)
+        self.assertEqual(transport_.get('url').raw.read(), b'content')
+        self.assertEqual(throttle.transferred, len(b'content'))
 
 
 class TestDownloadResult(unittest.TestCase):
 
     _DOWNLOADED_JOBS = [post for post in TestThread.POSTS
                         if post.has_file and post.file.extension == 'jpg']
-    _FAILED_JOBS = []
-    _SKIPPED_JOBS = []
     _REMAINING_JOBS = [post for post in TestThread.POSTS
                        if post.has_file and post.file.extension == 'png']
     _ELAPSED = datetime.timedelta(microseconds=98520934)
 
+    @classmethod
+    def _tally(cls, failed_jobs=(), keep=(downloader.OUTCOME_FAILED,)):
+        tally = stats.Tally(keep)
+        for outcome, posts in [(downloader.OUTCOME_DOWNLOADED,
+                                cls._DOWNLOADED_JOBS),
+                               (downloader.OUTCOME_FAILED, failed_jobs),
+                               (downloader.OUTCOME_REMAINING,
+                                cls._REMAINING_JOBS)]:
+            for post in posts:
+                tally.add(outcome, post)
+        return tally
+
     @classmethod
     def setUpClass(cls):
-        cls.result = downloader.DownloadResult(cls._DOWNLOADED_JOBS,
-                                               cls._FAILED_JOBS,
-                                               cls._SKIPPED_JOBS,
-                                               cls._REMAINING_JOBS,
-                                               cls._ELAPSED)
+        cls.result = downloader.DownloadResult(cls._tally(), cls._ELAPSED)
 
-    def test_posts_size(self):
-        self.assertEqual(
-            downloader.DownloadResult._posts_size(self._DOWNLOADED_JOBS),
-            sum([post.file.size for post in self._DOWNLOADED_JOBS]))
+    def test_totals(self):
+        self.assertEqual(self.result.downloaded_bytes,
+                         sum(post.file.size for post in self._DOWNLOADED_JOBS))
+        self.assertEqual(self.result.total_jobs, 3)
+        self.assertListEqual(self.result.failed_jobs, [])
 
     def test_str(self):
         self.assertEqual(str(self.result),
                          '2/3 jobs completed, 0 failed, 0 skipped\n'
                          '646.2 KiB/681.0 KiB downloaded, 0.0 B skipped\n'
                          'Duration: 98.521 seconds (6.6 KiB/s)')
+
+    def test_str_hosts(self):
+        host = mirrors.Host('https://i.4cdn.org')
+        result = downloader.DownloadResult(self._tally(), self._ELAPSED,
+                                           [host])
+        self.assertTrue(str(result).endswith(
+            '\nhttps://i.4cdn.org: 0 requests, 0 errors, 0.0 B downloaded'))
+
+    def test_str_thumbnails(self):
+        result = downloader.DownloadResult(self._tally(), self._ELAPSED,
+                                           thumbnails=True)
+        self.assertTrue(str(result).startswith('2/3 thumbnails completed'))
+
+    def test_str_latency(self):
+        tally = self._tally()
+        tally.add(downloader.OUTCOME_DOWNLOADED, TestPost.POST, .07)
+        result = downloader.DownloadResult(tally, self._ELAPSED)
+        self.assertTrue(str(result).endswith(
+            '\nDownload times: 50% within 70 ms, 90% within 70 ms, '
+            'slowest 70 ms'))
+
+    def test_str_failed(self):
+        result = downloader.DownloadResult(self._tally([TestPost.POST]),
+                                           self._ELAPSED)
+        self.assertTrue(str(result).endswith(
+            '\nFailed: {0}'.format(TestPost.POST.file)))
+
+    def test_summary_only(self):
+        result = downloader.DownloadResult(self._tally([TestPost.POST], ()),
+                                           self._ELAPSED)
+        self.assertIsNone(result.failed_jobs)
+        self.assertEqual(result.failed_job_count, 1)
+        self.assertNotIn('Failed:', str(result))
+
+
+class TestDownloader(unittest.TestCase):
+
+    _RESOURCE = os.path.join(os.path.dirname(__file__), 'model', 'resources',
+                             TestPost.POST.file.filename)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def _posts(count):
+        for i in range(count):
+            yield Post(TestPost.BOARD, i, TestPost.POST.timestamp,
+                       file_=TestPost.POST.file)
+
+    def _download(self, posts, store_=None, archive_=None, queue=None,
+                  fsync=downloader.FSYNC_NONE):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            with open(self._RESOURCE, 'rb') as f:
+                return response(content=f.read(), stream=True)
+
+        with HTTMock(response_content):
+            return downloader.Downloader(self.directory, '{id}.jpg', 1,
+                                         store_, archive_, queue=queue,
+                                         fsync=fsync).download(posts)
+
+    def test_download_list(self):
+        result = self._download(list(self._posts(3)))
+        self.assertEqual(result.downloaded_job_count, 3)
+        self.assertListEqual(sorted(os.listdir(self.directory)),
+                             ['0.jpg', '1.jpg', '2.jpg'])
+
+    def test_download_fsync(self):
+        synced = []
+        sync = downloader.file.sync
+        downloader.file.sync = lambda paths, cache: synced.extend(paths)
+        try:
+            for mode in downloader.FSYNC_MODES:
+                result = self._download(list(self._posts(3)), fsync=mode)
+                self.assertEqual(result.downloaded_job_count, 3, mode)
+                for name in os.listdir(self.directory):
+                    os.remove(os.path.join(self.directory, name))
+        finally:
+            downloader.file.sync = sync
+        # the thread and end modes flush the files they wrote in batches
+        self.assertEqual(len(synced), 6)
+
+    def test_download_stream(self):
+        result = self._download(self._posts(5))
+        self.assertEqual(result.downloaded_job_count, 5)
+        self.assertEqual(len(os.listdir(self.directory)), 5)
+
+    def test_download_malformed(self):
+        json = {'no': 1, 'tim': 1, 'time': TestPost.POST_JSON['time']}
+        for posts in [
+                LazyPosts(TestPost.BOARD, [json, TestPost.POST_JSON]),
+                PostStream(TestPost.BOARD, iter([json, TestPost.POST_JSON]))]:
+            result = self._download(posts)
+            # the post after the malformed one is still downloaded
+            self.assertEqual(result.downloaded_job_count, 1)
+            self.assertEqual(result.failed_job_count, 1)
+            self.assertIsInstance(result.failed_jobs[0], MalformedPost)
+            self.assertIn('Failed: MalformedPost(1, ', str(result))
+            shutil.rmtree(self.directory)
+            os.mkdir(self.directory)
+
+    def test_download_empty_stream(self):
+        result = self._download(self._posts(0))
+        self.assertEqual(result.total_jobs, 0)
+
+    def test_download_stream_error(self):
+        def posts():
+            for post in self._posts(2):
+                yield post
+            raise ValueError('Malformed JSON')
+
+        result = self._download(posts())
+        self.assertEqual(result.downloaded_job_count, 2)
+
+    def test_download_store(self):
+        posts = [Post(TestPost.BOARD, i, TestPost.POST.timestamp,
+                      file_=TestPost.POST.file) for i in range(2)]
+        thread = TestThread._thread
+        store_ = store.Store(os.path.join(self.directory, 'chandl.db'))
+        try:
+            store_.add_posts(thread, posts[:1])
+            self._download(posts, store_)
+            self.assertSetEqual(store_.downloaded(thread.board, thread.id),
+                                {TestPost.POST.file.id})
+        finally:
+            store_.close()
+
+    def test_download_archive(self):
+        path = os.path.join(self.directory, 'thread.tar')
+        with archive.Archive(path) as archive_:
+            result = self._download(self._posts(3), archive_=archive_)
+        self.assertEqual(result.downloaded_job_count, 3)
+        self.assertListEqual(sorted(os.listdir(self.directory)),
+                             ['thread.tar', 'thread.tar.manifest.jsonl'])
+
+    def test_download_shared_queue(self):
+        path = os.path.join(self.directory, 'queue.db')
+        first, second = jobs.SQLiteQueue(path), jobs.SQLiteQueue(path)
+        try:
+            # every post has the same file; the worker that claims it saves
+            # it under each post's own name
+            result = self._download(list(self._posts(3)), queue=first)
+            self.assertEqual(result.downloaded_job_count, 3)
+            self.assertEqual(len(os.listdir(self.directory)), 4)
+
+            # while other workers leave it to that one
+            result = self._download(self._posts(2), queue=second)
+            self.assertEqual(result.downloaded_job_count, 0)
+            self.assertEqual(result.skipped_job_count, 2)
+        finally:
+            first.close()
+            second.close()
+
+    def test_download_mirrors(self):
+        # noinspection PyUnusedLocal
+        @urlmatch(netloc='down.example')
+        def down(url, request):
+            return response(503)
+
+        # noinspection PyUnusedLocal
+        @urlmatch(netloc='up.example')
+        def up(url, request):
+            with open(self._RESOURCE, 'rb') as f:
+                return response(content=f.read(), stream=True)
+
+        mirrors_ = mirrors.Mirrors(['http://down.example',
+                                    'http://up.example'])
+        with HTTMock(down, up):
+            result = downloader.Downloader(
+                self.directory, '{id}.jpg', 1,
+                mirrors_=mirrors_).download(list(self._posts(3)))
+        self.assertEqual(result.downloaded_job_count, 3)
+        down_, up_ = result.hosts
+        self.assertGreaterEqual(down_.errors, 1)
+        self.assertEqual(up_.requests, 3)
+        self.assertEqual(up_.bytes, 3 * os.path.getsize(self._RESOURCE))
+
+    def test_download_thumbnails(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            self.assertTrue(url.path.endswith('s.jpg'))
+            return response(content=b'thumbnail', stream=True)
+
+        with HTTMock(response_content):
+            result = downloader.Downloader(
+                self.directory, '{id}.{file.extension}', 1,
+                thumbnails=True).download(list(self._posts(2)))
+        self.assertEqual(result.downloaded_job_count, 2)
+        self.assertEqual(result.downloaded_bytes, 2 * len(b'thumbnail'))
+        self.assertTrue(str(result).startswith('2/2 thumbnails'))
+        self.assertListEqual(sorted(os.listdir(self.directory)),
+                             ['0.jpg', '1.jpg'])
+
+    def test_thumbnails_store(self):
+        store_ = store.Store(os.path.join(self.directory, 'chandl.db'))
+        try:
+            with self.assertRaises(ValueError):
+                downloader.Downloader(self.directory, '{id}.jpg', 1, store_,
+                                      thumbnails=True)
+        finally:
+            store_.close()
+
+    def test_as_completed(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            with open(self._RESOURCE, 'rb') as f:
+                return response(content=f.read(), stream=True)
+
+        downloader_ = downloader.Downloader(self.directory, '{id}.jpg', 1)
+        with HTTMock(response_content):
+            outcomes = list(downloader_.as_completed(self._posts(3)))
+        self.assertListEqual(sorted(outcome.post.id for outcome in outcomes),
+                             [0, 1, 2])
+        for outcome in outcomes:
+            self.assertEqual(outcome.status, downloader.OUTCOME_DOWNLOADED)
+            self.assertTrue(os.path.isfile(outcome.path))
+        self.assertEqual(downloader_.result.downloaded_job_count, 3)
+
+    def test_as_completed_failed(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(404)
+
+        downloader_ = downloader.Downloader(self.directory, '{id}.jpg', 1)
+        with HTTMock(response_content):
+            outcome, = downloader_.as_completed(list(self._posts(1)))
+        self.assertEqual(outcome.status, downloader.OUTCOME_FAILED)
+        self.assertIsInstance(outcome.error, IOError)
+        self.assertIsNone(outcome.path)
+        self.assertEqual(downloader_.result.failed_job_count, 1)
+        self.assertEqual(len(downloader_.result.failed_jobs), 1)
+
+    def test_download_summary_only(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(404)
+
+        with HTTMock(response_content):
+            result = downloader.Downloader(
+                self.directory, '{id}.jpg', 1,
+                summary_only=True).download(list(self._posts(2)))
+        self.assertEqual(result.failed_job_count, 2)
+        self.assertIsNone(result.failed_jobs)
+
+    def test_download_timeline(self):
+        timeline_ = timeline.Timeline()
+
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            with open(self._RESOURCE, 'rb') as f:
+                return response(content=f.read(), stream=True)
+
+        for _ in range(2):
+            # the second time, files exist, so are verified instead
+            with HTTMock(response_content):
+                downloader.Downloader(
+                    self.directory, '{id}.jpg', 1,
+                    timeline_=timeline_).download(list(self._posts(2)))
+        phases = [phase for _, phase, _, _ in timeline_._spans]
+        # however many threads there are
+        self.assertIn(timeline.PHASE_IDLE, phases)
+        for phase in [timeline.PHASE_CONNECTING,
+                      timeline.PHASE_TRANSFERRING, timeline.PHASE_WRITING,
+                      timeline.PHASE_VERIFYING]:
+            self.assertEqual(phases.count(phase), 2, phase)
+
+    def test_as_completed_skipped(self):
+        self._download(list(self._posts(1)))
+        downloader_ = downloader.Downloader(self.directory, '{id}.jpg', 1)
+        outcome, = downloader_.as_completed(list(self._posts(1)))
+        self.assertEqual(outcome.status, downloader.OUTCOME_SKIPPED)
+
+    def test_as_completed_error(self):
+        class BrokenStore:
+            def flush(self):
+                raise RuntimeError('database is locked')
+
+        downloader_ = downloader.Downloader(self.directory, '{id}.jpg', 1,
+                                            BrokenStore())
+        with self.assertRaises(RuntimeError):
+            list(downloader_.as_completed([]))
+
+    def test_cancelled_before(self):
+        downloader_ = downloader.Downloader(self.directory, '{id}.jpg', 1)
+        downloader_.cancel()
+        result = downloader_.download(list(self._posts(3)))
+        self.assertEqual(result.remaining_job_count, 3)
+        self.assertListEqual(os.listdir(self.directory), [])
+
+    def test_cancelled_in_flight(self):
+        with open(self._RESOURCE, 'rb') as f:
+            content = f.read()
+        downloader_ = downloader.Downloader(
+            self.directory, '{id}.jpg', 1,
+            session=_Transport(content, lambda: downloader_.cancel()))
+        result = downloader_.download(list(self._posts(2)))
+        # the transfer was abandoned rather than finished or failed
+        self.assertEqual(result.downloaded_job_count, 0)
+        self.assertEqual(result.failed_job_count, 0)
+        self.assertEqual(result.remaining_job_count, 2)
+        self.assertListEqual(os.listdir(self.directory), [])
+
+    def test_cancelled_independently(self):
+        with open(self._RESOURCE, 'rb') as f:
+            content = f.read()
+        other = downloader.Downloader(self.directory, '{id}.jpg', 1)
+        other.cancel()
+        result = downloader.Downloader(
+            self.directory, '{id}.jpg', 1,
+            session=_Transport(content)).download(list(self._posts(2)))
+        self.assertEqual(result.downloaded_job_count, 2)
+
+    def test_snapshot(self):
+        with open(self._RESOURCE, 'rb') as f:
+            content = f.read()
+        snapshots = []
+
+        def on_read():
+            if not snapshots:
+                snapshots.append(downloader_.snapshot())
+
+        downloader_ = downloader.Downloader(
+            self.directory, '{id}.jpg', 1, session=_Transport(content, on_read),
+            throttle=downloader.Throttle(1024 ** 3))
+        downloader_.download(list(self._posts(3)))
+        snapshot, = snapshots
+        self.assertEqual(snapshot.in_progress, 1)
+        self.assertEqual(snapshot.completed, 0)
+        self.assertEqual(snapshot.queued + len(snapshot.workers), 3)
+        self.assertEqual(snapshot.rate, 1024 ** 3)
+        self.assertIn('1 in progress, 0 completed', str(snapshot))
+        self.assertEqual(downloader_.snapshot().completed, 3)
+        self.assertEqual(downloader_.snapshot().workers, [])
+
+    def test_resize(self):
+        with open(self._RESOURCE, 'rb') as f:
+            content = f.read()
+        names = set()
+
+        def on_read():
+            names.add(threading.current_thread().name)
+            if len(names) == 1:
+                downloader_.resize(8)
+                # let the new threads take jobs
+                time.sleep(.01)
+
+        cpus = multiprocessing.cpu_count()
+        downloader_ = downloader.Downloader(
+            self.directory, '{id}.jpg', 1, session=_Transport(content, on_read))
+        result = downloader_.download(list(self._posts(cpus + 3)))
+        self.assertEqual(result.downloaded_job_count, cpus + 3)
+        self.assertGreater(len(names), cpus)
+        self.assertEqual(downloader_.snapshot().threads, cpus * 8)
+
+    def test_resize_smaller(self):
+        with open(self._RESOURCE, 'rb') as f:
+            content = f.read()
+
+        downloader_ = downloader.Downloader(
+            self.directory, '{id}.jpg', 1,
+            session=_Transport(content, lambda: downloader_.resize(0)))
+        result = downloader_.download(list(self._posts(3)))
+        # transfers in progress were finished, but no more were started
+        self.assertEqual(result.downloaded_job_count,
+                         min(multiprocessing.cpu_count(), 3))
+        self.assertEqual(result.remaining_job_count,
+                         3 - result.downloaded_job_count)
+
+    def test_as_completed_closed(self):
+        with open(self._RESOURCE, 'rb') as f:
+            content = f.read()
+        downloader_ = downloader.Downloader(self.directory, '{id}.jpg', 1,
+                                            session=_Transport(content))
+        outcomes = downloader_.as_completed(self._posts(3))
+        next(outcomes)
+        outcomes.close()
+        self.assertTrue(downloader_.cancellation.cancelled)
+        self.assertIsNotNone(downloader_.result)
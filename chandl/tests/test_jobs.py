@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from chandl import jobs
+from chandl.model.file import File
+from chandl.model.post import Post
+from chandl.tests.model.test_post import TestPost
+
+
+def _post(i):
+    file_ = File(i, TestPost.BOARD, 'file', 'jpg', 1024, 10, 10,
+                 '{0:032x}'.format(i))
+    return Post(TestPost.BOARD, i, TestPost.POST.timestamp, file_=file_)
+
+
+class TestMemoryQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = jobs.MemoryQueue()
+
+    def test_empty(self):
+        self.assertIsNone(self.queue.claim())
+        self.assertEqual(len(self.queue), 0)
+
+    def test_claim_in_order(self):
+        posts = [_post(i) for i in range(3)]
+        for post in posts:
+            self.queue.put(post)
+        self.assertEqual(len(self.queue), 3)
+        self.assertListEqual([self.queue.claim().post for _ in range(3)],
+                             posts)
+        self.assertIsNone(self.queue.claim())
+
+    def test_pending(self):
+        posts = [_post(i) for i in range(3)]
+        for post in posts:
+            self.queue.put(post)
+        self.queue.claim()
+        self.assertListEqual(self.queue.pending(), posts[1:])
+
+    def test_put_all(self):
+        posts = [_post(i) for i in range(3)]
+        self.queue.put_all(posts)
+        self.assertListEqual(self.queue.pending(), posts)
+
+
+class TestSQLiteQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'queue.db')
+        self.first = jobs.SQLiteQueue(self.path)
+        self.second = jobs.SQLiteQueue(self.path)
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        shutil.rmtree(self.directory)
+
+    def test_owners_distinct(self):
+        self.assertNotEqual(self.first.owner, self.second.owner)
+
+    def test_claim(self):
+        post = _post(1)
+        self.first.put(post)
+        self.assertIs(self.first.claim().post, post)
+        self.assertIsNone(self.first.claim())
+
+    def test_claim_only_put(self):
+        self.first.put(_post(1))
+        self.assertIsNone(self.second.claim())
+
+    def test_leased_elsewhere(self):
+        self.first.put(_post(1))
+        self.second.put(_post(1))
+        self.assertIsNotNone(self.first.claim())
+        self.assertIsNone(self.second.claim())
+        # retried once the other worker is done with it
+        self.assertEqual(len(self.second), 1)
+
+    def test_done_elsewhere(self):
+        self.first.put(_post(1))
+        self.second.put(_post(1))
+        self.first.ack(self.first.claim())
+        self.assertIsNone(self.second.claim())
+        self.assertEqual(len(self.second), 0)
+        self.assertListEqual([post.id for post in self.second.done_elsewhere()],
+                             [1])
+
+    def test_repost(self):
+        post = _post(1)
+        repost = Post(TestPost.BOARD, 2, post.timestamp, file_=post.file)
+        self.first.put(post)
+        self.first.put(repost)
+        self.second.put(_post(1))
+        lease = self.first.claim()
+        self.assertIs(lease.post, post)
+        # waits for this worker to finish the file
+        self.assertIsNone(self.first.claim())
+        self.first.ack(lease)
+        lease = self.first.claim()
+        self.assertIs(lease.post, repost)
+        # failing to save the repost does not return the file to the queue
+        self.first.release(lease)
+        self.assertIsNone(self.second.claim())
+        self.assertEqual(len(self.second.done_elsewhere()), 1)
+        self.assertListEqual(self.first.done_elsewhere(), [])
+
+    def test_release(self):
+        self.first.put(_post(1))
+        self.second.put(_post(1))
+        self.first.release(self.first.claim())
+        self.assertIsNotNone(self.second.claim())
+
+    def test_expired(self):
+        self.first.put(_post(1))
+        self.second.put(_post(1))
+        self.assertIsNotNone(self.second.claim())
+        # as if the second worker had died without releasing its lease
+        with self.second._connection:
+            self.second._connection.execute('UPDATE queue SET expires = 0')
+        self.assertIsNotNone(self.first.claim())
+
+    def test_renew(self):
+        queue = jobs.SQLiteQueue(self.path, lease_time=.3)
+        try:
+            queue.put(_post(1))
+            self.first.put(_post(1))
+            self.assertIsNotNone(queue.claim())
+            time.sleep(.5)
+            self.assertIsNone(self.first.claim())
+        finally:
+            queue.close()
+
+    def test_close_releases(self):
+        self.first.put(_post(1))
+        self.second.put(_post(1))
+        self.first.claim()
+        self.first.close()
+        self.assertIsNotNone(self.second.claim())
+
+    def test_pending(self):
+        posts = [_post(i) for i in range(3)]
+        for post in posts:
+            self.first.put(post)
+        self.first.claim()
+        self.assertListEqual(self.first.pending(), posts[1:])
+
+    def test_put_all(self):
+        posts = [_post(i) for i in range(jobs._CLAIM_BATCH * 2 + 1)]
+        self.first.put_all(posts)
+        self.second.put_all(posts[-1:])
+        self.assertEqual(len(self.first), len(posts))
+        self.assertListEqual([self.first.claim().post for _ in posts], posts)
+        self.assertIsNone(self.first.claim())
+        self.assertEqual(len(self.first), 0)
+        # the last file was leased by the first worker
+        self.assertIsNone(self.second.claim())
+
+    def test_claim_batch(self):
+        posts = [_post(i) for i in range(jobs._CLAIM_BATCH + 1)]
+        self.first.put_all(posts)
+        self.second.put_all(posts)
+        self.first.claim()
+        # the rest of the first batch is leased to the first worker
+        self.assertIs(self.second.claim().post, posts[-1])
+        self.assertIsNone(self.second.claim())
+
+    def test_persistent(self):
+        self.first.put(_post(1))
+        self.first.ack(self.first.claim())
+        queue = jobs.SQLiteQueue(self.path)
+        try:
+            queue.put(_post(1))
+            self.assertIsNone(queue.claim())
+        finally:
+            queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+import json
+
+from chandl import jsonstream
+
+
+def _chunked(text, size):
+    data = text.encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestIterArray(unittest.TestCase):
+
+    _DOCUMENT = json.dumps({
+        'before': {'a': [1, 2, 3], 'b': 'ignored'},
+        'posts': [{'no': 1, 'com': 'café &amp; ☃'},
+                  12345,
+                  True,
+                  None,
+                  'text',
+                  [1.5, {'x': 'y'}]],
+        'after': 1
+    }, ensure_ascii=False)
+
+    def test_single_chunk(self):
+        self.assertListEqual(
+            list(jsonstream.iter_array([self._DOCUMENT.encode('utf-8')],
+                                       'posts')),
+            json.loads(self._DOCUMENT)['posts'])
+
+    def test_chunk_boundaries(self):
+        # every split point, including within multi-byte characters and numbers
+        expected = json.loads(self._DOCUMENT)['posts']
+        for size in range(1, 12):
+            self.assertListEqual(
+                list(jsonstream.iter_array(_chunked(self._DOCUMENT, size),
+                                           'posts')),
+                expected)
+
+    def test_top_level_array(self):
+        self.assertListEqual(
+            list(jsonstream.iter_array(_chunked(' [ 1 , {"a": 2} , 345 ] ',
+                                                1))),
+            [1, {'a': 2}, 345])
+
+    def test_empty_array(self):
+        self.assertListEqual(list(jsonstream.iter_array([b'{"posts": []}'],
+                                                        'posts')),
+                             [])
+
+    def test_yields_before_end(self):
+        chunks = iter([b'{"posts": [{"no": 1}, ', b'{"no": 2}'])
+        items = jsonstream.iter_array(chunks, 'posts')
+        self.assertEqual(next(items), {'no': 1})
+        # the second chunk has not been read yet
+        self.assertEqual(next(chunks), b'{"no": 2}')
+
+    def test_missing_key(self):
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_array([b'{"other": []}'], 'posts'))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_array([b'{"posts": [1, {"no"'], 'posts'))
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_array([b'[1 2]']))
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_array([]))
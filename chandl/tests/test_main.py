@@ -5,9 +5,15 @@ import argparse
 import sys
 import os
 import contextlib
+import shutil
+import signal
+import tempfile
+import threading
 import six
 
 from chandl import __main__ as main
+from chandl.downloader import Cancellation
+from chandl.model.post import LazyPosts
 from chandl.tests.model.test_thread import TestThread
 
 
@@ -35,6 +41,72 @@ class TestPrintError(unittest.TestCase):
             sys.stderr = sys.__stderr__
 
 
+class TestCancelOnSigint(unittest.TestCase):
+
+    def test_cancelled(self):
+        cancellation = Cancellation()
+        with main._cancel_on_sigint(cancellation):
+            os.kill(os.getpid(), signal.SIGINT)
+        self.assertTrue(cancellation.cancelled)
+
+    def test_exception(self):
+        handler = signal.getsignal(signal.SIGINT)
+        with self.assertRaises(ValueError), \
+                main._cancel_on_sigint(Cancellation()):
+            raise ValueError()
+        self.assertIs(signal.getsignal(signal.SIGINT), handler)
+
+    def test_other_thread(self):
+        entered = []
+
+        def target():
+            with main._cancel_on_sigint(Cancellation()):
+                entered.append(True)
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        self.assertListEqual(entered, [True])
+
+
+class TestInstrumented(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _args(self, **kwargs):
+        args = argparse.Namespace(profile=None, profiler='deterministic',
+                                  trace_malloc=None, timeline=None)
+        for key, value in kwargs.items():
+            setattr(args, key, value)
+        return args
+
+    def test_nothing(self):
+        with main._instrumented(self._args()) as timeline_:
+            self.assertIsNone(timeline_)
+
+    def test_timeline(self):
+        path = os.path.join(self.directory, 'timeline.json')
+        save_stdout = sys.stdout
+        try:
+            sys.stdout = six.StringIO()
+            with main._instrumented(self._args(timeline=path)) as timeline_:
+                self.assertIsNotNone(timeline_)
+        finally:
+            sys.stdout = save_stdout
+        self.assertTrue(os.path.isfile(path))
+
+    def test_unwritable(self):
+        args = self._args(profile=os.path.join(self.directory, 'missing',
+                                               'profile'))
+        with self.assertRaises(main._OutputError):
+            with main._instrumented(args):
+                self.fail('Entered the context')
+
+
 class TestParseArgs(unittest.TestCase):
 
     _DUMMY_URL = 'https://boards.4chan.org/wg/thread/6851190'
@@ -120,6 +192,206 @@ class TestParseArgs(unittest.TestCase):
         self.assertEqual(
             main._parse_args(self._BASE_ARGV + ['-p', '4']).parallelism, 4)
 
+    def test_stream_missing(self):
+        self.assertFalse(main._parse_args(self._BASE_ARGV).stream)
+
+    def test_stream(self):
+        self.assertTrue(main._parse_args(self._BASE_ARGV + ['-s']).stream)
+
+    def test_state_missing(self):
+        self.assertIsNone(main._parse_args(self._BASE_ARGV).state)
+
+    def test_state(self):
+        self.assertEqual(
+            main._parse_args(self._BASE_ARGV + ['--state', 'chandl.db']).state,
+            'chandl.db')
+
+    def test_archive_missing(self):
+        self.assertIsNone(main._parse_args(self._BASE_ARGV).archive)
+
+    def test_archive(self):
+        self.assertEqual(
+            main._parse_args(self._BASE_ARGV + ['-a', 'tar.gz']).archive,
+            'tar.gz')
+
+    def test_archive_unknown(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['-a', 'rar'])
+
+    def test_content_dir_missing(self):
+        self.assertIsNone(main._parse_args(self._BASE_ARGV).content_dir)
+
+    def test_content_dir(self):
+        self.assertEqual(
+            main._parse_args(self._BASE_ARGV + ['-c', 'objects']).content_dir,
+            'objects')
+
+    def test_content_dir_with_archive(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['-c', 'objects', '-a', 'zip'])
+
+    def test_manifest(self):
+        self.assertTrue(main._parse_args(
+            self._BASE_ARGV + ['-c', 'objects', '-m']).manifest)
+
+    def test_manifest_without_content_dir(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['-m'])
+
+    def test_index_missing(self):
+        self.assertFalse(main._parse_args(self._BASE_ARGV).index)
+
+    def test_index(self):
+        self.assertTrue(main._parse_args(
+            self._BASE_ARGV + ['--state', 'chandl.db', '-i']).index)
+
+    def test_index_without_state(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['-i'])
+
+    def test_drop_cache_missing(self):
+        self.assertFalse(main._parse_args(self._BASE_ARGV).drop_cache)
+
+    def test_drop_cache(self):
+        self.assertTrue(main._parse_args(
+            self._BASE_ARGV + ['--drop-cache']).drop_cache)
+
+    def test_fsync_missing(self):
+        self.assertEqual(main._parse_args(self._BASE_ARGV).fsync, 'none')
+
+    def test_fsync(self):
+        self.assertEqual(main._parse_args(
+            self._BASE_ARGV + ['--fsync', 'thread']).fsync, 'thread')
+
+    def test_fsync_invalid(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['--fsync', 'always'])
+
+    def test_summary_only_missing(self):
+        self.assertFalse(main._parse_args(self._BASE_ARGV).summary_only)
+
+    def test_summary_only(self):
+        self.assertTrue(main._parse_args(
+            self._BASE_ARGV + ['--summary-only']).summary_only)
+
+    def test_queue_missing(self):
+        self.assertIsNone(main._parse_args(self._BASE_ARGV).queue)
+
+    def test_queue(self):
+        self.assertEqual(main._parse_args(
+            self._BASE_ARGV + ['-q', 'queue.db']).queue, 'queue.db')
+
+    def test_media_host_missing(self):
+        self.assertListEqual(main._parse_args(self._BASE_ARGV).media_host, [])
+
+    def test_media_host(self):
+        self.assertListEqual(
+            main._parse_args(self._BASE_ARGV +
+                             ['-M', 'https://i.4cdn.org,https://is2.4chan.org',
+                              '-M', 'http://mirror']).media_host,
+            ['https://i.4cdn.org', 'https://is2.4chan.org', 'http://mirror'])
+
+    def test_media_host_invalid(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['-M', 'i.4cdn.org'])
+
+    def test_prewarm_missing(self):
+        self.assertEqual(main._parse_args(self._BASE_ARGV).prewarm, 0)
+
+    def test_prewarm(self):
+        self.assertEqual(main._parse_args(
+            self._BASE_ARGV + ['--prewarm', '4']).prewarm, 4)
+
+    def test_select_missing(self):
+        self.assertIsNone(main._parse_args(self._BASE_ARGV).select)
+
+    def test_select(self):
+        self.assertSetEqual(
+            main._parse_args(self._BASE_ARGV +
+                             ['--select', '1,2', '--select', '3']).select,
+            {1, 2, 3})
+
+    def test_select_invalid(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['--select', 'image.jpg'])
+
+    def test_thumbnails_missing(self):
+        self.assertIsNone(main._parse_args(self._BASE_ARGV).thumbnails)
+
+    def test_thumbnails(self):
+        self.assertEqual(main._parse_args(
+            self._BASE_ARGV + ['--thumbnails', 'first']).thumbnails, 'first')
+
+    def test_thumbnails_with_archive(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['--thumbnails', 'only',
+                                                '-a', 'zip'])
+
+    def test_transport_missing(self):
+        self.assertEqual(main._parse_args(self._BASE_ARGV).transport,
+                         'requests')
+
+    def test_transport_replay(self):
+        args = main._parse_args(self._BASE_ARGV + ['--transport', 'replay',
+                                                   '--cassette', 'responses'])
+        self.assertEqual(args.transport, 'replay')
+        self.assertEqual(args.cassette, 'responses')
+
+    def test_transport_without_cassette(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['--transport', 'record'])
+
+    def test_profile_missing(self):
+        args = main._parse_args(self._BASE_ARGV)
+        self.assertIsNone(args.profile)
+        self.assertEqual(args.profiler, 'deterministic')
+
+    def test_profile(self):
+        args = main._parse_args(self._BASE_ARGV + ['--profile', 'stacks.txt',
+                                                   '--profiler', 'sampling'])
+        self.assertEqual(args.profile, 'stacks.txt')
+        self.assertEqual(args.profiler, 'sampling')
+
+    def test_trace_malloc_missing(self):
+        self.assertIsNone(main._parse_args(self._BASE_ARGV).trace_malloc)
+
+    def test_trace_malloc_default(self):
+        self.assertEqual(main._parse_args(
+            self._BASE_ARGV + ['--trace-malloc']).trace_malloc, 10)
+
+    def test_trace_malloc(self):
+        self.assertEqual(main._parse_args(
+            self._BASE_ARGV + ['--trace-malloc', '20']).trace_malloc, 20)
+
+    def test_timeline_missing(self):
+        self.assertIsNone(main._parse_args(self._BASE_ARGV).timeline)
+
+    def test_timeline(self):
+        self.assertEqual(main._parse_args(
+            self._BASE_ARGV + ['--timeline', 'trace.json']).timeline,
+            'trace.json')
+
+    def test_limit_rate_missing(self):
+        self.assertIsNone(main._parse_args(self._BASE_ARGV).limit_rate)
+
+    def test_limit_rate(self):
+        self.assertEqual(main._parse_args(
+            self._BASE_ARGV + ['--limit-rate', '500K']).limit_rate,
+            500 * 1024)
+
+    def test_limit_rate_unlimited(self):
+        self.assertIsNone(main._parse_args(
+            self._BASE_ARGV + ['--limit-rate', '0']).limit_rate)
+
+    def test_limit_rate_invalid(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_args(self._BASE_ARGV + ['--limit-rate', 'fast'])
+
+    def test_control(self):
+        self.assertEqual(main._parse_args(
+            self._BASE_ARGV + ['--control', 'chandl.control']).control,
+            'chandl.control')
+
     def test_url_missing(self):
         with self.assertRaises(SystemExit), _suppress_stderr():
             main._parse_args([])
@@ -130,32 +402,145 @@ class TestParseArgs(unittest.TestCase):
             self._DUMMY_URL)
 
 
+class TestParseSearchArgs(unittest.TestCase):
+
+    _BASE_ARGV = ['chandl', 'search', 'chandl.db', 'sparrow']
+
+    def test_state(self):
+        self.assertEqual(main._parse_search_args(self._BASE_ARGV).state,
+                         'chandl.db')
+
+    def test_query(self):
+        self.assertEqual(main._parse_search_args(self._BASE_ARGV).query,
+                         'sparrow')
+
+    def test_limit_default(self):
+        self.assertEqual(main._parse_search_args(self._BASE_ARGV).limit, 20)
+
+    def test_limit(self):
+        self.assertEqual(main._parse_search_args(
+            self._BASE_ARGV[:2] + ['-l', '5'] + self._BASE_ARGV[2:]).limit, 5)
+
+    def test_query_missing(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_search_args(self._BASE_ARGV[:3])
+
+
+class TestParseServeArgs(unittest.TestCase):
+
+    _BASE_ARGV = ['chandl', 'serve']
+
+    def test_defaults(self):
+        args = main._parse_serve_args(self._BASE_ARGV)
+        self.assertEqual(args.port, main._DEFAULT_PORT)
+        self.assertEqual(args.host, '127.0.0.1')
+        self.assertIsNone(args.socket)
+        self.assertIsNone(args.state)
+
+    def test_port(self):
+        self.assertEqual(
+            main._parse_serve_args(self._BASE_ARGV + ['--port', '80']).port, 80)
+
+    def test_socket(self):
+        self.assertEqual(main._parse_serve_args(
+            self._BASE_ARGV + ['--socket', 'chandl.sock']).socket,
+            'chandl.sock')
+
+    def test_port_and_socket(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_serve_args(
+                self._BASE_ARGV + ['--port', '80', '--socket', 'chandl.sock'])
+
+
+class TestParseVerifyArgs(unittest.TestCase):
+
+    _BASE_ARGV = ['chandl', 'verify']
+
+    def test_path(self):
+        args = main._parse_verify_args(self._BASE_ARGV + ['thread'])
+        self.assertEqual(args.path, 'thread')
+        self.assertIsNone(args.url)
+        self.assertIsNone(args.processes)
+        self.assertFalse(args.requeue)
+
+    def test_url(self):
+        self.assertEqual(main._parse_verify_args(
+            self._BASE_ARGV + ['thread', TestThread._VALID_URL]).url,
+            TestThread._VALID_URL)
+
+    def test_processes(self):
+        self.assertEqual(main._parse_verify_args(
+            self._BASE_ARGV + ['-j', '3', 'thread']).processes, 3)
+
+    def test_requeue(self):
+        self.assertTrue(main._parse_verify_args(
+            self._BASE_ARGV + ['-r', 'thread', TestThread._VALID_URL]).requeue)
+
+    def test_requeue_without_source(self):
+        with self.assertRaises(SystemExit), _suppress_stderr():
+            main._parse_verify_args(self._BASE_ARGV + ['-r', 'thread'])
+
+
 class TestRemoveUnwanted(unittest.TestCase):
 
-    _NO_ARGS = argparse.Namespace(filter=[], exclude=[])
+    _NO_ARGS = argparse.Namespace(filter=[], exclude=[], select=None)
+
+    # noinspection PyProtectedMember
+    _LAZY_POSTS = LazyPosts('wg', TestThread._THREAD_JSON['posts'])
 
     def test_no_posts_no_args(self):
-        self.assertListEqual(main._remove_unwanted([], self._NO_ARGS),
-                             [])
+        self.assertListEqual(
+            list(main._remove_unwanted(LazyPosts('wg', []), self._NO_ARGS)),
+            [])
 
     def test_posts_no_args(self):
         self.assertListEqual(
-            main._remove_unwanted(TestThread.POSTS, self._NO_ARGS),
+            list(main._remove_unwanted(self._LAZY_POSTS, self._NO_ARGS)),
             [post for post in TestThread.POSTS if post.has_file])
 
     def test_posts_filter_png(self):
         self.assertListEqual(
-            main._remove_unwanted(TestThread.POSTS,
-                                  argparse.Namespace(filter=['png'],
-                                                     exclude=[])),
+            list(main._remove_unwanted(self._LAZY_POSTS,
+                                       argparse.Namespace(filter=['png'],
+                                                          exclude=[],
+                                                          select=None))),
             [post for post in TestThread.POSTS
              if post.has_file and post.file.extension == 'png'])
 
     def test_posts_exclude_png(self):
         name = '1475710924523.jpg'
         self.assertListEqual(
-            main._remove_unwanted(TestThread.POSTS,
-                                  argparse.Namespace(filter=[],
-                                                     exclude=[name])),
+            list(main._remove_unwanted(self._LAZY_POSTS,
+                                       argparse.Namespace(filter=[],
+                                                          exclude=[name],
+                                                          select=None))),
             [post for post in TestThread.POSTS
              if post.has_file and post.file.name != name])
+
+    def test_posts_exclude_name(self):
+        name = 'stretched-32086'
+        self.assertListEqual(
+            list(main._remove_unwanted(self._LAZY_POSTS,
+                                       argparse.Namespace(filter=[],
+                                                          exclude=[name],
+                                                          select=None))),
+            [post for post in TestThread.POSTS
+             if post.has_file and post.file.name != name])
+
+    def test_posts_select(self):
+        self.assertListEqual(
+            list(main._remove_unwanted(self._LAZY_POSTS,
+                                       argparse.Namespace(
+                                           filter=[], exclude=[],
+                                           select={1486134370795}))),
+            [post for post in TestThread.POSTS
+             if post.has_file and post.file.id == 1486134370795])
+
+    def test_posts_not_decoded(self):
+        posts = main._remove_unwanted(self._LAZY_POSTS,
+                                      argparse.Namespace(filter=['png'],
+                                                         exclude=[],
+                                                         select=None))
+        self.assertEqual(len(posts), 1)
+        # noinspection PyProtectedMember
+        self.assertEqual(self._LAZY_POSTS._posts, [None] * 4)
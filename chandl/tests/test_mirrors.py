@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import unittest
+from httmock import response, urlmatch, HTTMock
+
+from chandl import mirrors, transport
+from chandl.model import file
+
+
+class TestMirrors(unittest.TestCase):
+
+    def setUp(self):
+        self.mirrors = mirrors.Mirrors(['http://a.example', 'http://b.example/',
+                                        'http://c.example'])
+        self.a, self.b, self.c = self.mirrors.hosts
+
+    def test_no_hosts(self):
+        with self.assertRaises(ValueError):
+            mirrors.Mirrors([])
+
+    def test_root_normalised(self):
+        self.assertEqual(self.b.root, 'http://b.example')
+
+    def test_untried_first(self):
+        self.mirrors.succeeded(self.a, .1)
+        self.assertIs(self.mirrors.choose(), self.b)
+
+    def test_fastest(self):
+        for host, latency in [(self.a, .3), (self.b, .1), (self.c, .2)]:
+            self.mirrors.succeeded(host, latency)
+        self.assertIs(self.mirrors.choose(), self.b)
+        self.assertIs(self.mirrors.choose([self.b]), self.c)
+
+    def test_ewma(self):
+        self.mirrors.succeeded(self.a, 1)
+        self.mirrors.succeeded(self.a, 2)
+        self.assertAlmostEqual(self.a.latency,
+                               mirrors._ALPHA * 2 + (1 - mirrors._ALPHA) * 1)
+
+    def test_failed_avoided(self):
+        self.mirrors.failed(self.a)
+        self.assertFalse(self.a.healthy())
+        self.assertIs(self.mirrors.choose(), self.b)
+
+    def test_cooldown_doubles(self):
+        self.mirrors.failed(self.a)
+        first = self.a.down_until
+        self.mirrors.failed(self.a)
+        self.assertGreater(self.a.down_until - first,
+                           mirrors._COOLDOWN * .9)
+
+    def test_recovers(self):
+        self.mirrors.failed(self.a)
+        self.mirrors.succeeded(self.a, .1)
+        self.assertTrue(self.a.healthy())
+        self.assertEqual(self.a.consecutive_errors, 0)
+        self.assertEqual(self.a.errors, 1)
+
+    def test_all_failed(self):
+        for host in [self.b, self.a, self.c]:
+            self.mirrors.failed(host)
+        self.assertIs(self.mirrors.choose(), self.b)
+
+    def test_all_excluded(self):
+        self.assertIn(self.mirrors.choose(self.mirrors.hosts),
+                      self.mirrors.hosts)
+
+
+class _Broken(io.RawIOBase):
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer_):
+        raise ValueError('connection reset')
+
+
+class _Transport:
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.urls = []
+
+    def get(self, url, stream=False):
+        self.urls.append(url)
+        return transport.Response(url, 200, self.raw)
+
+
+class TestMirrorTransport(unittest.TestCase):
+
+    _PATH = '/wg/1486866826992.jpg'
+
+    def setUp(self):
+        self.mirrors = mirrors.Mirrors(['http://a.example',
+                                        'http://b.example'])
+        self.a, self.b = self.mirrors.hosts
+
+    @staticmethod
+    def _host(netloc, status_code):
+        # noinspection PyUnusedLocal
+        @urlmatch(netloc=netloc)
+        def host(url, request):
+            return response(status_code, b'body from ' +
+                            netloc.encode('utf-8'), stream=True)
+        return host
+
+    def _get(self, a, b, url=None):
+        with HTTMock(self._host('a.example', a), self._host('b.example', b)):
+            return mirrors.MirrorTransport(self.mirrors).get(
+                url or file.MEDIA_ROOT + self._PATH, stream=True)
+
+    def test_fastest(self):
+        self.mirrors.succeeded(self.a, .5)
+        self.mirrors.succeeded(self.b, .1)
+        response_ = self._get(200, 200)
+        self.assertEqual(response_.url, 'http://b.example' + self._PATH)
+        self.assertEqual(response_.raw.read(), b'body from b.example')
+        self.assertEqual(self.b.bytes, len(b'body from b.example'))
+        self.assertEqual(self.b.requests, 2)
+
+    def test_failover(self):
+        response_ = self._get(503, 200)
+        self.assertEqual(response_.raw.read(), b'body from b.example')
+        self.assertEqual(self.a.errors, 1)
+        self.assertFalse(self.a.healthy())
+        self.assertIsNotNone(self.b.latency)
+
+    def test_not_found(self):
+        # the file is gone, not the host
+        self.assertEqual(self._get(404, 200).status_code, 404)
+        self.assertEqual(self.a.errors, 0)
+        self.assertEqual(self.b.requests, 0)
+
+    def test_all_failed(self):
+        with self.assertRaises(mirrors.HostError):
+            self._get(500, 503)
+        self.assertEqual(self.a.errors + self.b.errors, 2)
+
+    def test_mirror_url(self):
+        response_ = self._get(200, 200, 'http://b.example' + self._PATH)
+        self.assertEqual(response_.url, 'http://a.example' + self._PATH)
+
+    def test_other_url(self):
+        transport_ = _Transport(io.BytesIO())
+        mirrors.MirrorTransport(self.mirrors, transport_).get(
+            'http://b.example.org/thread.json')
+        self.assertListEqual(transport_.urls,
+                             ['http://b.example.org/thread.json'])
+        self.assertEqual(self.a.requests + self.b.requests, 0)
+
+    def test_body_error(self):
+        transport_ = _Transport(_Broken())
+        response_ = mirrors.MirrorTransport(self.mirrors, transport_).get(
+            file.MEDIA_ROOT + self._PATH)
+        with self.assertRaises(mirrors.HostError):
+            response_.raw.read()
+        self.assertEqual(self.a.requests, 1)
+        self.assertEqual(self.a.errors, 1)
+        self.assertFalse(self.a.healthy())
+
+
+if __name__ == '__main__':
+    unittest.main()
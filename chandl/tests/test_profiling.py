@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from chandl import profiling
+
+
+def _work():
+    # busy for long enough to be sampled
+    deadline = time.time() + .1
+    while time.time() < deadline:
+        sum(range(100))
+
+
+def _in_thread():
+    thread = threading.Thread(target=_work)
+    thread.start()
+    thread.join()
+
+
+class TestProfiled(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'profile')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_deterministic(self):
+        with profiling.profiled(self.path):
+            _in_thread()
+        functions = [function for _, _, function
+                     in pstats.Stats(self.path).stats]
+        self.assertIn('_in_thread', functions)
+        # run by the worker thread
+        self.assertIn('_work', functions)
+
+    def test_sampling(self):
+        with profiling.profiled(self.path, profiling.PROFILER_SAMPLING):
+            _in_thread()
+        with io.open(self.path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertTrue(any(':_work ' in line for line in lines))
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError), \
+                profiling.profiled(self.path, 'psychic'):
+            pass
+
+
+@unittest.skipUnless(profiling.tracemalloc, 'tracemalloc is unavailable')
+class TestTracedAllocations(unittest.TestCase):
+
+    def test_report(self):
+        with profiling.traced_allocations(3) as report:
+            held = [bytearray(1024 * 1024)]
+        self.assertGreaterEqual(report.peak, 1024 * 1024)
+        self.assertLessEqual(len(report.sites), 3)
+        filename, lineno, size, count = report.sites[0]
+        self.assertEqual(filename, __file__.replace('.pyc', '.py'))
+        self.assertGreaterEqual(size, 1024 * 1024)
+        self.assertTrue(str(report).startswith('Traced memory: '))
+        del held
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unittest
+
+from chandl import stats
+from chandl.tests.model.test_post import TestPost
+from chandl.tests.model.test_thread import TestThread
+
+
+class TestSecondsFmt(unittest.TestCase):
+
+    def test_milliseconds(self):
+        self.assertEqual(stats.seconds_fmt(.0804), '80 ms')
+
+    def test_seconds(self):
+        self.assertEqual(stats.seconds_fmt(12.34), '12.3 s')
+
+
+class TestHistogram(unittest.TestCase):
+
+    def setUp(self):
+        self.histogram = stats.Histogram([1, 2, 4])
+
+    def test_empty(self):
+        self.assertIsNone(self.histogram.percentile(.5))
+
+    def test_percentile(self):
+        for value in [.5, 1.5, 1.5, 3]:
+            self.histogram.add(value)
+        self.assertEqual(self.histogram.percentile(.25), 1)
+        self.assertEqual(self.histogram.percentile(.5), 2)
+        self.assertEqual(self.histogram.percentile(1), 3)
+        self.assertEqual(self.histogram.count, 4)
+        self.assertEqual(self.histogram.total, 6.5)
+
+    def test_overflow(self):
+        self.histogram.add(100)
+        self.assertEqual(self.histogram.percentile(.5), 100)
+        self.assertListEqual(self.histogram.buckets, [0, 0, 0, 1])
+
+    def test_bounded(self):
+        histogram = stats.Histogram()
+        for i in range(10000):
+            histogram.add(i / 100.0)
+        self.assertEqual(len(histogram.buckets),
+                         len(stats._LATENCY_BOUNDS) + 1)
+
+
+class TestTally(unittest.TestCase):
+
+    _POSTS = [post for post in TestThread.POSTS if post.has_file]
+
+    def test_counts(self):
+        tally = stats.Tally()
+        for post in self._POSTS:
+            tally.add('downloaded', post, .1)
+        self.assertEqual(tally.counts['downloaded'], len(self._POSTS))
+        self.assertEqual(tally.bytes['downloaded'],
+                         sum(post.file.size for post in self._POSTS))
+        self.assertEqual(tally.latencies['downloaded'].count,
+                         len(self._POSTS))
+        self.assertEqual(len(tally), len(self._POSTS))
+
+    def test_kept(self):
+        tally = stats.Tally(['failed'])
+        tally.add('failed', TestPost.POST)
+        tally.add('downloaded', TestPost.POST)
+        self.assertListEqual(tally.posts('failed'), [TestPost.POST])
+        self.assertIsNone(tally.posts('downloaded'))
+        self.assertNotIn('failed', tally.latencies)
+
+    def test_no_file(self):
+        tally = stats.Tally()
+        tally.add('skipped', TestPost._POST_NO_FILE)
+        self.assertEqual(tally.bytes['skipped'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
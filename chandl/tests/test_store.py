@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from chandl import stats, store
+from chandl.downloader import DownloadResult, OUTCOME_DOWNLOADED
+from chandl.model.post import MalformedPost
+from chandl.tests.model.test_thread import TestThread
+
+
+class TestStore(unittest.TestCase):
+
+    _FILE_POSTS = [post for post in TestThread.POSTS if post.has_file]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'chandl.db')
+        self.store = store.Store(self.path)
+        self.thread = TestThread._thread
+        self.store.add_thread(self.thread)
+        self.store.add_posts(self.thread, TestThread.POSTS)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def _count(self, table):
+        return self.store._connection.execute(
+            'SELECT COUNT(*) FROM {0}'.format(table)).fetchone()[0]
+
+    def test_add_thread(self):
+        self.assertEqual(self._count('threads'), 1)
+
+    def test_add_posts(self):
+        self.assertEqual(self._count('posts'), len(TestThread.POSTS))
+        self.assertEqual(self._count('files'), len(self._FILE_POSTS))
+
+    def test_add_posts_idempotent(self):
+        self.store.add_posts(self.thread, TestThread.POSTS)
+        self.assertEqual(self._count('posts'), len(TestThread.POSTS))
+
+    def test_add_posts_malformed(self):
+        self.store.add_posts(self.thread, [
+            MalformedPost(self.thread.board, {'no': 1}, KeyError('time'))])
+        self.assertEqual(self._count('posts'), len(TestThread.POSTS))
+
+    def _rows(self, table):
+        return self.store._connection.execute(
+            'SELECT * FROM {0} ORDER BY id'.format(table)).fetchall()
+
+    def test_add_raw_posts(self):
+        posts, files = self._rows('posts'), self._rows('files')
+        self.store._connection.executescript('DELETE FROM posts; '
+                                             'DELETE FROM files;')
+        self.store.add_raw_posts(self.thread,
+                                 TestThread._THREAD_JSON['posts'])
+        self.assertListEqual(self._rows('posts'), posts)
+        self.assertListEqual(self._rows('files'), files)
+
+    def test_add_raw_posts_malformed(self):
+        self.store.add_raw_posts(self.thread,
+                                 [{'no': 1}, {'no': 2, 'time': 0, 'tim': 3}])
+        self.assertEqual(self._count('posts'), len(TestThread.POSTS))
+
+    def test_downloaded_none(self):
+        self.assertSetEqual(
+            self.store.downloaded(self.thread.board, self.thread.id), set())
+
+    def test_downloaded(self):
+        post = self._FILE_POSTS[0]
+        self.store.set_status(post, store.STATUS_DOWNLOADED, 'a.jpg')
+        self.store.set_status(self._FILE_POSTS[1], store.STATUS_FAILED)
+        self.store.flush()
+        self.assertSetEqual(
+            self.store.downloaded(self.thread.board, self.thread.id),
+            {post.file.id})
+
+    def test_downloaded_directory(self):
+        inside, outside = self._FILE_POSTS[:2]
+        self.store.set_status(inside, store.STATUS_DOWNLOADED,
+                              os.path.join(self.directory, 'a.jpg'))
+        self.store.set_status(outside, store.STATUS_DOWNLOADED,
+                              self.directory + '2/b.jpg')
+        self.store.flush()
+        self.assertSetEqual(
+            self.store.downloaded(self.thread.board, self.thread.id,
+                                  self.directory),
+            {inside.file.id})
+
+    def test_saved_files(self):
+        inside, outside = self._FILE_POSTS[:2]
+        self.store.set_status(inside, store.STATUS_DOWNLOADED,
+                              os.path.join(self.directory, 'a.jpg'))
+        self.store.set_status(outside, store.STATUS_DOWNLOADED,
+                              self.directory + '2/b.jpg')
+        self.assertListEqual(self.store.saved_files(self.directory),
+                             [(inside.board, inside.file.id,
+                               os.path.join(self.directory, 'a.jpg'),
+                               inside.file.md5)])
+
+    def test_reset_files(self):
+        post = self._FILE_POSTS[0]
+        self.store.set_status(post, store.STATUS_DOWNLOADED, 'a.jpg')
+        self.store.reset_files([(post.board, post.file.id)])
+        self.assertSetEqual(
+            self.store.downloaded(self.thread.board, self.thread.id), set())
+
+    def test_status_survives_re_add(self):
+        post = self._FILE_POSTS[0]
+        self.store.set_status(post, store.STATUS_DOWNLOADED, 'a.jpg')
+        self.store.add_posts(self.thread, TestThread.POSTS)
+        self.assertSetEqual(
+            self.store.downloaded(self.thread.board, self.thread.id),
+            {post.file.id})
+
+    def test_persistence(self):
+        self.store.set_status(self._FILE_POSTS[0], store.STATUS_DOWNLOADED)
+        self.store.close()
+        self.store = store.Store(self.path)
+        self.assertEqual(
+            len(self.store.downloaded(self.thread.board, self.thread.id)), 1)
+
+    def test_runs(self):
+        run_id = self.store.start_run(self.thread)
+        tally = stats.Tally()
+        for post in self._FILE_POSTS:
+            tally.add(OUTCOME_DOWNLOADED, post)
+        self.store.finish_run(run_id, DownloadResult(
+            tally, datetime.timedelta(seconds=1)))
+        row = self.store._connection.execute(
+            'SELECT downloaded, failed, finished FROM runs WHERE id = ?',
+            (run_id,)).fetchone()
+        self.assertEqual(row[0], len(self._FILE_POSTS))
+        self.assertEqual(row[1], 0)
+        self.assertIsNotNone(row[2])
+
+
+class TestStoreJobs(unittest.TestCase):
+
+    _URL = 'http://boards.4chan.org/wg/thread/6840627'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = store.Store(os.path.join(self.directory, 'chandl.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_add_job(self):
+        job = self.store.job(self.store.add_job(self._URL, {'filter': ['jpg']}))
+        self.assertEqual(job['url'], self._URL)
+        self.assertEqual(job['options'], {'filter': ['jpg']})
+        self.assertEqual(job['status'], store.JOB_QUEUED)
+
+    def test_job_missing(self):
+        self.assertIsNone(self.store.job(1))
+
+    def test_claim_job_oldest_first(self):
+        first = self.store.add_job(self._URL, {})
+        self.store.add_job(self._URL, {})
+        job = self.store.claim_job()
+        self.assertEqual(job['id'], first)
+        self.assertEqual(job['status'], store.JOB_RUNNING)
+
+    def test_claim_job_empty(self):
+        self.assertIsNone(self.store.claim_job())
+
+    def test_finish_job(self):
+        job_id = self.store.add_job(self._URL, {})
+        self.store.claim_job()
+        run_id = self.store.start_run(TestThread._thread)
+        self.store.finish_run(run_id, DownloadResult(
+            stats.Tally(), datetime.timedelta(seconds=1)))
+        self.store.finish_job(job_id, run_id)
+        job = self.store.job(job_id)
+        self.assertEqual(job['status'], store.JOB_DONE)
+        self.assertEqual(job['downloaded'], 0)
+
+    def test_finish_job_error(self):
+        job_id = self.store.add_job(self._URL, {})
+        self.store.finish_job(job_id, error='Not found')
+        self.assertEqual(self.store.job(job_id)['status'], store.JOB_FAILED)
+
+    def test_requeue_jobs(self):
+        job_id = self.store.add_job(self._URL, {})
+        self.store.claim_job()
+        self.assertEqual(self.store.requeue_jobs(), 1)
+        self.assertEqual(self.store.job(job_id)['status'], store.JOB_QUEUED)
+
+    def test_jobs_newest_first(self):
+        ids = [self.store.add_job(self._URL, {}) for _ in range(3)]
+        self.assertListEqual([job['id'] for job in self.store.jobs(2)],
+                             ids[:0:-1])
+
+    def test_job_counts(self):
+        self.store.add_job(self._URL, {})
+        self.store.add_job(self._URL, {})
+        self.store.claim_job()
+        self.assertDictEqual(self.store.job_counts(),
+                             {store.JOB_QUEUED: 1, store.JOB_RUNNING: 1})
+
+
+def _has_fts5():
+    try:
+        sqlite3.connect(':memory:').execute(
+            'CREATE VIRTUAL TABLE test USING fts5 (text)')
+        return True
+    except sqlite3.Error:
+        return False
+
+
+@unittest.skipUnless(_has_fts5(), 'SQLite was built without FTS5')
+class TestStoreSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = store.Store(os.path.join(self.directory, 'chandl.db'),
+                                 index=True)
+        self.thread = TestThread._thread
+        self.store.add_thread(self.thread)
+        self.store.add_posts(self.thread, TestThread.POSTS)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_body(self):
+        results = self.store.search('sparrow')
+        self.assertListEqual([result.post_id for result in results],
+                             [TestThread.POSTS[3].id])
+        self.assertIn('[sparrow]', results[0].snippet)
+
+    def test_html_stripped(self):
+        self.assertListEqual(self.store.search('quotelink'), [])
+
+    def test_title(self):
+        self.assertEqual(len(self.store.search('title:monty')),
+                         len(TestThread.POSTS))
+
+    def test_filename(self):
+        post = TestThread.POSTS[2]
+        results = self.store.search('filename:stretched')
+        self.assertListEqual([result.post_id for result in results],
+                             [post.id])
+        self.assertIsNone(results[0].path)
+
+    def test_path(self):
+        post = TestThread.POSTS[2]
+        self.store.set_status(post, store.STATUS_DOWNLOADED, 'a.jpg')
+        results = self.store.search('filename:stretched')
+        self.assertEqual(results[0].path, 'a.jpg')
+
+    def test_indexed_once(self):
+        self.store.add_posts(self.thread, TestThread.POSTS)
+        self.assertEqual(len(self.store.search('sparrow')), 1)
+
+    def test_index_stored(self):
+        # posts stored before indexing was enabled are indexed once it is
+        path = os.path.join(self.directory, 'unindexed.db')
+        unindexed = store.Store(path)
+        unindexed.add_thread(self.thread)
+        unindexed.add_posts(self.thread, TestThread.POSTS)
+        unindexed.close()
+
+        for _ in range(2):
+            indexed = store.Store(path, index=True)
+            results = indexed.search('filename:stretched')
+            self.assertListEqual([result.post_id for result in results],
+                                 [TestThread.POSTS[2].id])
+            self.assertEqual(len(indexed.search('title:monty')),
+                             len(TestThread.POSTS))
+            indexed.close()
+
+    def test_malformed_query(self):
+        with self.assertRaises(sqlite3.Error):
+            self.store.search('"unterminated')
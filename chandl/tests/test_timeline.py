@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from chandl import timeline
+
+
+class TestTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.timeline = timeline.Timeline()
+
+    def tearDown(self):
+        timeline.bind(None)
+
+    def test_unbound(self):
+        timeline.mark(timeline.PHASE_IDLE)
+        timeline.mark(timeline.PHASE_CONNECTING)
+        self.assertEqual(len(self.timeline), 0)
+
+    def test_mark(self):
+        timeline.bind(self.timeline)
+        timeline.mark(timeline.PHASE_IDLE)
+        timeline.mark(timeline.PHASE_CONNECTING)
+        timeline.mark(None)
+        timeline.mark(timeline.PHASE_WRITING)
+        timeline.bind(None)
+        # stops recording
+        timeline.mark(timeline.PHASE_IDLE)
+
+        spans = self.timeline._spans
+        self.assertEqual([phase for _, phase, _, _ in spans],
+                         [timeline.PHASE_IDLE, timeline.PHASE_CONNECTING,
+                          timeline.PHASE_WRITING])
+        for (_, _, start, end), (_, _, next_start, _) in zip(spans,
+                                                             spans[1:]):
+            self.assertLessEqual(start, end)
+            self.assertLessEqual(end, next_start)
+
+    def test_threads(self):
+        def run():
+            timeline.bind(self.timeline)
+            timeline.mark(timeline.PHASE_TRANSFERRING)
+            timeline.bind(None)
+
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(track for track, _, _, _
+                                in self.timeline._spans), [1, 2, 3])
+
+    def test_write(self):
+        timeline.bind(self.timeline)
+        timeline.mark(timeline.PHASE_VERIFYING)
+        timeline.bind(None)
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'timeline.json')
+            self.timeline.write(path)
+            with io.open(path, encoding='utf-8') as f:
+                events = json.load(f)['traceEvents']
+        finally:
+            shutil.rmtree(directory)
+
+        name, span = events
+        self.assertEqual(name['ph'], 'M')
+        self.assertEqual(name['args']['name'],
+                         threading.current_thread().name)
+        self.assertEqual(span['name'], timeline.PHASE_VERIFYING)
+        self.assertEqual(span['ph'], 'X')
+        self.assertEqual(span['tid'], name['tid'])
+        self.assertGreaterEqual(span['dur'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
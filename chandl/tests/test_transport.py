@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from httmock import all_requests, response, HTTMock
+
+from chandl import transport
+from chandl.benchmarks.server import FakeChan
+from chandl.model.thread import Thread
+from chandl.tests.model.test_post import TestPost
+from chandl.tests.model.test_thread import TestThread
+
+
+class TestResponse(unittest.TestCase):
+
+    def test_iter_content(self):
+        response_ = transport.Response('url', 200, io.BytesIO(b'abcde'))
+        self.assertListEqual(list(response_.iter_content(2)),
+                             [b'ab', b'cd', b'e'])
+
+    def test_json(self):
+        response_ = transport.Response('url', 200, io.BytesIO(b'{"a": 1}'))
+        self.assertDictEqual(response_.json(), {'a': 1})
+        self.assertTrue(response_.raw.closed)
+
+    def test_json_invalid(self):
+        response_ = transport.Response('url', 200, io.BytesIO(b'invalid'))
+        with self.assertRaises(ValueError):
+            response_.json()
+
+
+class TestRecordReplay(unittest.TestCase):
+
+    _URL = TestPost.POST.file.url
+    _RESOURCE = os.path.join(os.path.dirname(__file__), 'model', 'resources',
+                             TestPost.POST.file.filename)
+
+    def setUp(self):
+        self.cassette = os.path.join(tempfile.mkdtemp(), 'cassette')
+        with open(self._RESOURCE, 'rb') as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.cassette))
+
+    def _record(self, status_code=200):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(status_code, self.content, stream=True)
+
+        with HTTMock(response_content):
+            return transport.RecordingTransport(self.cassette).get(self._URL)
+
+    def test_replay(self):
+        self.assertEqual(self._record().raw.read(), self.content)
+        replayed = transport.ReplayTransport(self.cassette).get(self._URL)
+        self.assertEqual(replayed.status_code, 200)
+        self.assertEqual(replayed.raw.read(), self.content)
+        replayed.close()
+
+    def test_replay_status(self):
+        self._record(404).raw.read()
+        replayed = transport.ReplayTransport(self.cassette).get(self._URL)
+        self.assertEqual(replayed.status_code, 404)
+        replayed.close()
+
+    def test_replay_missing(self):
+        with self.assertRaises(IOError):
+            transport.ReplayTransport(self.cassette).get(self._URL)
+
+    def test_partial_not_recorded(self):
+        response_ = self._record()
+        response_.raw.read(100)
+        response_.close()
+        self.assertListEqual(os.listdir(self.cassette), [])
+        with self.assertRaises(IOError):
+            transport.ReplayTransport(self.cassette).get(self._URL)
+
+    def test_factory(self):
+        recording = transport.factory(transport.BACKEND_RECORD,
+                                      self.cassette)()
+        self.assertIsInstance(recording, transport.RecordingTransport)
+        self._record().raw.read()
+        recording.close()
+
+        # no mock, so only succeeds if the replay transport is used
+        replaying = transport.factory(transport.BACKEND_REPLAY,
+                                      self.cassette)()
+        with tempfile.TemporaryFile() as handle:
+            self.assertEqual(TestPost.POST.file.fetch(handle, replaying),
+                             TestPost.POST.file.md5)
+        replaying.close()
+
+    def test_from_url(self):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            return response(content=json.dumps(TestThread._THREAD_JSON),
+                            stream=True)
+
+        with HTTMock(response_content):
+            recorded = Thread.from_url(
+                TestThread._VALID_URL,
+                transport.RecordingTransport(self.cassette), stream=True)
+            list(recorded.posts)
+
+        self.assertEqual(Thread.from_url(TestThread._VALID_URL,
+                                         transport.ReplayTransport(
+                                             self.cassette)),
+                         Thread(TestThread._BOARD, TestThread._ID,
+                                TestThread._SUBJECT, TestThread._TITLE,
+                                TestThread._SLUG, TestThread.POSTS))
+
+
+class TestPrewarm(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeChan(posts=1, file_size=1024)
+        cls.fake.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop()
+
+    def setUp(self):
+        self.session = transport.pooled(4)
+
+    def tearDown(self):
+        self.session.close()
+
+    def _prewarm(self, url, connections):
+        for thread in transport.prewarm(self.session, url, connections):
+            thread.join()
+        return transport._connection_pool(self.session, url)
+
+    def test_pooled(self):
+        pool = transport._connection_pool(self.session, self.fake.root + '/')
+        self.assertEqual(pool.pool.maxsize, 4)
+
+    def test_reused(self):
+        pool = self._prewarm(self.fake.root + '/', 3)
+        self.assertEqual(pool.num_connections, 3)
+        with self.fake.patched():
+            thread = Thread.from_url(self.fake.thread_url, self.session)
+            for _ in range(2):
+                self.session.get(thread.posts[0].file.url).close()
+        # the thread and file were requested over the connections opened
+        self.assertEqual(pool.num_connections, 3)
+
+    def test_capped(self):
+        pool = self._prewarm(self.fake.root + '/', 10)
+        self.assertEqual(pool.num_connections, 4)
+
+    def test_unsupported(self):
+        # as if urllib3 had changed its private API
+        connection_pool = transport._connection_pool
+        transport._connection_pool = lambda session, url: object()
+        try:
+            self.assertListEqual(
+                transport.prewarm(self.session, self.fake.root + '/', 2), [])
+        finally:
+            transport._connection_pool = connection_pool
+
+    def test_unreachable(self):
+        # nothing listens on the discard port
+        pool = self._prewarm('http://127.0.0.1:9/', 2)
+        self.assertEqual(pool.num_requests, 0)
+
+    def test_other_transports(self):
+        self.assertListEqual(
+            transport.prewarm(transport.ReplayTransport('cassette'),
+                              self.fake.root + '/', 2), [])
+
+
+class TestFactory(unittest.TestCase):
+
+    def test_default(self):
+        self.assertTrue(hasattr(transport.create(), 'mount'))
+        self.assertIs(transport.factory(transport.BACKEND_REQUESTS),
+                      transport.create)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            transport.factory('carrier-pigeon')
+
+    def test_cassette_required(self):
+        for backend in [transport.BACKEND_RECORD, transport.BACKEND_REPLAY]:
+            with self.assertRaises(ValueError):
+                transport.factory(backend)
+
+    @unittest.skipIf(transport.aiohttp, 'aiohttp is installed')
+    def test_async_unavailable(self):
+        with self.assertRaises(ValueError):
+            transport.factory(transport.BACKEND_ASYNC)
+
+    @unittest.skipUnless(transport.aiohttp, 'aiohttp is not installed')
+    def test_async_close(self):
+        transport_ = transport.pooled(4, transport.factory(
+            transport.BACKEND_ASYNC))
+        transport_.close()
+        self.assertTrue(transport_._loop.is_closed())
+        # further calls do nothing
+        transport_.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,10 @@ from __future__ import unicode_literals
 import unittest
 import sys
 import os
+import hashlib
+import mmap
+import shutil
+import tempfile
 import six
 import logging
 
@@ -131,6 +135,63 @@ class TestMd5File(unittest.TestCase):
             self.assertEqual(util.md5_file(path), os.path.basename(path))
 
 
+class TestMd5FileRange(unittest.TestCase):
+
+    # spans several allocation units, with a partial one at the end
+    _CONTENT = os.urandom(mmap.ALLOCATIONGRANULARITY * 3 + 123)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'file')
+        with open(self.path, 'wb') as f:
+            f.write(self._CONTENT)
+        self.settings = (util._HASH_BUFFER_SIZE, util._MMAP_THRESHOLD,
+                         util._MMAP_WINDOW)
+
+    def tearDown(self):
+        util._HASH_BUFFER_SIZE, util._MMAP_THRESHOLD, util._MMAP_WINDOW = \
+            self.settings
+        shutil.rmtree(self.directory)
+
+    def _assert_hashes(self, offset=0, size=None):
+        end = None if size is None else offset + size
+        self.assertEqual(util.md5_file(self.path, offset, size),
+                         hashlib.md5(self._CONTENT[offset:end]).hexdigest())
+
+    def test_small_reads(self):
+        util._HASH_BUFFER_SIZE = 1000
+        self._assert_hashes()
+        self._assert_hashes(10, 2500)
+
+    def test_mapped(self):
+        util._MMAP_THRESHOLD = 0
+        self._assert_hashes()
+
+    def test_mapped_windows(self):
+        util._MMAP_THRESHOLD = 0
+        util._MMAP_WINDOW = mmap.ALLOCATIONGRANULARITY
+        self._assert_hashes()
+
+    def test_mapped_unaligned(self):
+        util._MMAP_THRESHOLD = 0
+        self._assert_hashes(1000, mmap.ALLOCATIONGRANULARITY * 2)
+        self._assert_hashes(10, 20)
+
+    def test_empty(self):
+        open(self.path, 'wb').close()
+        self.assertEqual(util.md5_file(self.path),
+                         hashlib.md5(b'').hexdigest())
+
+    def test_past_end(self):
+        with self.assertRaises(ValueError):
+            util.md5_file(self.path, 0, len(self._CONTENT) * 2)
+
+    def test_mapped_past_end(self):
+        util._MMAP_THRESHOLD = 0
+        with self.assertRaises(ValueError):
+            util.md5_file(self.path, 0, len(self._CONTENT) * 2)
+
+
 class TestLogLevelFromVerbosity(unittest.TestCase):
 
     def test_warning(self):
@@ -169,3 +230,21 @@ class TestUnescapeHtml(unittest.TestCase):
 
     def test_named_reference(self):
         self.assertEqual(util.unescape_html('&copy;'), '©')
+
+    def test_no_entities(self):
+        text = 'No entities <br> here'
+        self.assertIs(util.unescape_html(text), text)
+
+
+class TestStripHtml(unittest.TestCase):
+
+    def test_escaped(self):
+        self.assertEqual(
+            util.strip_html('<span class="quote">&gt;Foo &amp; bar</span>'
+                            '<br>Baz'),
+            '>Foo & bar\nBaz')
+
+    def test_unescaped(self):
+        self.assertEqual(
+            util.strip_html('<a href="#p1" class="quotelink">>>1</a> a < b'),
+            '>>1 a < b')
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from httmock import all_requests, response, HTTMock
+
+from chandl import archive, verify
+from chandl.model.post import Post
+from chandl.tests.model.test_post import TestPost
+
+
+class TestVerifyDirectory(unittest.TestCase):
+
+    _RESOURCE = os.path.join(os.path.dirname(__file__), 'model', 'resources',
+                             TestPost.POST.file.filename)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ['a.jpg', 'b.jpg']:
+            shutil.copy(self._RESOURCE, os.path.join(self.directory, name))
+        self.entries = [verify.Entry(name, TestPost.POST.file.md5)
+                        for name in ['a.jpg', 'b.jpg', 'c.jpg']]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _verify(self, processes):
+        with open(os.path.join(self.directory, 'b.jpg'), 'ab') as f:
+            f.write(b'\0')
+        return verify.verify_directory(self.directory, self.entries,
+                                       processes)
+
+    def test_in_process(self):
+        result = self._verify(1)
+        self.assertEqual(result.checked, 3)
+        self.assertListEqual([entry.name for entry in result.corrupt],
+                             ['b.jpg'])
+        self.assertListEqual([entry.name for entry in result.missing],
+                             ['c.jpg'])
+
+    def test_pool(self):
+        result = self._verify(2)
+        self.assertListEqual([str(problem) for problem in result.problems],
+                             ['corrupt: b.jpg', 'missing: c.jpg'])
+
+    def test_empty(self):
+        result = verify.verify_directory(self.directory, [])
+        self.assertEqual(result.checked, 0)
+        self.assertListEqual(result.problems, [])
+
+
+class TestVerifyArchive(unittest.TestCase):
+
+    _RESOURCE = os.path.join(os.path.dirname(__file__), 'model', 'resources',
+                             TestPost.POST.file.filename)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _archive(self, format_, names, first_id=0):
+        # noinspection PyUnusedLocal
+        @all_requests
+        def response_content(url, request):
+            with open(self._RESOURCE, 'rb') as f:
+                return response(content=f.read(), stream=True)
+
+        path = os.path.join(self.directory, 'thread.' + format_)
+        posts = []
+        for i in range(first_id, first_id + len(names)):
+            # a distinct file id for each post, so later runs add to the
+            # archive rather than skip
+            file_ = copy.copy(TestPost.POST.file)
+            file_.id = i
+            posts.append(Post(TestPost.BOARD, i, TestPost.POST.timestamp,
+                              file_=file_))
+        with HTTMock(response_content), archive.Archive(path) as archive_:
+            for post, name in zip(posts, names):
+                archive_.save(post, name)
+        return path
+
+    def _assert_intact(self, format_):
+        path = self._archive(format_, ['a.jpg', 'b.jpg'])
+        result = verify.verify_archive(path, 2)
+        self.assertEqual(result.checked, 2)
+        self.assertListEqual(result.problems, [])
+
+    def test_tar(self):
+        self._assert_intact(archive.FORMAT_TAR)
+
+    def test_tar_gz(self):
+        self._assert_intact(archive.FORMAT_TAR_GZ)
+
+    def test_zip(self):
+        self._assert_intact(archive.FORMAT_ZIP)
+
+    def test_parts(self):
+        self._archive(archive.FORMAT_TAR_GZ, ['a.jpg'])
+        path = self._archive(archive.FORMAT_TAR_GZ, ['b.jpg'], 1)
+        self.assertTrue(os.path.isfile(os.path.join(self.directory,
+                                                    'thread.2.tar.gz')))
+        result = verify.verify_archive(path, 2)
+        self.assertEqual(result.checked, 2)
+        self.assertListEqual(result.problems, [])
+
+    def test_corrupt(self):
+        path = self._archive(archive.FORMAT_ZIP, ['a.jpg'])
+        ranges = verify._member_ranges(path, archive.FORMAT_ZIP)
+        offset, _ = ranges['a.jpg']
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            f.write(b'\0')
+        result = verify.verify_archive(path, 1)
+        self.assertListEqual([str(problem) for problem in result.problems],
+                             ['corrupt: a.jpg'])
+
+    def test_compressed_zip(self):
+        path = self._archive(archive.FORMAT_ZIP, ['a.jpg'])
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_:
+            zip_.write(self._RESOURCE, 'a.jpg')
+        self.assertIsNone(verify._member_ranges(path, archive.FORMAT_ZIP))
+        self.assertListEqual(verify.verify_archive(path, 1).problems, [])
+
+    def test_missing_part(self):
+        path = self._archive(archive.FORMAT_TAR, ['a.jpg'])
+        os.remove(path)
+        result = verify.verify_archive(path)
+        self.assertListEqual([str(problem) for problem in result.problems],
+                             ['missing: a.jpg'])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            verify.verify_archive(os.path.join(self.directory, 'thread.rar'))
+
+    def test_no_manifest(self):
+        with self.assertRaises(IOError):
+            verify.verify_archive(os.path.join(self.directory, 'thread.tar'))
+
+
+if __name__ == '__main__':
+    unittest.main()
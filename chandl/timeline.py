@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Recording what each download thread spends its time on, as a timeline of
+phases, for viewing in Chrome's about:tracing or Perfetto, e.g. to see how
+saturated the thread pool is, and how unevenly it drains near the end.
+"""
+from __future__ import unicode_literals, division
+
+import io
+import json
+import os
+import threading
+import time
+
+
+# what a thread can be doing: waiting for a job, waiting for a response's
+# headers, receiving its body, finishing the file on disk, or checking the
+# checksum of a file that already exists
+PHASE_IDLE = 'idle'
+PHASE_CONNECTING = 'connecting'
+PHASE_TRANSFERRING = 'transferring'
+PHASE_WRITING = 'writing'
+PHASE_VERIFYING = 'verifying'
+
+# the timeline each thread is recording to, if any
+_current = threading.local()
+
+
+class Timeline:
+    """
+    Collects spans of each bound thread's phases. A thread is in exactly one
+    phase at a time while bound, from one call to `mark()` until the next.
+    Safe to use from many threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._origin = time.time()
+        # (track, phase, start, end) tuples, in seconds since `_origin`
+        self._spans = []
+        # track -> thread name; threads get their own track in the order they
+        # are bound, as thread idents are reused
+        self._tracks = {}
+
+    def _bind(self):
+        """
+        Give the calling thread a track of its own.
+
+        :return: The track.
+        """
+        with self._lock:
+            track = len(self._tracks) + 1
+            self._tracks[track] = threading.current_thread().name
+        return track
+
+    def _add(self, track, phase, start, end):
+        """
+        Record a span.
+
+        :param track: The track of the thread it belongs to.
+        :param phase: What the thread was doing, one of the `PHASE_*`
+                      constants.
+        :param start: When the span started, from `time.time()`.
+        :param end: When the span ended, from `time.time()`.
+        """
+        with self._lock:
+            self._spans.append((track, phase, start - self._origin,
+                                end - self._origin))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._spans)
+
+    def write(self, path):
+        """
+        Write the timeline in Chrome's trace event format.
+
+        :param path: The file to write to.
+        :raises IOError: If the file could not be written.
+        """
+        with self._lock:
+            spans = list(self._spans)
+            tracks = dict(self._tracks)
+
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': track,
+                   'args': {'name': name}}
+                  for track, name in sorted(tracks.items())]
+        # timestamps are in microseconds
+        events.extend({'name': phase, 'cat': 'download', 'ph': 'X',
+                       'pid': pid, 'tid': track, 'ts': round(start * 1e6, 1),
+                       'dur': round((end - start) * 1e6, 1)}
+                      for track, phase, start, end in spans)
+        with io.open(path, 'w', encoding='utf-8') as handle:
+            handle.write(json.dumps({'traceEvents': events,
+                                     'displayTimeUnit': 'ms'},
+                                    ensure_ascii=False))
+
+
+def bind(timeline):
+    """
+    Start or stop recording the calling thread's phases, ending its current
+    phase, if any.
+
+    :param timeline: The `Timeline` to record to, or None to stop recording.
+    """
+    mark(None)
+    _current.timeline = timeline
+    _current.track = timeline._bind() if timeline is not None else None
+    _current.phase = None
+
+
+def mark(phase):
+    """
+    Note that the calling thread has entered a phase, ending its previous one.
+    Does nothing unless the thread is bound to a timeline, so is cheap enough
+    to call unconditionally.
+
+    :param phase: What the thread is now doing, one of the `PHASE_*`
+                  constants, or None if nothing worth recording.
+    """
+    timeline = getattr(_current, 'timeline', None)
+    if timeline is None:
+        return
+    now = time.time()
+    previous = _current.phase
+    if previous is not None:
+        timeline._add(_current.track, previous, _current.start, now)
+    _current.phase = phase
+    _current.start = now
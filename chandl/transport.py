@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+"""
+The transports chandl's HTTP requests go through. A transport is an object
+with a requests-style `get(url, stream=False)` method, returning a response
+with a `status_code`, the body as a binary file object in `raw`, and
+`iter_content()` and `json()` methods, and a `close()` method to release its
+connections. A `requests.Session` is one; the other transports here return
+`Response`s.
+
+Code needing a transport takes one as an argument, falling back to a new
+requests session from `create()`. The command line picks the backend with
+`factory()`, e.g. to record a download once and replay it offline, and hands
+the resulting transport to everything it runs.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import requests
+
+from chandl import util
+
+try:
+    import asyncio
+    import aiohttp
+except ImportError:  # optional, and Python 3 only
+    aiohttp = None
+
+
+BACKEND_REQUESTS = 'requests'
+BACKEND_ASYNC = 'async'
+BACKEND_RECORD = 'record'
+BACKEND_REPLAY = 'replay'
+
+BACKENDS = [BACKEND_REQUESTS, BACKEND_ASYNC, BACKEND_RECORD, BACKEND_REPLAY]
+
+# the suffixes of the two files a response is recorded in
+_META_SUFFIX = '.json'
+_BODY_SUFFIX = '.body'
+
+logger = logging.getLogger(__name__)
+
+
+def create():
+    """
+    Get a transport using the default backend, a new requests session.
+
+    :return: The transport.
+    """
+    return util.create_session()
+
+
+def factory(backend, cassette=None):
+    """
+    Get a function creating transports using a backend, e.g. for `pooled()`.
+
+    :param backend: One of `BACKENDS`.
+    :param cassette: The directory responses are recorded in or replayed
+                     from; required by those backends.
+    :return: A function taking no arguments and returning a new transport.
+    :raises ValueError: If the backend is unknown or unavailable, or needs a
+                        cassette that was not given.
+    """
+    if backend not in BACKENDS:
+        raise ValueError('Unknown transport: {0}'.format(backend))
+    if backend in (BACKEND_RECORD, BACKEND_REPLAY) and not cassette:
+        raise ValueError('The {0} transport requires a cassette '
+                         'directory'.format(backend))
+
+    if backend == BACKEND_REQUESTS:
+        return create
+    if backend == BACKEND_ASYNC:
+        if aiohttp is None:
+            raise ValueError('The async transport requires the aiohttp '
+                             'package')
+        return AsyncTransport
+    if backend == BACKEND_RECORD:
+        return lambda: RecordingTransport(cassette)
+    return lambda: ReplayTransport(cassette)
+
+
+def pooled(connections, factory_=create):
+    """
+    Get a transport for many threads to share, e.g. so connections are reused
+    between the files of a thread. An `AsyncTransport` multiplexes every
+    thread's requests through its event loop as it is.
+
+    :param connections: The number of connections to keep open to each host;
+                        at least the number of threads using the transport.
+    :param factory_: The function to create the transport with; see
+                     `factory()`. Defaults to `create()`.
+    :return: The transport, to be closed once no longer needed.
+    """
+    transport = factory_()
+    if isinstance(transport, requests.Session):
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=connections)
+        transport.mount('https://', adapter)
+        transport.mount('http://', adapter)
+    return transport
+
+
+def _connection_pool(session, url):
+    """
+    Find the urllib3 connection pool a requests session sends requests for a
+    URL through.
+
+    :param session: The `requests.Session`.
+    :param url: The URL.
+    :return: The connection pool.
+    """
+    adapter = session.get_adapter(url)
+    try:
+        get_connection = adapter.get_connection_with_tls_context
+    except AttributeError:  # requests < 2.32
+        return adapter.get_connection(url)
+    return get_connection(
+        session.prepare_request(requests.Request('GET', url)), session.verify)
+
+
+def _can_prewarm(pool):
+    """
+    Find whether a connection pool has the private urllib3 API prewarming
+    takes connections from it and returns them with. It is not part of
+    urllib3's public interface, so may change in any release.
+
+    :param pool: The urllib3 connection pool.
+    :return: True if it does.
+    """
+    return callable(getattr(pool, '_get_conn', None)) and \
+        callable(getattr(pool, '_put_conn', None)) and \
+        hasattr(getattr(pool, 'pool', None), 'maxsize')
+
+
+def _warm(pool, connection, url):
+    """
+    Open a connection taken from a pool, resolving the host's name and
+    completing the TCP and TLS handshakes, and return it for the next request
+    to use.
+
+    :param pool: The urllib3 connection pool.
+    :param connection: The connection.
+    :param url: The URL the pool is for, for logging.
+    """
+    # pylint: disable=protected-access
+    if getattr(connection, 'sock', None) is not None:
+        # already open, e.g. by an earlier request
+        pool._put_conn(connection)
+        return
+    start = time.time()
+    try:
+        connection.connect()
+    except Exception as e:  # pylint: disable=broad-except
+        # the request that would have used it will report the problem
+        logger.debug('Failed to open a connection for %s: %s', url, e)
+        connection.close()
+        pool._put_conn(None)
+        return
+    logger.debug('Opened a connection for %s in %.3f seconds', url,
+                 time.time() - start)
+    pool._put_conn(connection)
+
+
+def prewarm(transport, url, connections=1):
+    """
+    Open connections to a host in the background, so the first requests to
+    it, e.g. for files once a thread has been retrieved, need not wait for a
+    connection to be set up. Only requests sessions keep connections open;
+    other transports are left alone, as are sessions whose urllib3 lacks the
+    private API this relies on.
+
+    :param transport: The transport that will send the requests.
+    :param url: A URL on the host.
+    :param connections: The number of connections to open, each on its own
+                        thread. No more than the pool holds are opened.
+    :return: The threads opening the connections, e.g. to join.
+    """
+    if not isinstance(transport, requests.Session) or connections < 1:
+        return []
+    pool = _connection_pool(transport, url)
+    if not _can_prewarm(pool):
+        logger.debug('Not prewarming connections for %s: unsupported by this '
+                     'version of urllib3', url)
+        return []
+    # taken all at once, so none is handed out twice
+    taken = [pool._get_conn()  # pylint: disable=protected-access
+             for _ in range(min(connections, pool.pool.maxsize))]
+    threads = [threading.Thread(target=_warm, args=(pool, connection, url))
+               for connection in taken]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return threads
+
+
+def _cassette_path(cassette, url):
+    """
+    Find where a response is recorded.
+
+    :param cassette: The cassette directory.
+    :param url: The URL requested.
+    :return: The path, without a suffix.
+    """
+    return os.path.join(cassette,
+                        hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+class Response:
+    """
+    A response from a transport other than requests, with the subset of
+    `requests.Response` chandl uses.
+    """
+
+    def __init__(self, url, status_code, raw):
+        """
+        Initialise a new response.
+
+        :param url: The URL requested.
+        :param status_code: The HTTP status code.
+        :param raw: The body, a binary file object supporting `read()` and
+                    `readinto()`.
+        """
+        self.url = url
+        self.status_code = status_code
+        self.raw = raw
+
+    def iter_content(self, chunk_size=1):
+        """
+        Iterate over the body.
+
+        :param chunk_size: The maximum size of each chunk.
+        :return: An iterator of byte strings.
+        """
+        return iter(lambda: self.raw.read(chunk_size), b'')
+
+    def json(self):
+        """
+        Decode the body as JSON.
+
+        :return: The decoded value.
+        :raises ValueError: If the body is not valid JSON.
+        """
+        try:
+            return json.loads(self.raw.read().decode('utf-8'))
+        finally:
+            self.raw.close()
+
+    def close(self):
+        """
+        Release the body.
+        """
+        self.raw.close()
+
+
+class _Recorder(io.RawIOBase):
+    """
+    A response body that copies everything read from it into a cassette. The
+    recording is only kept if the body is read to the end.
+    """
+
+    def __init__(self, raw, path, url, status_code):
+        """
+        Initialise a new recorder.
+
+        :param raw: The body being read.
+        :param path: Where to record the response, without a suffix.
+        :param url: The URL requested.
+        :param status_code: The HTTP status code.
+        """
+        super(_Recorder, self).__init__()
+        self._raw = raw
+        self._path = path
+        self._meta = {'url': url, 'status': status_code}
+        self._body = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), suffix='.part', delete=False)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer_):
+        data = self._raw.read(len(buffer_))
+        if not data:
+            self._finish()
+            return 0
+        self._body.write(data)
+        buffer_[:len(data)] = data
+        return len(data)
+
+    def _finish(self):
+        """
+        Move the recording into place, once the whole body has been read.
+        """
+        if self._body.closed:
+            return
+        self._body.close()
+        os.rename(self._body.name, self._path + _BODY_SUFFIX)
+        with io.open(self._path + _META_SUFFIX, 'w',
+                     encoding='utf-8') as handle:
+            handle.write(json.dumps(self._meta))
+
+    def close(self):
+        if not self._body.closed:
+            # abandoned part way through
+            self._body.close()
+            os.remove(self._body.name)
+        self._raw.close()
+        super(_Recorder, self).close()
+
+
+class RecordingTransport:
+    """
+    A transport that sends requests with requests, recording every response
+    read to the end in a cassette directory for `ReplayTransport`.
+    """
+
+    def __init__(self, cassette, transport=None):
+        """
+        Initialise a new recording transport, creating the cassette directory
+        if necessary.
+
+        :param cassette: The directory to record responses in.
+        :param transport: The transport to send requests with. Defaults to a
+                          new requests session.
+        """
+        if not os.path.isdir(cassette):
+            os.makedirs(cassette)
+        self._cassette = cassette
+        self._transport = transport or util.create_session()
+
+    def close(self):
+        """
+        Close the transport requests are sent with.
+        """
+        self._transport.close()
+
+    def get(self, url, stream=False):
+        """
+        Send a GET request, recording the response.
+
+        :param url: The URL to request.
+        :param stream: Ignored; the body is always streamed.
+        :return: The `Response`.
+        """
+        response = self._transport.get(url, stream=True)
+        raw = response.raw
+        if hasattr(raw, 'decode_content'):
+            # record the body as callers of requests' other methods see it
+            raw.decode_content = True
+        return Response(url, response.status_code, io.BufferedReader(
+            _Recorder(raw, _cassette_path(self._cassette, url), url,
+                      response.status_code)))
+
+
+class ReplayTransport:
+    """
+    A transport answering requests from the responses in a cassette directory
+    written by `RecordingTransport`, without touching the network.
+    """
+
+    def __init__(self, cassette):
+        """
+        Initialise a new replay transport.
+
+        :param cassette: The directory containing the recorded responses.
+        """
+        self._cassette = cassette
+
+    def close(self):
+        """
+        Do nothing; responses are opened and closed one by one.
+        """
+
+    def get(self, url, stream=False):
+        """
+        Replay the recorded response to a GET request.
+
+        :param url: The URL requested.
+        :param stream: Ignored; the body is always read from disk as needed.
+        :return: The `Response`.
+        :raises IOError: If the response was not recorded.
+        """
+        path = _cassette_path(self._cassette, url)
+        try:
+            with io.open(path + _META_SUFFIX, encoding='utf-8') as handle:
+                meta = json.load(handle)
+        except (IOError, OSError):
+            raise IOError('No recorded response to {0}'.format(url))
+        return Response(url, meta['status'], io.open(path + _BODY_SUFFIX, 'rb'))
+
+
+class _AsyncBody(io.RawIOBase):
+    """
+    The body of an aiohttp response, read from another thread.
+    """
+
+    def __init__(self, transport, response):
+        """
+        Initialise a new body.
+
+        :param transport: The `AsyncTransport` the response came from.
+        :param response: The aiohttp response.
+        """
+        super(_AsyncBody, self).__init__()
+        self._transport = transport
+        self._response = response
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer_):
+        data = self._transport._run(self._response.content.read(len(buffer_)))
+        buffer_[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._transport._loop.call_soon_threadsafe(self._response.close)
+        super(_AsyncBody, self).close()
+
+
+class AsyncTransport:
+    """
+    A transport sending every request through a single asyncio event loop,
+    using aiohttp. The loop runs on its own thread and holds all connections,
+    so any number of download threads share one connection pool, each only
+    blocking on its own responses. Requires the aiohttp package.
+    """
+
+    def __init__(self):
+        """
+        Start a new event loop.
+
+        :raises ValueError: If aiohttp is unavailable.
+        """
+        if aiohttp is None:
+            raise ValueError('The async transport requires the aiohttp '
+                             'package')
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+        headers = dict(util.create_session().headers)
+        self._session = self._call(
+            lambda: aiohttp.ClientSession(headers=headers))
+
+    def _call(self, function):
+        """
+        Call a function on the event loop and wait for its result.
+
+        :param function: The function, taking no arguments.
+        :return: Its result.
+        """
+        done = threading.Event()
+        result = []
+
+        def call():
+            try:
+                result.append((function(), None))
+            except Exception as e:  # pylint: disable=broad-except
+                result.append((None, e))
+            done.set()
+
+        self._loop.call_soon_threadsafe(call)
+        done.wait()
+        value, error = result[0]
+        if error:
+            raise error
+        return value
+
+    def _run(self, coroutine):
+        """
+        Run a coroutine on the event loop and wait for its result.
+
+        :param coroutine: The coroutine.
+        :return: Its result.
+        :raises IOError: If the request failed.
+        """
+        try:
+            return asyncio.run_coroutine_threadsafe(coroutine,
+                                                    self._loop).result()
+        except aiohttp.ClientError as e:
+            raise IOError(str(e))
+
+    def get(self, url, stream=False):
+        """
+        Send a GET request.
+
+        :param url: The URL to request.
+        :param stream: Ignored; the body is always streamed.
+        :return: The `Response`.
+        :raises IOError: If the request failed.
+        """
+        response = self._run(self._session.get(url))
+        return Response(url, response.status,
+                        io.BufferedReader(_AsyncBody(self, response)))
+
+    def close(self):
+        """
+        Close every connection and stop the event loop. Further calls do
+        nothing.
+        """
+        if self._loop.is_closed():
+            return
+        try:
+            self._run(self._session.close())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import io
 import logging
+import mmap
+import os
 import sys
 import hashlib
+import threading
+import bleach
 import unidecode
 import six
 import requests
@@ -11,6 +16,21 @@ import requests
 import chandl
 
 
+# files are hashed by reading them into a reused buffer of this size; reads
+# this large also let hashlib release the GIL while hashing each one
+_HASH_BUFFER_SIZE = 1024 * 1024
+
+# files at least this large are mapped into memory rather than read...
+_MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# ...this much at a time; a multiple of every platform's allocation
+# granularity
+_MMAP_WINDOW = 64 * 1024 * 1024
+
+# each thread's hashing buffer
+_buffers = threading.local()
+
+
 def bytes_fmt(num, suffix='B'):
     """
     Turn a number of bytes into a more friendly representation, e.g. 2.5MiB.
@@ -83,25 +103,86 @@ def make_filename(string):
     return joined
 
 
-def md5_file(path):
+def md5_file(path, offset=0, size=None):
     """
-    Get the MD5 hash of a file.
+    Get the MD5 hash of a file, or part of one.
 
     :param path: The path of the file.
+    :param offset: The position of the first byte to hash. Defaults to the
+                   start of the file.
+    :param size: The number of bytes to hash. Defaults to the rest of the file.
     :return: The 32-character long lowercase hex representation of the
              checksum.
-    :raises ValueError: If path is invalid.
+    :raises ValueError: If path is invalid, or the range extends past the end
+                        of the file.
     """
     if not path:
         raise ValueError('Path cannot be empty or None')
 
     hash_ = hashlib.md5()
-    with open(path, 'rb') as fd:
-        for chunk in iter(lambda: fd.read(4096), b''):
-            hash_.update(chunk)
+    with io.open(path, 'rb') as handle:
+        if size is None:
+            size = os.fstat(handle.fileno()).st_size - offset
+        if size >= _MMAP_THRESHOLD:
+            _md5_mapped(hash_, handle, offset, size)
+        else:
+            _md5_read(hash_, handle, offset, size)
     return hash_.hexdigest()
 
 
+def _md5_read(hash_, handle, offset, size):
+    """
+    Hash part of a file by reading it into the calling thread's buffer, so no
+    new object is created per read.
+
+    :param hash_: The hash to update.
+    :param handle: The file, opened in binary mode.
+    :param offset: The position of the first byte to hash.
+    :param size: The number of bytes to hash.
+    """
+    buffer_ = getattr(_buffers, 'buffer', None)
+    if buffer_ is None:
+        buffer_ = _buffers.buffer = bytearray(_HASH_BUFFER_SIZE)
+    view = memoryview(buffer_)
+
+    handle.seek(offset)
+    while size:
+        read = handle.readinto(view[:min(size, _HASH_BUFFER_SIZE)])
+        if not read:
+            raise ValueError('Range extends past the end of the file')
+        hash_.update(view[:read])
+        size -= read
+
+
+def _md5_mapped(hash_, handle, offset, size):
+    """
+    Hash part of a file by mapping it into memory a window at a time, so it
+    is hashed straight out of the page cache.
+
+    :param hash_: The hash to update.
+    :param handle: The file, opened in binary mode.
+    :param offset: The position of the first byte to hash.
+    :param size: The number of bytes to hash.
+    """
+    end = offset + size
+
+    # mappings must start on a multiple of the allocation granularity
+    head = min(-offset % mmap.ALLOCATIONGRANULARITY, size)
+    if head:
+        _md5_read(hash_, handle, offset, head)
+
+    position = offset + head
+    while position < end:
+        length = min(_MMAP_WINDOW, end - position)
+        mapped = mmap.mmap(handle.fileno(), length, access=mmap.ACCESS_READ,
+                           offset=position)
+        try:
+            hash_.update(mapped)
+        finally:
+            mapped.close()
+        position += length
+
+
 def log_level_from_vebosity(verbosity):
     """
     Get the `logging` module log level from a verbosity.
@@ -132,12 +213,12 @@ def create_session():
     return session
 
 
-def unescape_html(html_):
+def _find_unescape():
     """
-    Replace HTML entities (e.g. `&pound;`) in a string.
+    Find the best available function for replacing HTML entities on this
+    version of Python.
 
-    :param html_: The escaped HTML.
-    :return: The input string with entities replaces.
+    :return: A function taking and returning a string.
     """
 
     # http://stackoverflow.com/a/2360639
@@ -145,15 +226,45 @@ def unescape_html(html_):
     if sys.version_info.major == 2:  # 2.7
         # noinspection PyUnresolvedReferences,PyCompatibility
         from HTMLParser import HTMLParser
-        return HTMLParser().unescape(html_)
+        return HTMLParser().unescape
 
     if sys.version_info.minor == 3:  # 3.3
         # noinspection PyCompatibility
         from html.parser import HTMLParser
         # noinspection PyDeprecation
-        return HTMLParser().unescape(html_)
+        return HTMLParser().unescape
 
     # 3.4+
     # noinspection PyCompatibility
     import html
-    return html.unescape(html_)
+    return html.unescape
+
+
+_unescape = _find_unescape()
+
+
+def unescape_html(html_):
+    """
+    Replace HTML entities (e.g. `&pound;`) in a string.
+
+    :param html_: The escaped HTML.
+    :return: The input string with entities replaces.
+    """
+
+    # every entity starts with an ampersand, and most posts contain none
+    if '&' not in html_:
+        return html_
+
+    return _unescape(html_)
+
+
+def strip_html(html_):
+    """
+    Reduce a post's comment to plain text, removing tags and replacing line
+    breaks with newlines.
+
+    :param html_: The comment's HTML, either escaped or unescaped.
+    :return: The text of the comment.
+    """
+    text = html_.replace('<br>', '\n')
+    return unescape_html(bleach.clean(text, tags=[], strip=True))
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Checking files that have already been downloaded against the checksums 4chan
+reports for them, without downloading anything. Files are hashed by a pool of
+processes, so large threads are checked at the speed of the disk rather than
+of a single core.
+"""
+from __future__ import unicode_literals
+
+import datetime
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import tarfile
+import zipfile
+
+from chandl import archive, util
+
+
+CORRUPT = 'corrupt'
+MISSING = 'missing'
+
+# the size of reads when an archive member has to be decompressed
+_CHUNK_SIZE = 1024 * 1024
+
+# the fixed-size part of a zip member's local header, ending with the lengths
+# of the name and extra field that precede the member's data
+_ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+_ZIP_LOCAL_SIGNATURE = b'PK\x03\x04'
+
+logger = logging.getLogger(__name__)
+
+
+def _hash_range(job):
+    """
+    Hash part of a file. Runs in a worker process.
+
+    :param job: A (path, offset, size) tuple; see `util.md5_file()`.
+    :return: The checksum, or None if the range could not be read.
+    """
+    try:
+        return util.md5_file(*job)
+    except (IOError, OSError, ValueError) as e:
+        logger.debug('Failed to read %s: %s', job[0], e)
+        return None
+
+
+def _hash_members(job):
+    """
+    Hash every member of an archive whose members cannot be mapped directly,
+    e.g. a compressed tar. Runs in a worker process.
+
+    :param job: A (path, format) tuple.
+    :return: A dictionary of member names to checksums; for duplicate names,
+             the last member wins. Members that could not be read are absent.
+    """
+    path, format_ = job
+    hashes = {}
+    try:
+        if format_ == archive.FORMAT_ZIP:
+            with zipfile.ZipFile(path) as zip_:
+                for info in zip_.infolist():
+                    with zip_.open(info) as handle:
+                        hashes[info.filename] = _md5_stream(handle)
+            return hashes
+
+        with open(path, 'rb') as raw:
+            if format_ == archive.FORMAT_TAR_ZSTD:
+                stream = archive.zstandard.ZstdDecompressor().stream_reader(raw)
+                tar = tarfile.open(fileobj=stream, mode='r|')
+            else:
+                tar = tarfile.open(fileobj=raw, mode='r|*')
+            with tar:
+                for member in tar:
+                    if member.isfile():
+                        hashes[member.name] = _md5_stream(
+                            tar.extractfile(member))
+    except (IOError, OSError, EOFError, tarfile.TarError,
+            zipfile.BadZipfile) as e:
+        # keep what was read before the damage
+        logger.debug('Failed to read %s: %s', path, e)
+    return hashes
+
+
+def _md5_stream(handle):
+    """
+    Get the MD5 hash of the rest of a file object.
+
+    :param handle: The file object.
+    :return: The checksum.
+    """
+    hash_ = hashlib.md5()
+    for chunk in iter(lambda: handle.read(_CHUNK_SIZE), b''):
+        hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def _map(function, jobs, processes=None):
+    """
+    Apply a function to each of a list of jobs, spread across processes.
+
+    :param function: The module-level function to apply.
+    :param jobs: The list of arguments to apply it to.
+    :param processes: The maximum number of processes to use. Defaults to the
+                      number of cores. If 1, jobs are run in this process.
+    :return: The list of results, in the order of the jobs.
+    """
+    processes = min(processes or multiprocessing.cpu_count(), len(jobs))
+    if processes <= 1:
+        return [function(job) for job in jobs]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(function, jobs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class Entry:
+    """
+    A file that is expected to have been downloaded.
+    """
+
+    def __init__(self, name, md5, source=None):
+        """
+        Initialise a new entry.
+
+        :param name: The file's path within the thread directory or archive.
+        :param md5: The checksum the file should have.
+        :param source: What the file was expected from, e.g. its post,
+                       returned with any problem found with it.
+        """
+        self.name = name
+        self.md5 = md5
+        self.source = source
+
+
+class Problem:
+    """
+    A file that is corrupt or missing.
+    """
+
+    def __init__(self, entry, kind):
+        """
+        Initialise a new problem.
+
+        :param entry: The `Entry` of the file.
+        :param kind: `CORRUPT` or `MISSING`.
+        """
+        self.entry = entry
+        self.kind = kind
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.kind, self.entry.name)
+
+
+class VerifyResult:
+    """
+    Represents the outcome of checking the files of a thread.
+    """
+
+    def __init__(self, checked, problems, elapsed):
+        """
+        Initialise a new verify result.
+
+        :param checked: The number of files checked.
+        :param problems: A list of `Problem`s, in the order of the entries.
+        :param elapsed: A timedelta representing the duration of the check.
+        """
+        self.checked = checked
+        self.problems = problems
+        self.corrupt = [problem.entry for problem in problems
+                        if problem.kind == CORRUPT]
+        self.missing = [problem.entry for problem in problems
+                        if problem.kind == MISSING]
+        self.elapsed = elapsed
+
+    def __str__(self):
+        return '{0} files checked, {1} corrupt, {2} missing\n' \
+               'Duration: {3:.3f} seconds'.format(
+                   self.checked, len(self.corrupt), len(self.missing),
+                   self.elapsed.total_seconds())
+
+
+def _result(entries, hashes, start):
+    """
+    Compare the checksums found with those expected.
+
+    :param entries: The `Entry`s checked.
+    :param hashes: For each entry, the checksum found, False if the file does
+                   not exist, or None if it could not be read.
+    :param start: When the check started.
+    :return: The `VerifyResult`.
+    """
+    problems = []
+    for entry, md5 in zip(entries, hashes):
+        if md5 is False:
+            problems.append(Problem(entry, MISSING))
+        elif md5 != entry.md5:
+            problems.append(Problem(entry, CORRUPT))
+    return VerifyResult(len(entries), problems,
+                        datetime.datetime.now() - start)
+
+
+def verify_directory(directory, entries, processes=None):
+    """
+    Check the files in a thread directory. Symlinks, e.g. into a content
+    tree, are followed.
+
+    :param directory: The thread directory.
+    :param entries: The `Entry`s of the files expected in it.
+    :param processes: The maximum number of processes to hash files with.
+                      Defaults to the number of cores.
+    :return: The `VerifyResult`.
+    """
+    start = datetime.datetime.now()
+    paths = [os.path.join(directory, entry.name) for entry in entries]
+    existing = [path for path in paths if os.path.isfile(path)]
+    found = dict(zip(existing, _map(_hash_range,
+                                    [(path, 0, None) for path in existing],
+                                    processes)))
+    return _result(entries, [found.get(path, False) for path in paths], start)
+
+
+def read_manifest(path):
+    """
+    Read the manifest of an archive written by `archive.Archive`.
+
+    :param path: The path of the archive.
+    :return: A list of `Entry`s, each with its manifest record as its source.
+    :raises IOError: If the manifest could not be read.
+    """
+    entries = []
+    with io.open(path + archive.MANIFEST_SUFFIX, encoding='utf-8') as handle:
+        for line in handle:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # cut short by a run being killed; the file was not recorded
+                continue
+            entries.append(Entry(record['name'], record['md5'], record))
+    return entries
+
+
+def _member_ranges(path, format_):
+    """
+    Find where the data of each member of an uncompressed archive is, so
+    members can be hashed in place.
+
+    :param path: The path of the archive.
+    :param format_: `archive.FORMAT_TAR` or `archive.FORMAT_ZIP`.
+    :return: A dictionary of member names to (offset, size) tuples, or None if
+             any member is compressed; for duplicate names, the last member
+             wins.
+    :raises IOError: If the archive could not be read.
+    :raises tarfile.TarError: If a tar archive is invalid.
+    :raises zipfile.BadZipfile: If a zip archive is invalid.
+    """
+    ranges = {}
+    if format_ == archive.FORMAT_TAR:
+        with tarfile.open(path) as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    ranges[member.name] = (member.offset_data, member.size)
+        return ranges
+
+    with zipfile.ZipFile(path) as zip_, open(path, 'rb') as raw:
+        for info in zip_.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                return None
+            raw.seek(info.header_offset)
+            signature, name_length, extra_length = _ZIP_LOCAL_HEADER.unpack(
+                raw.read(_ZIP_LOCAL_HEADER.size))
+            if signature != _ZIP_LOCAL_SIGNATURE:
+                raise zipfile.BadZipfile('Bad local header for ' +
+                                         info.filename)
+            ranges[info.filename] = (info.header_offset +
+                                     _ZIP_LOCAL_HEADER.size + name_length +
+                                     extra_length, info.compress_size)
+    return ranges
+
+
+def verify_archive(path, processes=None):
+    """
+    Check the files in an archive, and any later parts of it, against its
+    manifest. Members of uncompressed archives are hashed in place, spread
+    across processes; the parts of compressed archives can only be read from
+    start to end, so each is read by a single process.
+
+    :param path: The path of the archive, e.g. `thread.tar.gz`.
+    :param processes: The maximum number of processes to hash files with.
+                      Defaults to the number of cores.
+    :return: The `VerifyResult`.
+    :raises ValueError: If the archive's format is unknown or unavailable.
+    :raises IOError: If the manifest could not be read.
+    """
+    format_ = archive.detect_format(path)
+    if format_ is None:
+        raise ValueError('Unknown archive format for {0}'.format(path))
+    if format_ == archive.FORMAT_TAR_ZSTD and archive.zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+
+    start = datetime.datetime.now()
+    entries = read_manifest(path)
+    directory = os.path.dirname(path)
+    parts = sorted(set(os.path.join(directory, entry.source['archive'])
+                       for entry in entries))
+
+    # find each part's members, in place if possible
+    ranges, streamed = {}, []
+    for part in parts:
+        if not os.path.isfile(part):
+            continue
+        if format_ in (archive.FORMAT_TAR, archive.FORMAT_ZIP):
+            try:
+                ranges[part] = _member_ranges(part, format_)
+            except (IOError, OSError, EOFError, tarfile.TarError,
+                    zipfile.BadZipfile) as e:
+                logger.warning('Failed to list %s: %s', part, e)
+                ranges[part] = {}
+                continue
+            if ranges[part] is not None:
+                continue
+        streamed.append(part)
+
+    jobs = [(part, offset, size)
+            for part, members in ranges.items() if members
+            for offset, size in members.values()]
+    hashed = dict(zip(jobs, _map(_hash_range, jobs, processes)))
+    members = dict(zip(streamed, _map(_hash_members,
+                                      [(part, format_) for part in streamed],
+                                      processes)))
+    for part, part_ranges in ranges.items():
+        if part_ranges is not None:
+            members[part] = dict(
+                (name, hashed[(part, offset, size)])
+                for name, (offset, size) in part_ranges.items())
+
+    hashes = []
+    for entry in entries:
+        part = os.path.join(directory, entry.source['archive'])
+        hashes.append(members.get(part, {}).get(entry.name, False))
+    return _result(entries, hashes, start)
@@ -38,6 +38,9 @@ setup(
         'pytz',
         'pyfakefs'
     ],
+    extras_require={
+        'zstd': ['zstandard']
+    },
     test_suite='nose.collector',
     tests_require=[
         'nose'